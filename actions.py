@@ -1,4 +1,61 @@
+import struct
+import threading
+
+import numpy as np
+
+import canvas_cython_helpers
+
+DAMAGE_NONE = "none"
+DAMAGE_PIXELS = "pixels"
+DAMAGE_LAYERS = "layers"
+
+ACTION_BASE_BYTES = 64
+
+
+_ARRAY_HEADER = struct.Struct("<BI")
+
+
+def _array_bytes(array):
+    if array.ndim and array.strides[0] == 0:
+        return array.itemsize
+    return array.nbytes
+
+
+def _pack_arrays(*arrays):
+    parts = []
+    for array in arrays:
+        constant = len(array) > 1 and array.strides[0] == 0
+        parts.append(_ARRAY_HEADER.pack(constant, len(array)))
+        parts.append((array[:1] if constant else array).tobytes())
+    return b"".join(parts)
+
+
+def _unpack_arrays(data, count):
+    arrays, offset = [], 0
+    for _ in range(count):
+        constant, length = _ARRAY_HEADER.unpack_from(data, offset)
+        offset += _ARRAY_HEADER.size
+        stored = 1 if constant else length
+        array = np.frombuffer(data, dtype=np.uint32, count=stored, offset=offset)
+        offset += array.nbytes
+        arrays.append(np.broadcast_to(array[0], (length,)) if constant else array)
+    return arrays
+
+
 class Action:
+    damage = DAMAGE_LAYERS
+
+    def byte_size(self):
+        return ACTION_BASE_BYTES + sum(layer.nbytes for layer in self.held_layers())
+
+    def held_layers(self):
+        return ()
+
+    def freeze(self, store, live_layers):
+        for layer in self.held_layers():
+            if not any(layer is live for live in live_layers):
+                layer.freeze(store)
+
     def undo(self, app):
         raise NotImplementedError
 
@@ -7,47 +64,66 @@ class Action:
 
 
 class PixelAction(Action):
-    def __init__(self, layer_index, pixels_before, pixels_after):
+    damage = DAMAGE_PIXELS
+
+    def __init__(self, layer_index, indices, colors_before, colors_after):
         self.layer_index = layer_index
-        self.pixels_before = pixels_before
-        self.pixels_after = pixels_after
+        self._payload = (indices, colors_before, colors_after)
+        self._frozen = None
+        self._lock = threading.Lock()
+
+    def byte_size(self):
+        with self._lock:
+            if self._frozen is not None:
+                return ACTION_BASE_BYTES + self._frozen.resident_bytes
+            return ACTION_BASE_BYTES + sum(_array_bytes(a) for a in self._payload)
+
+    def freeze(self, store, live_layers):
+        with self._lock:
+            if self._frozen is None:
+                self._frozen = store.put(_pack_arrays(*self._payload))
+                self._payload = None
+
+    def payload(self):
+        with self._lock:
+            if self._frozen is not None:
+                self._payload = tuple(_unpack_arrays(self._frozen.load(), 3))
+                self._frozen = None
+            return self._payload
 
     def undo(self, app):
-        layer_data = app.layers[self.layer_index].pixel_data
-        for (x, y), data_before in self.pixels_before.items():
-            if data_before:
-                layer_data[(x, y)] = data_before
-            elif (x, y) in layer_data:
-                del layer_data[(x, y)]
-
-            app.pixel_canvas._update_dirty_bbox(x, y)
+        indices, colors_before, _ = self.payload()
+        self._apply(app, indices, colors_before)
 
     def redo(self, app):
-        layer_data = app.layers[self.layer_index].pixel_data
-        for (x, y), data_after in self.pixels_after.items():
-            if data_after:
-                layer_data[(x, y)] = data_after
-            elif (x, y) in layer_data:
-                del layer_data[(x, y)]
+        indices, _, colors_after = self.payload()
+        self._apply(app, indices, colors_after)
 
-            app.pixel_canvas._update_dirty_bbox(x, y)
+    def _apply(self, app, indices, colors):
+        layer = app.layers[self.layer_index]
+        canvas_cython_helpers.scatter_pixels_cy(layer.buffer, indices, colors)
+        app.pixel_canvas.mark_layer_dirty(layer)
+        app.pixel_canvas.mark_dirty_indices(indices, layer.buffer.width)
 
 
 class AddLayerAction(Action):
+    damage = DAMAGE_NONE
+
     def __init__(self, layer_obj, index, prev_active_index):
         self.layer_obj = layer_obj
         self.index = index
         self.prev_active_index = prev_active_index
 
+    def held_layers(self):
+        return (self.layer_obj,)
+
     def undo(self, app):
         app.layers.pop(self.index)
         app.active_layer_index = self.prev_active_index
-        app.layer_panel.update_ui()
 
     def redo(self, app):
         app.layers.insert(self.index, self.layer_obj)
         app.active_layer_index = self.index
-        app.layer_panel.update_ui()
 
 
 class DuplicateLayerAction(Action):
@@ -56,17 +132,16 @@ class DuplicateLayerAction(Action):
         self.index = index
         self.prev_active_index = prev_active_index
 
+    def held_layers(self):
+        return (self.layer_obj,)
+
     def undo(self, app):
         app.layers.pop(self.index)
         app.active_layer_index = self.prev_active_index
-        app.pixel_canvas.force_redraw()
-        app.layer_panel.update_ui()
 
     def redo(self, app):
         app.layers.insert(self.index, self.layer_obj)
         app.active_layer_index = self.index
-        app.pixel_canvas.force_redraw()
-        app.layer_panel.update_ui()
 
 
 class DeleteLayerAction(Action):
@@ -76,17 +151,16 @@ class DeleteLayerAction(Action):
         self.prev_active_index = prev_active_index
         self.new_active_index = new_active_index
 
+    def held_layers(self):
+        return (self.layer_obj,)
+
     def undo(self, app):
         app.layers.insert(self.index, self.layer_obj)
         app.active_layer_index = self.prev_active_index
-        app.pixel_canvas.force_redraw()
-        app.layer_panel.update_ui()
 
     def redo(self, app):
         app.layers.pop(self.index)
         app.active_layer_index = self.new_active_index
-        app.pixel_canvas.force_redraw()
-        app.layer_panel.update_ui()
 
 
 class MoveLayerAction(Action):
@@ -100,18 +174,16 @@ class MoveLayerAction(Action):
         layer = app.layers.pop(self.to_index)
         app.layers.insert(self.from_index, layer)
         app.active_layer_index = self.active_index_before
-        app.pixel_canvas.force_redraw()
-        app.layer_panel.update_ui()
 
     def redo(self, app):
         layer = app.layers.pop(self.from_index)
         app.layers.insert(self.to_index, layer)
         app.active_layer_index = self.active_index_after
-        app.pixel_canvas.force_redraw()
-        app.layer_panel.update_ui()
 
 
 class RenameLayerAction(Action):
+    damage = DAMAGE_NONE
+
     def __init__(self, layer_index, old_name, new_name):
         self.layer_index = layer_index
         self.old_name = old_name
@@ -119,11 +191,9 @@ class RenameLayerAction(Action):
 
     def undo(self, app):
         app.layers[self.layer_index].name = self.old_name
-        app.layer_panel.update_ui()
 
     def redo(self, app):
         app.layers[self.layer_index].name = self.new_name
-        app.layer_panel.update_ui()
 
 
 class MergeLayerAction(Action):
@@ -139,18 +209,21 @@ class MergeLayerAction(Action):
         self.merged_lower_layer_obj = merged_lower_layer_obj
         self.upper_layer_index = upper_layer_index
 
+    def held_layers(self):
+        return (
+            self.upper_layer_obj,
+            self.lower_layer_obj,
+            self.merged_lower_layer_obj,
+        )
+
     def undo(self, app):
         app.layers.pop(self.upper_layer_index - 1)
         app.layers.insert(self.upper_layer_index - 1, self.lower_layer_obj)
         app.layers.insert(self.upper_layer_index, self.upper_layer_obj)
         app.active_layer_index = self.upper_layer_index
-        app.pixel_canvas.force_redraw()
-        app.layer_panel.update_ui()
 
     def redo(self, app):
         app.layers.pop(self.upper_layer_index)
         app.layers.pop(self.upper_layer_index - 1)
         app.layers.insert(self.upper_layer_index - 1, self.merged_lower_layer_obj)
         app.active_layer_index = self.upper_layer_index - 1
-        app.pixel_canvas.force_redraw()
-        app.layer_panel.update_ui()
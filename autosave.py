@@ -0,0 +1,348 @@
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+from pathlib import Path
+import re
+import shutil
+import struct
+import tempfile
+import zlib
+
+if os.name == "nt":
+    import msvcrt
+else:
+    import fcntl
+
+import canvas_cython_helpers
+from actions import DAMAGE_PIXELS, _pack_arrays, _unpack_arrays
+from layer_buffer import LayerBuffer
+from project_file import ChunkCache, load_project, save_project, snapshot_layers
+
+AUTOSAVE_DIR = Path.home() / ".pixel_art_app" / "autosave"
+COMPACT_BYTES = 64 * 1024 * 1024
+COMPRESS_LEVEL = 1
+JOURNAL_MAGIC = b"PXJ1"
+LOCK_NAME = "lock"
+SESSION_PREFIX = "session-"
+
+RECORD_LAYER = 1
+RECORD_LAYOUT = 2
+RECORD_PIXELS = 3
+
+_RECORD_HEADER = struct.Struct("<BIII")
+_FILE_PATTERN = re.compile(r"(snapshot|journal)-(\d+)\.(pxart|bin)$")
+
+
+class Autosave:
+    """Crash recovery through a snapshot plus an append-only edit journal.
+
+    :meth:`checkpoint` writes the whole document as a project file and starts
+    an empty journal; :meth:`record` then appends what each history step
+    changed. Pixel steps store the changed indices and their new colors,
+    layer steps store the resulting layer order, names, visibility and
+    opacity, plus the content of any layer the journal has not seen yet.
+    :meth:`record_layout` stores the same for visibility and opacity changes,
+    which are not history steps.
+    All file work happens in order on one worker thread.
+
+    Files are numbered by checkpoint, so a crash in the middle of a
+    checkpoint never pairs a new snapshot with an older journal.
+
+    Every running app writes into its own session directory under
+    ``directory`` and holds a lock on a file in it. :meth:`recover` only
+    looks at sessions whose lock is free, that is, whose app has exited
+    without discarding them. The first checkpoint afterwards deletes the
+    sessions it looked at.
+    """
+
+    def __init__(self, directory=AUTOSAVE_DIR):
+        self.root = Path(directory)
+        self.directory = None
+        self._lock = None
+        self._orphans = []
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="autosave"
+        )
+        self._chunks = ChunkCache()
+        self._generation = 0
+        self._journal = None
+        self._journal_bytes = 0
+        self._registry = {}
+        self._next_id = 0
+        self._layout = None
+        self._failed = None
+        self.dirty = False
+        try:
+            self.root.mkdir(parents=True, exist_ok=True)
+            self.directory = Path(
+                tempfile.mkdtemp(prefix=SESSION_PREFIX, dir=self.root)
+            )
+            self._lock = _open_lock(self.directory)
+        except OSError as e:
+            self._fail(e)
+
+    @property
+    def enabled(self):
+        return self._failed is None
+
+    @property
+    def needs_compaction(self):
+        return self._journal_bytes > COMPACT_BYTES
+
+    def _fail(self, error):
+        if self._failed is None:
+            print(f"Warning: Autosave disabled: {error }")
+        self._failed = error
+
+    def _files(self, directory=None):
+        directory = directory or self.directory
+        files = {}
+        if directory is None or not directory.is_dir():
+            return files
+        for path in directory.iterdir():
+            if match := _FILE_PATTERN.match(path.name):
+                files[(match.group(1), int(match.group(2)))] = path
+        return files
+
+    def _path(self, kind, generation):
+        extension = "pxart" if kind == "snapshot" else "bin"
+        return self.directory / f"{kind }-{generation :08d}.{extension }"
+
+    def recover(self):
+        if not self.enabled:
+            return None
+        sessions = [
+            path
+            for path in self.root.glob(f"{SESSION_PREFIX }*")
+            if path.is_dir() and path != self.directory
+        ]
+        sessions.sort(key=lambda path: path.stat().st_mtime, reverse=True)
+        for session in sessions:
+            try:
+                lock = _open_lock(session, create=False)
+            except OSError:
+                continue
+            self._orphans.append((session, lock))
+            if (recovered := self._recover_session(session)) is not None:
+                return recovered
+        return None
+
+    def _recover_session(self, session):
+        files = self._files(session)
+        generations = [gen for kind, gen in files if kind == "snapshot"]
+        if not generations:
+            return None
+        generation = max(generations)
+        width, height, active_index, layers, source = load_project(
+            files[("snapshot", generation)], ChunkCache()
+        )
+        source.detach()
+
+        by_id = dict(enumerate(layers))
+        replayed = 0
+        journal = files.get(("journal", generation))
+        if journal is not None:
+            for kind, meta, blob in _read_records(journal):
+                replayed += 1
+                if kind == RECORD_LAYER:
+                    by_id[meta["id"]] = {
+                        "buffer": LayerBuffer.deserialize(zlib.decompress(blob))
+                    }
+                elif kind == RECORD_LAYOUT:
+                    layers = []
+                    for layer_id, name, visible, opacity in meta["layers"]:
+                        state = by_id[layer_id]
+                        state.update(name=name, visible=visible, opacity=opacity)
+                        layers.append(state)
+                    active_index = meta["active"]
+                elif kind == RECORD_PIXELS:
+                    indices, colors = _unpack_arrays(zlib.decompress(blob), 2)
+                    canvas_cython_helpers.scatter_pixels_cy(
+                        by_id[meta["id"]]["buffer"], indices, colors
+                    )
+
+        if not replayed and all(state["buffer"].is_empty() for state in layers):
+            return None
+        return width, height, active_index, layers
+
+    def checkpoint(self, width, height, active_index, layers):
+        if not self.enabled:
+            return
+        snapshot = snapshot_layers(layers)
+        self._registry = {
+            id(layer): (layer_id, layer, layer.buffer)
+            for layer_id, layer in enumerate(layers)
+        }
+        self._next_id = len(layers)
+        self._layout = self._current_layout(layers, active_index)
+        self._journal_bytes = 0
+        self.dirty = False
+        self._generation += 1
+        self._submit(
+            self._write_checkpoint,
+            self._generation,
+            width,
+            height,
+            active_index,
+            snapshot,
+        )
+        for session, lock in self._orphans:
+            self._submit(_remove_session, session, lock)
+        self._orphans = []
+
+    def record(self, layers, active_index, action, undone=False):
+        if not self.enabled:
+            return
+        self.dirty = True
+        if action.damage == DAMAGE_PIXELS:
+            indices, colors_before, colors_after = action.payload()
+            layer_id = self._layer_id(layers[action.layer_index])
+            colors = colors_before if undone else colors_after
+            self._submit(self._write_pixels, layer_id, indices, colors)
+        self.record_layout(layers, active_index)
+
+    def record_layout(self, layers, active_index):
+        if not self.enabled:
+            return
+        layout = self._current_layout(layers, active_index)
+        if layout != self._layout:
+            self.dirty = True
+            layout_ids = [self._layer_id(layer) for layer in layers]
+            live = {id(layer) for layer in layers}
+            self._registry = {
+                key: entry for key, entry in self._registry.items() if key in live
+            }
+            self._layout = layout
+            meta = {
+                "layers": [
+                    [layer_id, layer.name, layer.visible, layer.opacity]
+                    for layer_id, layer in zip(layout_ids, layers)
+                ],
+                "active": active_index,
+            }
+            self._submit(self._append, RECORD_LAYOUT, meta, b"")
+
+    def discard(self):
+        self._executor.shutdown(wait=True)
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        for _, lock in self._orphans:
+            lock.close()
+        self._orphans = []
+        if self.directory is not None:
+            _remove_session(self.directory, self._lock)
+
+    @staticmethod
+    def _current_layout(layers, active_index):
+        return (
+            tuple(
+                (id(layer), layer.name, layer.visible, layer.opacity)
+                for layer in layers
+            ),
+            active_index,
+        )
+
+    def _layer_id(self, layer):
+        entry = self._registry.get(id(layer))
+        buffer = layer.buffer
+        if entry is not None and entry[2] is buffer:
+            return entry[0]
+        layer_id = self._next_id
+        self._next_id += 1
+        self._registry[id(layer)] = (layer_id, layer, buffer)
+        self._submit(self._write_layer, layer_id, buffer.copy())
+        return layer_id
+
+    def _submit(self, work, *args):
+        self._executor.submit(self._run, work, *args)
+
+    def _run(self, work, *args):
+        if not self.enabled:
+            return
+        try:
+            work(*args)
+        except Exception as e:
+            self._fail(e)
+
+    def _write_checkpoint(self, generation, width, height, active_index, snapshot):
+        try:
+            save_project(
+                self._path("snapshot", generation),
+                width,
+                height,
+                active_index,
+                snapshot,
+                self._chunks,
+                lambda fraction: None,
+            )
+        finally:
+            for state in snapshot:
+                state["buffer"].release()
+        if self._journal is not None:
+            self._journal.close()
+        self._journal = open(self._path("journal", generation), "wb")
+        self._journal.write(JOURNAL_MAGIC)
+        self._journal.flush()
+        for (_, file_generation), path in self._files().items():
+            if file_generation < generation:
+                path.unlink()
+
+    def _write_layer(self, layer_id, buffer):
+        try:
+            blob = zlib.compress(buffer.serialize(), COMPRESS_LEVEL)
+        finally:
+            buffer.release()
+        self._append(RECORD_LAYER, {"id": layer_id}, blob)
+
+    def _write_pixels(self, layer_id, indices, colors):
+        blob = zlib.compress(_pack_arrays(indices, colors), COMPRESS_LEVEL)
+        self._append(RECORD_PIXELS, {"id": layer_id}, blob)
+
+    def _append(self, kind, meta, blob):
+        meta = json.dumps(meta).encode("utf-8")
+        header = _RECORD_HEADER.pack(
+            kind, len(meta), len(blob), zlib.crc32(blob, zlib.crc32(meta))
+        )
+        self._journal.write(header + meta + blob)
+        self._journal.flush()
+        self._journal_bytes += len(header) + len(meta) + len(blob)
+
+
+def _open_lock(directory, create=True):
+    lock = open(directory / LOCK_NAME, "ab" if create else "r+b")
+    try:
+        if os.name == "nt":
+            msvcrt.locking(lock.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock.close()
+        raise
+    return lock
+
+
+def _remove_session(directory, lock):
+    if lock is not None:
+        lock.close()
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+def _read_records(path):
+    with open(path, "rb") as journal:
+        if journal.read(len(JOURNAL_MAGIC)) != JOURNAL_MAGIC:
+            return
+        while True:
+            header = journal.read(_RECORD_HEADER.size)
+            if len(header) < _RECORD_HEADER.size:
+                return
+            kind, meta_length, blob_length, checksum = _RECORD_HEADER.unpack(header)
+            meta = journal.read(meta_length)
+            blob = journal.read(blob_length)
+            if (
+                len(meta) < meta_length
+                or len(blob) < blob_length
+                or zlib.crc32(blob, zlib.crc32(meta)) != checksum
+            ):
+                return
+            yield kind, json.loads(meta), blob
@@ -0,0 +1,114 @@
+import os
+import queue
+import threading
+
+from PIL import Image
+
+import canvas_cython_helpers
+
+
+def write_atomically(filename, write):
+    temp_name = f"{filename }.tmp"
+    write(temp_name)
+    os.replace(temp_name, filename)
+
+
+def write_png(filename, width, height, layers_info, bg_color, progress):
+    image_buffer = canvas_cython_helpers.export_image_cy(
+        width, height, layers_info, bg_color
+    )
+    progress(0.5)
+    img = Image.frombytes("RGBA", (width, height), image_buffer)
+    write_atomically(filename, lambda path: img.save(path, "PNG"))
+
+
+class BackgroundSaver:
+    """Runs save jobs on a worker thread, one at a time.
+
+    A job is a callable taking a ``progress(fraction)`` function, plus the
+    snapshot buffers it reads from, usually copy-on-write copies of the live
+    layers, so drawing can continue while the file is written. Progress and
+    completion are delivered on the Tk thread by polling a queue with
+    ``root.after``; the snapshot buffers are released there as well.
+
+    Jobs requested while one is running are queued in order. A queued job
+    is only replaced by a newer one for the same file. :meth:`flush` waits
+    for every job, for instance before the app closes.
+    """
+
+    POLL_INTERVAL_MS = 50
+
+    def __init__(self, root):
+        self.root = root
+        self._messages = queue.Queue()
+        self._job = None
+        self._thread = None
+        self._pending = []
+        self._after_id = None
+
+    @property
+    def busy(self):
+        return self._job is not None
+
+    def save(self, filename, work, snapshot, on_progress, on_done):
+        job = (filename, work, snapshot, on_progress, on_done)
+        if not self.busy:
+            self._start(job)
+            return
+        for index, queued in enumerate(self._pending):
+            if queued[0] == filename:
+                self._release(queued[2])
+                self._pending[index] = job
+                return
+        self._pending.append(job)
+
+    def flush(self):
+        while self._job is not None:
+            self._thread.join()
+            self._drain()
+
+    def _start(self, job):
+        self._job = job
+        _, work, _, on_progress, _ = job
+        on_progress(0.0)
+        self._thread = threading.Thread(
+            target=self._run, args=(work,), name="background-save"
+        )
+        self._thread.start()
+        if self._after_id is None:
+            self._after_id = self.root.after(self.POLL_INTERVAL_MS, self._poll)
+
+    def _run(self, work):
+        try:
+            work(lambda fraction: self._messages.put(("progress", fraction)))
+            self._messages.put(("done", None))
+        except Exception as e:
+            self._messages.put(("done", e))
+
+    def _poll(self):
+        self._after_id = None
+        if self._job is not None and not self._drain():
+            self._after_id = self.root.after(self.POLL_INTERVAL_MS, self._poll)
+
+    def _drain(self):
+        _, _, snapshot, on_progress, on_done = self._job
+        while True:
+            try:
+                kind, value = self._messages.get_nowait()
+            except queue.Empty:
+                return False
+            if kind == "progress":
+                on_progress(value)
+                continue
+
+            self._release(snapshot)
+            self._job = None
+            on_done(value)
+            if self._pending:
+                self._start(self._pending.pop(0))
+            return True
+
+    @staticmethod
+    def _release(snapshot):
+        for buffer in snapshot:
+            buffer.release()
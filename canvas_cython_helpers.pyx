@@ -1,522 +1,1050 @@
-# canvas_cython_helpers.pyx
-# cython: language_level=3
-# cython: boundscheck=False
-# cython: wraparound=False
-# cython: cdivision=True
-# cython: cpp=True
-
-from collections import defaultdict
-
-from libc.stdio cimport sprintf
-from libc.stdlib cimport calloc, free
-from libcpp.vector cimport vector
-
-cdef inline unsigned char blend_channel(unsigned char fg, unsigned char bg, double alpha):
-    return <unsigned char>(fg * alpha + bg * (1.0 - alpha))
-
-cpdef tuple hex_to_rgb_cy(str hex_color):
-    hex_color = hex_color.lstrip('#')
-    cdef int r = int(hex_color[0:2], 16)
-    cdef int g = int(hex_color[2:4], 16)
-    cdef int b = int(hex_color[4:6], 16)
-    return (r, g, b)
-
-cpdef object render_image(
-    int width, int height, list layers_info,
-    bint use_bg_color, tuple bg_color_rgb, bint render_alpha,
-    tuple dirty_bbox = None
-):
-    cdef int min_x = 0, min_y = 0, max_x = width, max_y = height
-    cdef int render_width = width, render_height = height
-
-    if dirty_bbox is not None:
-        min_x, min_y, max_x, max_y = dirty_bbox
-        render_width = max_x - min_x
-        render_height = max_y - min_y
-
-    cdef bytearray buffer = bytearray(render_width * render_height * 4)
-
-    cdef int x, y, i, layer_idx, px, py, r, g, b, a, base_idx, layer_opacity
-    cdef unsigned char e_alpha
-    cdef double alpha_norm
-    cdef tuple pixel_data, color_rgb
-    cdef dict layer_dict
-
-    cdef unsigned char c1_r=224, c1_g=224, c1_b=224
-    cdef unsigned char c2_r=240, c2_g=240, c2_b=240
-
-    for y in range(render_height):
-        for x in range(render_width):
-            px = x + min_x
-            py = y + min_y
-            base_idx = (y * render_width + x) * 4
-            if use_bg_color:
-                buffer[base_idx] = bg_color_rgb[0]
-                buffer[base_idx + 1] = bg_color_rgb[1]
-                buffer[base_idx + 2] = bg_color_rgb[2]
-                buffer[base_idx + 3] = 255
-            else:
-                if (px + py) % 2 == 0:
-                    buffer[base_idx] = c1_r; buffer[base_idx + 1] = c1_g; buffer[base_idx + 2] = c1_b;
-                else:
-                    buffer[base_idx] = c2_r; buffer[base_idx + 1] = c2_g; buffer[base_idx + 2] = c2_b;
-                buffer[base_idx + 3] = 255
-
-    for layer_dict, layer_opacity in layers_info:
-        for (px, py), pixel_data in layer_dict.items():
-            if min_x <= px < max_x and min_y <= py < max_y:
-                x = px - min_x
-                y = py - min_y
-                base_idx = (y * render_width + x) * 4
-
-                a = pixel_data[1]
-                
-                a = (a * layer_opacity) // 255
-
-                if not render_alpha:
-                    e_alpha = 255
-                else:
-                    e_alpha = a
-
-                if e_alpha > 0:
-                    color_rgb = hex_to_rgb_cy(pixel_data[0])
-                    r, g, b = color_rgb
-
-                    alpha_norm = e_alpha / 255.0
-
-                    buffer[base_idx] = blend_channel(r, buffer[base_idx], alpha_norm)
-                    buffer[base_idx + 1] = blend_channel(g, buffer[base_idx + 1], alpha_norm)
-                    buffer[base_idx + 2] = blend_channel(b, buffer[base_idx + 2], alpha_norm)
-
-    return buffer
-
-
-cpdef tuple composite_pixel_stack_cy(
-    int px, int py, list all_layers_info, int stop_at_layer_index,
-    bint use_bg_color, tuple bg_color_rgb, bint render_alpha
-):
-    cdef tuple base_rgb
-    if use_bg_color:
-        base_rgb = bg_color_rgb
-    else:
-        base_rgb = (224, 224, 224) if (px + py) % 2 == 0 else (240, 240, 240)
-
-    cdef double r, g, b
-    r, g, b = <double>base_rgb[0], <double>base_rgb[1], <double>base_rgb[2]
-
-    cdef int i, a, layer_opacity
-    cdef unsigned char e_alpha
-    cdef double alpha_norm
-    cdef tuple pixel_data, color_rgb
-    cdef dict layer_dict
-
-    if stop_at_layer_index == -1:
-        stop_at_layer_index = len(all_layers_info)
-
-    for i in range(stop_at_layer_index):
-        layer_dict, layer_opacity = all_layers_info[i]
-        pixel_data = layer_dict.get((px, py))
-        if pixel_data:
-            a = pixel_data[1]
-            a = (a * layer_opacity) // 255
-            
-            if not render_alpha: e_alpha = 255
-            else: e_alpha = a
-
-            if e_alpha > 0:
-                color_rgb = hex_to_rgb_cy(pixel_data[0])
-                alpha_norm = e_alpha / 255.0
-                r = color_rgb[0] * alpha_norm + r * (1.0 - alpha_norm)
-                g = color_rgb[1] * alpha_norm + g * (1.0 - alpha_norm)
-                b = color_rgb[2] * alpha_norm + b * (1.0 - alpha_norm)
-
-    return (<unsigned char>r, <unsigned char>g, <unsigned char>b)
-
-
-cpdef list bresenham_line_cy(int x0, int y0, int x1, int y1):
-    cdef list points = []
-    cdef int dx = abs(x1 - x0)
-    cdef int dy = -abs(y1 - y0)
-    cdef int sx = 1 if x0 < x1 else -1
-    cdef int sy = 1 if y0 < y1 else -1
-    cdef int err = dx + dy
-    cdef int e2
-
-    while True:
-        points.append((x0, y0))
-        if x0 == x1 and y0 == y1:
-            break
-        e2 = 2 * err
-        if e2 >= dy:
-            err += dy
-            x0 += sx
-        if e2 <= dx:
-            err += dx
-            y0 += sy
-    return points
-
-
-cpdef tuple blend_colors_cy(str hex1, int alpha1, str hex2, int alpha2):
-    cdef tuple rgb1 = hex_to_rgb_cy(hex1)
-    cdef tuple rgb2 = hex_to_rgb_cy(hex2)
-    cdef double a1 = alpha1 / 255.0
-    cdef double a2 = alpha2 / 255.0
-
-    cdef double a_out = a1 + a2 * (1.0 - a1)
-    if a_out == 0:
-        return ("#000000", 0)
-
-    cdef int r_out = <int>round((rgb1[0] * a1 + rgb2[0] * a2 * (1.0 - a1)) / a_out)
-    cdef int g_out = <int>round((rgb1[1] * a1 + rgb2[1] * a2 * (1.0 - a1)) / a_out)
-    cdef int b_out = <int>round((rgb1[2] * a1 + rgb2[2] * a2 * (1.0 - a1)) / a_out)
-    cdef int alpha_out = <int>round(a_out * 255)
-
-    hex_out = "#{:02x}{:02x}{:02x}".format(r_out, g_out, b_out)
-    
-    return (hex_out.upper(), alpha_out)
-
-
-cpdef set get_stroke_pixels_cy(
-    int x0, int y0, int x1, int y1,
-    int brush_size, int canvas_width, int canvas_height,
-    set drawn_pixels_set
-):
-    cdef list line_pixels = bresenham_line_cy(x0, y0, x1, y1)
-    cdef set pixels_to_add = set()
-
-    cdef int offset = (brush_size - 1) // 2
-    cdef int p_x, p_y, brush_px, brush_py, x_off, y_off
-
-    for p_x, p_y in line_pixels:
-        start_x = p_x - offset
-        start_y = p_y - offset
-
-        for y_off in range(brush_size):
-            brush_py = start_y + y_off
-            if 0 <= brush_py < canvas_height:
-                for x_off in range(brush_size):
-                    brush_px = start_x + x_off
-                    if 0 <= brush_px < canvas_width:
-                        if (brush_px, brush_py) not in drawn_pixels_set:
-                            pixels_to_add.add((brush_px, brush_py))
-                            drawn_pixels_set.add((brush_px, brush_py))
-
-    return pixels_to_add
-
-
-cpdef dict render_preview_chunks_cy(
-    set new_preview_pixels,
-    dict tool_options,
-    list all_layers_info,
-    bint use_bg_color, tuple bg_color_rgb, bint render_alpha,
-    int chunk_size,
-    int canvas_width, int canvas_height
-):
-    cdef bint is_eraser = tool_options.get("tool") == "eraser"
-    cdef int active_layer_index = tool_options["active_layer_index"]
-    cdef str source_hex = tool_options.get("color")
-    cdef int source_alpha = tool_options.get("alpha", 0)
-    cdef dict active_layer_data = tool_options["active_layer_data"]
-    cdef int active_layer_opacity = 255
-    if 0 <= active_layer_index < len(all_layers_info):
-        active_layer_opacity = all_layers_info[active_layer_index][1]
-
-    cdef bint color_blending = tool_options.get("color_blending", False)
-
-    cdef dict dirty_chunks = {}
-    cdef int px, py, cx, cy, i, a, alpha_to_use, base_idx, img_x, img_y, layer_opacity
-    cdef tuple existing_pixel, base_rgb, applied_rgb, rgb_above, chunk_coord, pixel_above
-    cdef str applied_hex
-    cdef int applied_alpha
-    cdef double alpha_norm, composite_r, composite_g, composite_b, final_r, final_g, final_b
-    cdef list pixel_list_for_chunk
-    cdef dict layer_dict
-    
-    cdef dict rendered_chunk_buffers = {}
-    cdef bytearray buffer
-
-    for px, py in new_preview_pixels:
-        if px < 0 or px >= canvas_width or py < 0 or py >= canvas_height:
-            continue
-
-        chunk_coord = (px // chunk_size, py // chunk_size)
-        if chunk_coord not in dirty_chunks:
-            dirty_chunks[chunk_coord] = []
-        dirty_chunks[chunk_coord].append((px, py))
-    
-    for (cx, cy), pixels_in_chunk in dirty_chunks.items():
-        buffer = bytearray(chunk_size * chunk_size * 4)
-        rendered_chunk_buffers[(cx, cy)] = buffer
-
-        for px, py in pixels_in_chunk:
-            base_rgb = composite_pixel_stack_cy(
-                px, py, all_layers_info, active_layer_index,
-                use_bg_color, bg_color_rgb, render_alpha
-            )
-
-            applied_hex = source_hex
-            applied_alpha = source_alpha
-            if is_eraser: applied_alpha = 0
-            
-            existing_pixel = active_layer_data.get((px, py))
-            if color_blending and 0 < source_alpha < 255 and existing_pixel and existing_pixel[1] > 0:
-                applied_hex, applied_alpha = blend_colors_cy(source_hex, source_alpha, existing_pixel[0], existing_pixel[1])
-
-            applied_alpha = (applied_alpha * active_layer_opacity) // 255
-
-            composite_r, composite_g, composite_b = base_rgb
-            if applied_alpha > 0:
-                alpha_to_use = applied_alpha if render_alpha else 255
-                alpha_norm = alpha_to_use / 255.0
-                applied_rgb = hex_to_rgb_cy(applied_hex)
-                composite_r = applied_rgb[0] * alpha_norm + base_rgb[0] * (1.0 - alpha_norm)
-                composite_g = applied_rgb[1] * alpha_norm + base_rgb[1] * (1.0 - alpha_norm)
-                composite_b = applied_rgb[2] * alpha_norm + base_rgb[2] * (1.0 - alpha_norm)
-
-            final_r, final_g, final_b = composite_r, composite_g, composite_b
-            for i in range(active_layer_index + 1, len(all_layers_info)):
-                layer_dict, layer_opacity = all_layers_info[i]
-                pixel_above = layer_dict.get((px, py))
-                if pixel_above and pixel_above[1] > 0:
-                    a = pixel_above[1]
-                    a = (a * layer_opacity) // 255
-                    
-                    alpha_to_use = a if render_alpha else 255
-                    if alpha_to_use > 0:
-                        alpha_norm = alpha_to_use / 255.0
-                        rgb_above = hex_to_rgb_cy(pixel_above[0])
-                        final_r = rgb_above[0] * alpha_norm + final_r * (1.0 - alpha_norm)
-                        final_g = rgb_above[1] * alpha_norm + final_g * (1.0 - alpha_norm)
-                        final_b = rgb_above[2] * alpha_norm + final_b * (1.0 - alpha_norm)
-
-            img_x, img_y = px % chunk_size, py % chunk_size
-            base_idx = (img_y * chunk_size + img_x) * 4
-            buffer[base_idx] = <unsigned char>final_r
-            buffer[base_idx + 1] = <unsigned char>final_g
-            buffer[base_idx + 2] = <unsigned char>final_b
-            buffer[base_idx + 3] = 255
-
-    return rendered_chunk_buffers
-
-cdef cppclass PixelCoord:
-    int x, y
-
-cpdef tuple flood_fill_apply_cy(
-    int start_x, int start_y,
-    int canvas_width, int canvas_height,
-    dict active_layer_data,
-    tuple target_data,
-    str new_hex, int new_alpha
-):
-    cdef dict pixels_before = {}
-    cdef dict pixels_after = {}
-    cdef size_t map_size = canvas_width * canvas_height
-    cdef char* processed = <char*>calloc(map_size, sizeof(char))
-    cdef vector[PixelCoord] stack
-    cdef vector[PixelCoord] pixels_to_fill
-    cdef int x, y, nx, ny, px, py
-    cdef long i
-    cdef tuple current_pixel_data, original_pixel, final_pixel_data
-    cdef PixelCoord current_coord, temp_coord
-    cdef str applied_hex
-    cdef int applied_alpha
-
-    if not (0 <= start_x < canvas_width and 0 <= start_y < canvas_height):
-        if processed: free(processed)
-        return ({}, {})
-
-    if processed is NULL:
-        raise MemoryError("Failed to allocate processed map for flood fill")
-
-    temp_coord.x = start_x
-    temp_coord.y = start_y
-    stack.push_back(temp_coord)
-    processed[start_y * canvas_width + start_x] = 1
-
-    while not stack.empty():
-        current_coord = stack.back()
-        stack.pop_back()
-        x = current_coord.x
-        y = current_coord.y
-        
-        current_pixel_data = active_layer_data.get((x, y), ("transparent", 0))
-
-        if current_pixel_data == target_data:
-            temp_coord.x = x
-            temp_coord.y = y
-            pixels_to_fill.push_back(temp_coord)
-            pixels_before[(x,y)] = current_pixel_data
-
-            for dx, dy in [(0, 1), (0, -1), (1, 0), (-1, 0)]:
-                nx = x + dx
-                ny = y + dy
-                if 0 <= nx < canvas_width and 0 <= ny < canvas_height and not processed[ny * canvas_width + nx]:
-                    processed[ny * canvas_width + nx] = 1
-                    temp_coord.x = nx
-                    temp_coord.y = ny
-                    stack.push_back(temp_coord)
-    
-    free(processed)
-    
-    if not pixels_to_fill.empty():
-        for i in range(pixels_to_fill.size()):
-            px = pixels_to_fill[i].x
-            py = pixels_to_fill[i].y
-            
-            applied_hex = new_hex
-            applied_alpha = new_alpha
-
-
-            if applied_alpha > 0:
-                final_pixel_data = (applied_hex, applied_alpha)
-                active_layer_data[(px, py)] = final_pixel_data
-                pixels_after[(px, py)] = final_pixel_data
-            elif (px, py) in active_layer_data:
-                del active_layer_data[(px, py)]
-                pixels_after[(px, py)] = None
-    
-    return (pixels_before, pixels_after)
-
-cpdef set get_brush_pixels_cy(int center_x, int center_y, int brush_size, int canvas_width, int canvas_height):
-    cdef set pixels = set()
-    cdef int offset = (brush_size - 1) // 2
-    cdef int start_x = center_x - offset
-    cdef int start_y = center_y - offset
-    cdef int x_off, y_off, px, py
-    for y_off in range(brush_size):
-        py = start_y + y_off
-        if 0 <= py < canvas_height:
-            for x_off in range(brush_size):
-                px = start_x + x_off
-                if 0 <= px < canvas_width:
-                    pixels.add((px, py))
-    return pixels
-
-cpdef set get_rectangle_pixels_cy(int x0, int y0, int x1, int y1, bint fill, int canvas_width, int canvas_height):
-    cdef set pixels = set()
-    cdef int xs = min(x0, x1), ys = min(y0, y1)
-    cdef int xe = max(x0, x1), ye = max(y0, y1)
-    cdef int x, y
-    if fill:
-        for y in range(ys, ye + 1):
-            if 0 <= y < canvas_height:
-                for x in range(xs, xe + 1):
-                    if 0 <= x < canvas_width:
-                        pixels.add((x, y))
-    else:
-        for x in range(xs, xe + 1):
-            if 0 <= x < canvas_width:
-                if 0 <= ys < canvas_height: pixels.add((x, ys))
-                if 0 <= ye < canvas_height: pixels.add((x, ye))
-        for y in range(ys + 1, ye):
-            if 0 <= y < canvas_height:
-                if 0 <= xs < canvas_width: pixels.add((xs, y))
-                if 0 <= xe < canvas_width: pixels.add((xe, y))
-    return pixels
-
-cpdef set get_ellipse_pixels_cy(int x0, int y0, int rx, int ry, bint fill, int canvas_width, int canvas_height):
-    cdef set pixels = set()
-    cdef int px, py, x_offset, y_offset
-    cdef set full_ellipse, inner_ellipse
-    cdef int rx_inner, ry_inner
-
-    if rx == 0 and ry == 0:
-        if 0 <= x0 < canvas_width and 0 <= y0 < canvas_height: pixels.add((x0,y0))
-        return pixels
-
-    if fill:
-        for y_offset in range(-ry, ry + 1):
-            for x_offset in range(-rx, rx + 1):
-                if ((x_offset / <float>rx if rx > 0 else 0)**2 + (y_offset / <float>ry if ry > 0 else 0)**2) <= 1:
-                    px = x0 + x_offset; py = y0 + y_offset
-                    if 0 <= px < canvas_width and 0 <= py < canvas_height: pixels.add((px, py))
-    else:
-        full_ellipse = set()
-        inner_ellipse = set()
-        for y_offset in range(-ry, ry + 1):
-            for x_offset in range(-rx, rx + 1):
-                if ((x_offset / <float>rx if rx > 0 else 0)**2 + (y_offset / <float>ry if ry > 0 else 0)**2) <= 1:
-                    px = x0 + x_offset; py = y0 + y_offset
-                    if 0 <= px < canvas_width and 0 <= py < canvas_height: full_ellipse.add((px, py))
-        
-        rx_inner = max(0, rx - 1)
-        ry_inner = max(0, ry - 1)
-        if rx_inner > 0 or ry_inner > 0:
-            for y_offset in range(-ry_inner, ry_inner + 1):
-                for x_offset in range(-rx_inner, rx_inner + 1):
-                    if ((x_offset / <float>rx_inner if rx_inner > 0 else 0)**2 + (y_offset / <float>ry_inner if ry_inner > 0 else 0)**2) <= 1:
-                        px = x0 + x_offset; py = y0 + y_offset
-                        if 0 <= px < canvas_width and 0 <= py < canvas_height: inner_ellipse.add((px, py))
-        pixels.update(full_ellipse - inner_ellipse)
-    return pixels
-
-cpdef tuple apply_pixels_cy(
-    set pixels_to_process,
-    dict active_layer_data,
-    str color,
-    int alpha,
-    bint color_blending,
-    int canvas_width,
-    int canvas_height
-):
-    cdef dict pixels_before = {}
-    cdef dict pixels_after = {}
-    cdef tuple original_pixel, new_pixel_data
-    cdef str applied_hex
-    cdef int applied_alpha
-    cdef int px, py
-    
-    for px, py in pixels_to_process:
-        if px < 0 or px >= canvas_width or py < 0 or py >= canvas_height:
-            continue
-
-        original_pixel = active_layer_data.get((px, py))
-        pixels_before[(px, py)] = original_pixel
-        
-        applied_hex = color
-        applied_alpha = alpha
-
-        if color_blending and 0 < alpha < 255 and original_pixel and original_pixel[1] > 0:
-            applied_hex, applied_alpha = blend_colors_cy(color, alpha, original_pixel[0], original_pixel[1])
-        
-        new_pixel_data = (applied_hex, applied_alpha) if applied_alpha > 0 else None
-        
-        if original_pixel != new_pixel_data:
-            if new_pixel_data:
-                active_layer_data[(px, py)] = new_pixel_data
-            elif (px, py) in active_layer_data:
-                del active_layer_data[(px, py)]
-        pixels_after[(px, py)] = active_layer_data.get((px,py))
-
-    return (pixels_before, pixels_after)
-
-cpdef tuple pick_color_at_pixel_cy(int px, int py, list visible_layers_info):
-    cdef tuple pixel_data
-    cdef dict layer_dict
-    cdef int i, layer_opacity
-    for i in range(len(visible_layers_info) - 1, -1, -1):
-        layer_dict, layer_opacity = visible_layers_info[i]
-        pixel_data = layer_dict.get((px, py))
-        if pixel_data and pixel_data[1] > 0 and layer_opacity > 0:
-            return pixel_data
-    return None
-
-cpdef dict process_image_data_cy(bytes rgba_data, int width, int height):
-    cdef dict pixel_data = {}
-    cdef int x, y, r, g, b, a, base_idx
-    cdef unsigned char* data = rgba_data
-    cdef char hex_buffer[8]
-
-    for y in range(height):
-        for x in range(width):
-            base_idx = (y * width + x) * 4
-            r = data[base_idx]
-            g = data[base_idx + 1]
-            b = data[base_idx + 2]
-            a = data[base_idx + 3]
-            
-            if a > 0:
-                sprintf(hex_buffer, "#%02X%02X%02X", r, g, b)
-                pixel_data[(x, y)] = (hex_buffer.decode('ascii'), a)
-    
-    return pixel_data
+# canvas_cython_helpers.pyx
+# cython: language_level=3
+# cython: boundscheck=False
+# cython: wraparound=False
+# cython: cdivision=True
+# cython: cpp=True
+
+from libc.math cimport lround
+from libc.stdlib cimport calloc, free
+from libcpp.vector cimport vector
+from cython.parallel cimport prange
+
+import numpy as np
+
+# Layer buffers are split into square tiles; must match layer_buffer.TILE_SIZE.
+cdef enum:
+    TILE_SHIFT = 5
+    TILE_DIM = 1 << TILE_SHIFT
+    TILE_MASK = TILE_DIM - 1
+
+TILE_SIZE = TILE_DIM
+
+# Dirty regions smaller than this are composited on the calling thread.
+cdef enum:
+    PARALLEL_MIN_PIXELS = 64 * 64
+
+cdef struct LayerView:
+    size_t* tiles
+    unsigned char* owned
+    int tiles_x
+    int tiles_y
+    int width
+    int height
+    int opacity
+
+cdef unsigned char _EMPTY_PIXEL[4]
+
+# Composites are accumulated in double precision and only rounded when the
+# final 8-bit color is written, so grouping the layers differently (as
+# CompositeCache does around the focus layer) gives the same pixels.
+ctypedef fused composite_t:
+    unsigned char
+    float
+
+cdef inline void _background(
+    double* rgb, int px, int py, bint use_bg_color, unsigned int bg_color
+) noexcept nogil:
+    if use_bg_color:
+        rgb[0] = (bg_color >> 24) & 0xFF
+        rgb[1] = (bg_color >> 16) & 0xFF
+        rgb[2] = (bg_color >> 8) & 0xFF
+    elif (px + py) % 2 == 0:
+        rgb[0] = 224; rgb[1] = 224; rgb[2] = 224
+    else:
+        rgb[0] = 240; rgb[1] = 240; rgb[2] = 240
+
+cdef inline void _blend_into(
+    double* rgb, unsigned char* src, int opacity, bint render_alpha
+) noexcept nogil:
+    if src[3] == 0:
+        return
+    cdef int a = 255 if not render_alpha else (src[3] * opacity) // 255
+    if a == 0:
+        return
+    cdef double alpha = a / 255.0
+    rgb[0] = src[0] * alpha + rgb[0] * (1.0 - alpha)
+    rgb[1] = src[1] * alpha + rgb[1] * (1.0 - alpha)
+    rgb[2] = src[2] * alpha + rgb[2] * (1.0 - alpha)
+
+cdef inline unsigned char _round_channel(double value) noexcept nogil:
+    return <unsigned char>(value + 0.5)
+
+cdef inline unsigned char* _tile_at(LayerView* view, int tx, int ty) noexcept nogil:
+    return <unsigned char*>view.tiles[ty * view.tiles_x + tx]
+
+cdef inline unsigned char* _pixel_at(LayerView* view, int x, int y) noexcept nogil:
+    cdef unsigned char* tile = _tile_at(view, x >> TILE_SHIFT, y >> TILE_SHIFT)
+    if tile == NULL:
+        return _EMPTY_PIXEL
+    return tile + (((y & TILE_MASK) << TILE_SHIFT) + (x & TILE_MASK)) * 4
+
+cdef inline unsigned char* _writable_pixel_at(
+    object buffer, LayerView* view, int x, int y
+) except NULL:
+    cdef int tx = x >> TILE_SHIFT, ty = y >> TILE_SHIFT
+    if not view.owned[ty * view.tiles_x + tx]:
+        buffer.writable_tile(tx, ty)
+    return _tile_at(view, tx, ty) + (((y & TILE_MASK) << TILE_SHIFT) + (x & TILE_MASK)) * 4
+
+cdef LayerView _make_layer_view(
+    object buffer, int opacity, tuple region=None, int step=1
+) except *:
+    if buffer.has_lazy_tiles:
+        buffer.load_tiles(region, step)
+    cdef size_t[:, ::1] tiles = buffer.tile_table
+    cdef unsigned char[:, ::1] owned = buffer.tile_owned
+    cdef LayerView view
+    view.tiles = &tiles[0, 0]
+    view.owned = &owned[0, 0]
+    view.tiles_x = tiles.shape[1]
+    view.tiles_y = tiles.shape[0]
+    view.width = buffer.width
+    view.height = buffer.height
+    view.opacity = opacity
+    return view
+
+cdef vector[LayerView] _make_layer_views(
+    list layers_info, tuple region=None, int step=1
+) except *:
+    cdef vector[LayerView] views
+    for buffer, opacity in layers_info:
+        views.push_back(_make_layer_view(buffer, opacity, region, step))
+    return views
+
+cdef tuple _pixels_bbox(set pixels):
+    if not pixels:
+        return (0, 0, 0, 0)
+    cdef int px, py
+    cdef int min_x = 2147483647, min_y = 2147483647, max_x = -1, max_y = -1
+    for px, py in pixels:
+        min_x = min(min_x, px); min_y = min(min_y, py)
+        max_x = max(max_x, px); max_y = max(max_y, py)
+    return (min_x, min_y, max_x + 1, max_y + 1)
+
+cdef inline void _blend_over(
+    int r1, int g1, int b1, int alpha1,
+    int r2, int g2, int b2, int alpha2,
+    unsigned char* out
+) noexcept nogil:
+    cdef double a1 = alpha1 / 255.0
+    cdef double a2 = alpha2 / 255.0
+    cdef double a_out = a1 + a2 * (1.0 - a1)
+    if a_out == 0:
+        out[0] = 0; out[1] = 0; out[2] = 0; out[3] = 0
+        return
+    out[0] = <unsigned char>lround((r1 * a1 + r2 * a2 * (1.0 - a1)) / a_out)
+    out[1] = <unsigned char>lround((g1 * a1 + g2 * a2 * (1.0 - a1)) / a_out)
+    out[2] = <unsigned char>lround((b1 * a1 + b2 * a2 * (1.0 - a1)) / a_out)
+    out[3] = <unsigned char>lround(a_out * 255)
+
+# Colors are packed as 0xRRGGBBAA; a packed value of 0 is an empty pixel.
+cdef inline unsigned int _pack(unsigned char* pixel) noexcept nogil:
+    return ((<unsigned int>pixel[0] << 24) | (<unsigned int>pixel[1] << 16)
+            | (<unsigned int>pixel[2] << 8) | pixel[3])
+
+cdef inline void _unpack(unsigned int color, unsigned char* out) noexcept nogil:
+    out[0] = (color >> 24) & 0xFF
+    out[1] = (color >> 16) & 0xFF
+    out[2] = (color >> 8) & 0xFF
+    out[3] = color & 0xFF
+    if out[3] == 0:
+        out[0] = 0; out[1] = 0; out[2] = 0
+
+# Writes 8-bit RGBA, or the unrounded RGB when ``out`` is float. Works one
+# tile at a time so the double accumulator fits on the stack.
+cdef void _render_band(
+    composite_t* out, Py_ssize_t out_stride,
+    LayerView* views, int count,
+    bint use_bg_color, unsigned int bg_color, bint render_alpha,
+    int min_x, int min_y, int max_x, int band_y0, int band_y1
+) noexcept nogil:
+    cdef double acc[TILE_DIM * TILE_DIM * 3]
+    cdef int px, py, tx, x0, x1, layer_idx, k
+    cdef int ty = band_y0 >> TILE_SHIFT
+    cdef unsigned char* tile
+    cdef double* rgb
+    cdef composite_t* dst
+
+    for tx in range(min_x >> TILE_SHIFT, ((max_x - 1) >> TILE_SHIFT) + 1):
+        x0 = max(min_x, tx << TILE_SHIFT)
+        x1 = min(max_x, (tx + 1) << TILE_SHIFT)
+        for py in range(band_y0, band_y1):
+            for px in range(x0, x1):
+                k = ((py & TILE_MASK) << TILE_SHIFT) + (px & TILE_MASK)
+                _background(acc + k * 3, px, py, use_bg_color, bg_color)
+
+        for layer_idx in range(count):
+            tile = _tile_at(&views[layer_idx], tx, ty)
+            if tile == NULL:
+                continue
+            for py in range(band_y0, band_y1):
+                for px in range(x0, x1):
+                    k = ((py & TILE_MASK) << TILE_SHIFT) + (px & TILE_MASK)
+                    _blend_into(
+                        acc + k * 3, tile + k * 4,
+                        views[layer_idx].opacity, render_alpha
+                    )
+
+        for py in range(band_y0, band_y1):
+            for px in range(x0, x1):
+                rgb = acc + (((py & TILE_MASK) << TILE_SHIFT) + (px & TILE_MASK)) * 3
+                if composite_t is float:
+                    dst = out + (py - min_y) * out_stride + (px - min_x) * 3
+                    dst[0] = rgb[0]; dst[1] = rgb[1]; dst[2] = rgb[2]
+                else:
+                    dst = out + (py - min_y) * out_stride + (px - min_x) * 4
+                    dst[0] = _round_channel(rgb[0])
+                    dst[1] = _round_channel(rgb[1])
+                    dst[2] = _round_channel(rgb[2])
+                    dst[3] = 255
+
+
+# Each band is one row of tiles, so threads never write the same output rows.
+# Without OpenMP at build time prange runs as a plain serial loop.
+cdef void _render_layers(
+    composite_t* out, Py_ssize_t out_stride,
+    LayerView* views, int count,
+    bint use_bg_color, unsigned int bg_color, bint render_alpha,
+    int min_x, int min_y, int max_x, int max_y
+) noexcept nogil:
+    cdef int ty
+    cdef int first_band = min_y >> TILE_SHIFT
+    cdef int last_band = ((max_y - 1) >> TILE_SHIFT) + 1
+
+    if max_x <= min_x or max_y <= min_y:
+        return
+
+    if <long>(max_x - min_x) * (max_y - min_y) < PARALLEL_MIN_PIXELS:
+        for ty in range(first_band, last_band):
+            _render_band(
+                out, out_stride, views, count, use_bg_color, bg_color, render_alpha,
+                min_x, min_y, max_x,
+                max(min_y, ty << TILE_SHIFT), min(max_y, (ty + 1) << TILE_SHIFT)
+            )
+    else:
+        for ty in prange(first_band, last_band, schedule="dynamic"):
+            _render_band(
+                out, out_stride, views, count, use_bg_color, bg_color, render_alpha,
+                min_x, min_y, max_x,
+                max(min_y, ty << TILE_SHIFT), min(max_y, (ty + 1) << TILE_SHIFT)
+            )
+
+
+# Matches Image.alpha_composite of each layer, at layer opacity, over the
+# running result, so exports are identical to compositing layer by layer.
+cdef void _export_band(
+    unsigned char* out, int width,
+    LayerView* views, int count,
+    unsigned int bg_color, int y0, int y1
+) noexcept nogil:
+    cdef int px, py, i
+    cdef unsigned char* src
+    cdef unsigned char* dst
+    cdef unsigned int src_a, blend, out_a255, coef1, coef2, tmp
+    cdef unsigned char dst_r, dst_g, dst_b, dst_a
+
+    for py in range(y0, y1):
+        for px in range(width):
+            dst_r = bg_color >> 24
+            dst_g = bg_color >> 16
+            dst_b = bg_color >> 8
+            dst_a = bg_color
+            for i in range(count):
+                src = _pixel_at(&views[i], px, py)
+                if src[3] == 0:
+                    continue
+                src_a = <int>(src[3] * (views[i].opacity / 255.0))
+                if src_a == 0:
+                    continue
+                blend = dst_a * (255 - src_a)
+                out_a255 = src_a * 255 + blend
+                coef1 = src_a * 255 * 255 * 128 // out_a255
+                coef2 = 255 * 128 - coef1
+
+                tmp = src[0] * coef1 + dst_r * coef2 + (0x80 << 7)
+                dst_r = ((((tmp >> 8) + tmp) >> 8) >> 7)
+                tmp = src[1] * coef1 + dst_g * coef2 + (0x80 << 7)
+                dst_g = ((((tmp >> 8) + tmp) >> 8) >> 7)
+                tmp = src[2] * coef1 + dst_b * coef2 + (0x80 << 7)
+                dst_b = ((((tmp >> 8) + tmp) >> 8) >> 7)
+                tmp = out_a255 + 0x80
+                dst_a = (((tmp >> 8) + tmp) >> 8)
+
+            dst = out + (<Py_ssize_t>py * width + px) * 4
+            dst[0] = dst_r; dst[1] = dst_g; dst[2] = dst_b; dst[3] = dst_a
+
+
+cpdef object export_image_cy(
+    int width, int height, list layers_info, unsigned int bg_color
+):
+    cdef bytearray buffer = bytearray(<Py_ssize_t>width * height * 4)
+    cdef unsigned char* out = <unsigned char*><char*>buffer
+    cdef vector[LayerView] views = _make_layer_views(layers_info)
+    cdef LayerView* view_data = views.data()
+    cdef int count = views.size()
+    cdef int ty, tiles_y = (height + TILE_DIM - 1) >> TILE_SHIFT
+
+    if not len(buffer):
+        return buffer
+    with nogil:
+        for ty in prange(tiles_y, schedule="dynamic"):
+            _export_band(
+                out, width, view_data, count, bg_color,
+                ty << TILE_SHIFT, min(height, (ty + 1) << TILE_SHIFT)
+            )
+    return buffer
+
+
+# ``out_rgba`` is either uint8 (height, width, 4), which receives the final
+# colors, or float32 (height, width, 3), which receives them unrounded.
+cpdef void render_layers_into_cy(
+    object out_rgba, list layers_info,
+    bint use_bg_color, unsigned int bg_color, bint render_alpha,
+    tuple bbox
+):
+    cdef unsigned char[:, :, ::1] out
+    cdef float[:, :, ::1] out_float
+    cdef int min_x, min_y, max_x, max_y
+    min_x, min_y, max_x, max_y = bbox
+    cdef vector[LayerView] views = _make_layer_views(layers_info, bbox)
+
+    cdef LayerView* view_data = views.data()
+    cdef int count = views.size()
+
+    if max_x <= min_x or max_y <= min_y:
+        return
+    if out_rgba.dtype == np.float32:
+        out_float = out_rgba
+        with nogil:
+            _render_layers(
+                &out_float[min_y, min_x, 0], out_float.strides[0] // sizeof(float),
+                view_data, count,
+                use_bg_color, bg_color, render_alpha,
+                min_x, min_y, max_x, max_y
+            )
+    else:
+        out = out_rgba
+        with nogil:
+            _render_layers(
+                &out[min_y, min_x, 0], out.strides[0],
+                view_data, count,
+                use_bg_color, bg_color, render_alpha,
+                min_x, min_y, max_x, max_y
+            )
+
+
+# Collapses the layers into ``out = color + transmittance * under``: the
+# premultiplied color in the first three channels and the share of whatever
+# is underneath that still shows through in the fourth.
+cdef void _flatten_band(
+    float* out, Py_ssize_t out_stride,
+    LayerView* views, int count, bint render_alpha,
+    int min_x, int min_y, int max_x, int y0, int y1
+) noexcept nogil:
+    cdef int px, py, i, a
+    cdef unsigned char* src
+    cdef float* dst
+    cdef double alpha_norm, r, g, b, transmittance
+
+    for py in range(y0, y1):
+        dst = out + (py - min_y) * out_stride
+        for px in range(min_x, max_x):
+            r = 0; g = 0; b = 0; transmittance = 1
+            for i in range(count):
+                src = _pixel_at(&views[i], px, py)
+                if src[3] == 0:
+                    continue
+                a = (src[3] * views[i].opacity) // 255
+                if not render_alpha:
+                    a = 255
+                if a == 0:
+                    continue
+                alpha_norm = a / 255.0
+                r = src[0] * alpha_norm + r * (1.0 - alpha_norm)
+                g = src[1] * alpha_norm + g * (1.0 - alpha_norm)
+                b = src[2] * alpha_norm + b * (1.0 - alpha_norm)
+                transmittance = transmittance * (1.0 - alpha_norm)
+
+            dst[0] = r; dst[1] = g; dst[2] = b; dst[3] = transmittance
+            dst += 4
+
+
+cpdef void flatten_layers_premultiplied_cy(
+    object out_rgba, list layers_info, bint render_alpha, tuple bbox
+):
+    cdef float[:, :, ::1] out = out_rgba
+    cdef vector[LayerView] views = _make_layer_views(layers_info, bbox)
+    cdef LayerView* view_data = views.data()
+    cdef int count = views.size()
+    cdef int min_x, min_y, max_x, max_y, ty
+    min_x, min_y, max_x, max_y = bbox
+
+    if max_x <= min_x or max_y <= min_y:
+        return
+    cdef float* origin = &out[min_y, min_x, 0]
+    cdef Py_ssize_t stride = out.strides[0] // sizeof(float)
+    cdef int first_band = min_y >> TILE_SHIFT
+    cdef int last_band = ((max_y - 1) >> TILE_SHIFT) + 1
+
+    with nogil:
+        if <long>(max_x - min_x) * (max_y - min_y) < PARALLEL_MIN_PIXELS:
+            for ty in range(first_band, last_band):
+                _flatten_band(
+                    origin, stride, view_data, count, render_alpha,
+                    min_x, min_y, max_x,
+                    max(min_y, ty << TILE_SHIFT), min(max_y, (ty + 1) << TILE_SHIFT)
+                )
+        else:
+            for ty in prange(first_band, last_band, schedule="dynamic"):
+                _flatten_band(
+                    origin, stride, view_data, count, render_alpha,
+                    min_x, min_y, max_x,
+                    max(min_y, ty << TILE_SHIFT), min(max_y, (ty + 1) << TILE_SHIFT)
+                )
+
+
+# Final color of one pixel from the unrounded composite below the focus
+# layer, the focus layer's pixel (NULL when there is none) and the collapsed
+# layers above it (NULL when there are none).
+cdef inline void _blend_focus_pixel(
+    unsigned char* dst, float* below, unsigned char* src, int opacity,
+    float* over, bint render_alpha
+) noexcept nogil:
+    cdef double rgb[3]
+    cdef int k
+    rgb[0] = below[0]; rgb[1] = below[1]; rgb[2] = below[2]
+    if src != NULL:
+        _blend_into(rgb, src, opacity, render_alpha)
+    if over != NULL:
+        for k in range(3):
+            rgb[k] = over[k] + over[3] * rgb[k]
+    for k in range(3):
+        dst[k] = _round_channel(rgb[k])
+    dst[3] = 255
+
+
+cdef void _blend_focus_band(
+    unsigned char* out, Py_ssize_t out_stride,
+    float* below, Py_ssize_t below_stride, float* above, Py_ssize_t above_stride,
+    LayerView* focus, int focus_opacity, bint render_alpha,
+    int min_x, int min_y, int max_x, int y0, int y1
+) noexcept nogil:
+    cdef int px, py
+    cdef unsigned char* dst
+
+    for py in range(y0, y1):
+        dst = out + (py - min_y) * out_stride
+        for px in range(min_x, max_x):
+            _blend_focus_pixel(
+                dst,
+                below + py * below_stride + px * 3,
+                _pixel_at(focus, px, py) if focus != NULL else NULL,
+                focus_opacity,
+                above + py * above_stride + px * 4 if above != NULL else NULL,
+                render_alpha
+            )
+            dst += 4
+
+
+cpdef object blend_focus_layer_cy(
+    object below_rgb, object focus_buffer, int focus_opacity,
+    object above_rgba, bint render_alpha, tuple bbox
+):
+    cdef float[:, :, ::1] below = below_rgb
+    cdef float[:, :, ::1] above
+    cdef float* above_data = NULL
+    cdef Py_ssize_t above_stride = 0
+    cdef LayerView focus
+    cdef LayerView* focus_view = NULL
+    if above_rgba is not None:
+        above = above_rgba
+        above_data = &above[0, 0, 0]
+        above_stride = above.strides[0] // sizeof(float)
+    if focus_buffer is not None:
+        focus = _make_layer_view(focus_buffer, focus_opacity, bbox)
+        focus_view = &focus
+
+    cdef int min_x, min_y, max_x, max_y, ty
+    min_x, min_y, max_x, max_y = bbox
+    cdef int render_width = max(0, max_x - min_x), render_height = max(0, max_y - min_y)
+    cdef bytearray buffer = bytearray(render_width * render_height * 4)
+    if not len(buffer):
+        return buffer
+
+    cdef unsigned char* out = <unsigned char*><char*>buffer
+    cdef float* below_data = &below[0, 0, 0]
+    cdef Py_ssize_t below_stride = below.strides[0] // sizeof(float)
+    cdef int first_band = min_y >> TILE_SHIFT
+    cdef int last_band = ((max_y - 1) >> TILE_SHIFT) + 1
+
+    with nogil:
+        if <long>render_width * render_height < PARALLEL_MIN_PIXELS:
+            for ty in range(first_band, last_band):
+                _blend_focus_band(
+                    out, render_width * 4,
+                    below_data, below_stride, above_data, above_stride,
+                    focus_view, focus_opacity, render_alpha,
+                    min_x, min_y, max_x,
+                    max(min_y, ty << TILE_SHIFT), min(max_y, (ty + 1) << TILE_SHIFT)
+                )
+        else:
+            for ty in prange(first_band, last_band, schedule="dynamic"):
+                _blend_focus_band(
+                    out, render_width * 4,
+                    below_data, below_stride, above_data, above_stride,
+                    focus_view, focus_opacity, render_alpha,
+                    min_x, min_y, max_x,
+                    max(min_y, ty << TILE_SHIFT), min(max_y, (ty + 1) << TILE_SHIFT)
+                )
+    return buffer
+
+
+cdef inline void _composite_stack(
+    LayerView* views, int count, int px, int py,
+    bint use_bg_color, unsigned int bg_color, bint render_alpha,
+    double* rgb
+) noexcept nogil:
+    cdef int i
+    _background(rgb, px, py, use_bg_color, bg_color)
+    for i in range(count):
+        _blend_into(rgb, _pixel_at(&views[i], px, py), views[i].opacity, render_alpha)
+
+
+cdef void _render_sampled_row(
+    unsigned char* out, LayerView* views, int count, int x0, int py, int out_width,
+    int step, bint use_bg_color, unsigned int bg_color, bint render_alpha
+) noexcept nogil:
+    cdef double rgb[3]
+    cdef int sx
+    for sx in range(out_width):
+        _composite_stack(
+            views, count, x0 + sx * step, py,
+            use_bg_color, bg_color, render_alpha, rgb
+        )
+        out[sx * 4] = _round_channel(rgb[0])
+        out[sx * 4 + 1] = _round_channel(rgb[1])
+        out[sx * 4 + 2] = _round_channel(rgb[2])
+        out[sx * 4 + 3] = 255
+
+
+# Composites every step-th pixel of every step-th row of bbox: a quick
+# low-resolution stand-in for the full composite while the full-resolution
+# image is refined. Only the lazy tiles holding a sampled pixel are loaded.
+cpdef object render_sampled_cy(
+    list layers_info, bint use_bg_color, unsigned int bg_color,
+    bint render_alpha, int step, tuple bbox
+):
+    cdef int x0, y0, x1, y1
+    x0, y0, x1, y1 = bbox
+    cdef int out_width = max(0, (x1 - x0 + step - 1) // step)
+    cdef int out_height = max(0, (y1 - y0 + step - 1) // step)
+    cdef bytearray buffer = bytearray(out_width * out_height * 4)
+    if not len(buffer):
+        return buffer
+    cdef vector[LayerView] views = _make_layer_views(layers_info, bbox, step)
+    cdef unsigned char* out = <unsigned char*><char*>buffer
+    cdef LayerView* view_data = views.data()
+    cdef int count = views.size()
+    cdef int sy
+
+    with nogil:
+        for sy in prange(out_height, schedule="static"):
+            _render_sampled_row(
+                out + <Py_ssize_t>sy * out_width * 4, view_data, count, x0,
+                y0 + sy * step, out_width, step, use_bg_color, bg_color, render_alpha
+            )
+    return buffer
+
+
+cpdef list bresenham_line_cy(int x0, int y0, int x1, int y1):
+    cdef list points = []
+    cdef int dx = abs(x1 - x0)
+    cdef int dy = -abs(y1 - y0)
+    cdef int sx = 1 if x0 < x1 else -1
+    cdef int sy = 1 if y0 < y1 else -1
+    cdef int err = dx + dy
+    cdef int e2
+
+    while True:
+        points.append((x0, y0))
+        if x0 == x1 and y0 == y1:
+            break
+        e2 = 2 * err
+        if e2 >= dy:
+            err += dy
+            x0 += sx
+        if e2 <= dx:
+            err += dx
+            y0 += sy
+    return points
+
+
+cpdef set get_stroke_pixels_cy(
+    int x0, int y0, int x1, int y1,
+    int brush_size, int canvas_width, int canvas_height,
+    set drawn_pixels_set
+):
+    cdef list line_pixels = bresenham_line_cy(x0, y0, x1, y1)
+    cdef set pixels_to_add = set()
+
+    cdef int offset = (brush_size - 1) // 2
+    cdef int p_x, p_y, brush_px, brush_py, x_off, y_off
+
+    for p_x, p_y in line_pixels:
+        start_x = p_x - offset
+        start_y = p_y - offset
+
+        for y_off in range(brush_size):
+            brush_py = start_y + y_off
+            if 0 <= brush_py < canvas_height:
+                for x_off in range(brush_size):
+                    brush_px = start_x + x_off
+                    if 0 <= brush_px < canvas_width:
+                        if (brush_px, brush_py) not in drawn_pixels_set:
+                            pixels_to_add.add((brush_px, brush_py))
+                            drawn_pixels_set.add((brush_px, brush_py))
+
+    return pixels_to_add
+
+
+cdef struct PreviewPixel:
+    int x
+    int y
+    unsigned char* out
+
+
+# Brush preview for a batch of stroke pixels, one RGBA buffer per touched
+# chunk along with the chunk-local bounds of the pixels written to it. Each
+# pixel is the tool's color applied to the focus layer's pixel, blended
+# between the CompositeCache buffers below and above the focus layer, so its
+# cost does not depend on the number of layers. The
+# constructor does everything that needs the GIL (loading lazy tiles,
+# allocating the chunk buffers) on the calling thread; run() only
+# composites, without the GIL, so it can run on a worker thread while the UI
+# keeps handling input. ``region`` must be filled in the composite buffers
+# before the job runs, and neither they nor the focus layer's pixels may be
+# written while it does.
+cdef class PreviewJob:
+    cdef float[:, :, ::1] below
+    cdef float[:, :, ::1] above
+    cdef bint has_above
+    cdef object focus_buffer
+    cdef LayerView focus_view
+    cdef int focus_opacity
+    cdef vector[PreviewPixel] pixels
+    cdef dict chunks
+    cdef unsigned int color
+    cdef bint is_eraser, color_blending, render_alpha
+    cdef readonly tuple region
+
+    def __init__(
+        self,
+        set new_preview_pixels,
+        dict tool_options,
+        object below_rgb, object above_rgba, int focus_opacity,
+        bint render_alpha,
+        int chunk_size
+    ):
+        cdef int width = below_rgb.shape[1], height = below_rgb.shape[0]
+        cdef int min_x, min_y, max_x, max_y, px, py
+        cdef tuple chunk_coord
+        cdef bytearray buffer
+        cdef PreviewPixel pixel
+
+        min_x, min_y, max_x, max_y = _pixels_bbox(new_preview_pixels)
+        self.region = (
+            max(0, min_x), max(0, min_y), min(width, max_x), min(height, max_y)
+        )
+        self.below = below_rgb
+        self.has_above = above_rgba is not None
+        if self.has_above:
+            self.above = above_rgba
+        self.focus_buffer = tool_options["active_layer_buffer"]
+        self.focus_view = _make_layer_view(self.focus_buffer, 255, self.region)
+        self.focus_opacity = focus_opacity
+
+        self.color = tool_options.get("color", 0)
+        self.is_eraser = tool_options.get("tool") == "eraser"
+        self.color_blending = tool_options.get("color_blending", False)
+        self.render_alpha = render_alpha
+
+        cdef dict buffers = {}
+        cdef dict bounds = {}
+        cdef list bound
+        cdef int cx, cy
+        for px, py in new_preview_pixels:
+            if px < 0 or px >= width or py < 0 or py >= height:
+                continue
+            chunk_coord = (px // chunk_size, py // chunk_size)
+            cx, cy = px % chunk_size, py % chunk_size
+            buffer = buffers.get(chunk_coord)
+            if buffer is None:
+                buffer = bytearray(chunk_size * chunk_size * 4)
+                buffers[chunk_coord] = buffer
+                bounds[chunk_coord] = [cx, cy, cx + 1, cy + 1]
+            else:
+                bound = bounds[chunk_coord]
+                bound[0] = min(bound[0], cx); bound[1] = min(bound[1], cy)
+                bound[2] = max(bound[2], cx + 1); bound[3] = max(bound[3], cy + 1)
+            pixel.x, pixel.y = px, py
+            pixel.out = <unsigned char*><char*>buffer + (cy * chunk_size + cx) * 4
+            self.pixels.push_back(pixel)
+        self.chunks = {
+            coord: (buffer, tuple(bounds[coord])) for coord, buffer in buffers.items()
+        }
+
+    def run(self):
+        cdef size_t i
+        with nogil:
+            for i in range(self.pixels.size()):
+                self._render_pixel(&self.pixels[i])
+        return self.chunks
+
+    cdef void _render_pixel(self, PreviewPixel* pixel) noexcept nogil:
+        cdef int px = pixel.x, py = pixel.y
+        cdef unsigned char source[4]
+        cdef unsigned char applied[4]
+        cdef unsigned char* existing_pixel = _pixel_at(&self.focus_view, px, py)
+
+        _unpack(self.color, source)
+        applied[0] = source[0]; applied[1] = source[1]; applied[2] = source[2]
+        applied[3] = 0 if self.is_eraser else source[3]
+        if self.color_blending and 0 < source[3] < 255 and existing_pixel[3] > 0:
+            _blend_over(
+                source[0], source[1], source[2], source[3],
+                existing_pixel[0], existing_pixel[1], existing_pixel[2], existing_pixel[3],
+                applied
+            )
+
+        _blend_focus_pixel(
+            pixel.out,
+            &self.below[py, px, 0],
+            applied,
+            self.focus_opacity,
+            &self.above[py, px, 0] if self.has_above else NULL,
+            self.render_alpha
+        )
+
+cdef cppclass PixelCoord:
+    int x, y
+
+cdef tuple _empty_delta():
+    return (
+        np.empty(0, dtype=np.uint32),
+        np.empty(0, dtype=np.uint32),
+        np.empty(0, dtype=np.uint32),
+    )
+
+cpdef tuple flood_fill_apply_cy(
+    int start_x, int start_y,
+    int canvas_width, int canvas_height,
+    object active_layer_buffer,
+    unsigned int new_color
+):
+    if not (0 <= start_x < canvas_width and 0 <= start_y < canvas_height):
+        return _empty_delta()
+
+    cdef LayerView view = _make_layer_view(active_layer_buffer, 255)
+    cdef unsigned char new_pixel[4]
+    cdef unsigned char target[4]
+    cdef unsigned char* pixel = _pixel_at(&view, start_x, start_y)
+    cdef int k
+
+    _unpack(new_color, new_pixel)
+    for k in range(4):
+        target[k] = pixel[k]
+
+    if (target[0] == new_pixel[0] and target[1] == new_pixel[1]
+            and target[2] == new_pixel[2] and target[3] == new_pixel[3]):
+        return _empty_delta()
+
+    cdef size_t map_size = canvas_width * canvas_height
+    cdef char* processed = <char*>calloc(map_size, sizeof(char))
+    cdef vector[PixelCoord] stack
+    cdef vector[PixelCoord] pixels_to_fill
+    cdef int x, y, nx, ny, px, py, d
+    cdef int dxs[4]
+    cdef int dys[4]
+    cdef long i
+    cdef unsigned int original_color
+    cdef unsigned int final_color
+    cdef PixelCoord current_coord, temp_coord
+
+    dxs[0] = 0; dxs[1] = 0; dxs[2] = 1; dxs[3] = -1
+    dys[0] = 1; dys[1] = -1; dys[2] = 0; dys[3] = 0
+
+    if processed is NULL:
+        raise MemoryError("Failed to allocate processed map for flood fill")
+
+    temp_coord.x = start_x
+    temp_coord.y = start_y
+    stack.push_back(temp_coord)
+    processed[start_y * canvas_width + start_x] = 1
+
+    while not stack.empty():
+        current_coord = stack.back()
+        stack.pop_back()
+        x = current_coord.x
+        y = current_coord.y
+
+        pixel = _pixel_at(&view, x, y)
+
+        if (pixel[0] == target[0] and pixel[1] == target[1]
+                and pixel[2] == target[2] and pixel[3] == target[3]):
+            temp_coord.x = x
+            temp_coord.y = y
+            pixels_to_fill.push_back(temp_coord)
+
+            for d in range(4):
+                nx = x + dxs[d]
+                ny = y + dys[d]
+                if 0 <= nx < canvas_width and 0 <= ny < canvas_height and not processed[ny * canvas_width + nx]:
+                    processed[ny * canvas_width + nx] = 1
+                    temp_coord.x = nx
+                    temp_coord.y = ny
+                    stack.push_back(temp_coord)
+
+    free(processed)
+
+    original_color = _pack(target)
+    final_color = _pack(new_pixel)
+
+    indices = np.empty(pixels_to_fill.size(), dtype=np.uint32)
+    cdef unsigned int[::1] index_view = indices
+
+    for i in range(pixels_to_fill.size()):
+        px = pixels_to_fill[i].x
+        py = pixels_to_fill[i].y
+
+        pixel = _writable_pixel_at(active_layer_buffer, &view, px, py)
+        for k in range(4):
+            pixel[k] = new_pixel[k]
+        index_view[i] = py * canvas_width + px
+
+    return (
+        indices,
+        np.broadcast_to(np.uint32(original_color), indices.shape),
+        np.broadcast_to(np.uint32(final_color), indices.shape),
+    )
+
+cpdef set get_brush_pixels_cy(int center_x, int center_y, int brush_size, int canvas_width, int canvas_height):
+    cdef set pixels = set()
+    cdef int offset = (brush_size - 1) // 2
+    cdef int start_x = center_x - offset
+    cdef int start_y = center_y - offset
+    cdef int x_off, y_off, px, py
+    for y_off in range(brush_size):
+        py = start_y + y_off
+        if 0 <= py < canvas_height:
+            for x_off in range(brush_size):
+                px = start_x + x_off
+                if 0 <= px < canvas_width:
+                    pixels.add((px, py))
+    return pixels
+
+cpdef set get_rectangle_pixels_cy(int x0, int y0, int x1, int y1, bint fill, int canvas_width, int canvas_height):
+    cdef set pixels = set()
+    cdef int xs = min(x0, x1), ys = min(y0, y1)
+    cdef int xe = max(x0, x1), ye = max(y0, y1)
+    cdef int x, y
+    if fill:
+        for y in range(ys, ye + 1):
+            if 0 <= y < canvas_height:
+                for x in range(xs, xe + 1):
+                    if 0 <= x < canvas_width:
+                        pixels.add((x, y))
+    else:
+        for x in range(xs, xe + 1):
+            if 0 <= x < canvas_width:
+                if 0 <= ys < canvas_height: pixels.add((x, ys))
+                if 0 <= ye < canvas_height: pixels.add((x, ye))
+        for y in range(ys + 1, ye):
+            if 0 <= y < canvas_height:
+                if 0 <= xs < canvas_width: pixels.add((xs, y))
+                if 0 <= xe < canvas_width: pixels.add((xe, y))
+    return pixels
+
+cpdef set get_ellipse_pixels_cy(int x0, int y0, int rx, int ry, bint fill, int canvas_width, int canvas_height):
+    cdef set pixels = set()
+    cdef int px, py, x_offset, y_offset
+    cdef set full_ellipse, inner_ellipse
+    cdef int rx_inner, ry_inner
+
+    if rx == 0 and ry == 0:
+        if 0 <= x0 < canvas_width and 0 <= y0 < canvas_height: pixels.add((x0,y0))
+        return pixels
+
+    if fill:
+        for y_offset in range(-ry, ry + 1):
+            for x_offset in range(-rx, rx + 1):
+                if ((x_offset / <float>rx if rx > 0 else 0)**2 + (y_offset / <float>ry if ry > 0 else 0)**2) <= 1:
+                    px = x0 + x_offset; py = y0 + y_offset
+                    if 0 <= px < canvas_width and 0 <= py < canvas_height: pixels.add((px, py))
+    else:
+        full_ellipse = set()
+        inner_ellipse = set()
+        for y_offset in range(-ry, ry + 1):
+            for x_offset in range(-rx, rx + 1):
+                if ((x_offset / <float>rx if rx > 0 else 0)**2 + (y_offset / <float>ry if ry > 0 else 0)**2) <= 1:
+                    px = x0 + x_offset; py = y0 + y_offset
+                    if 0 <= px < canvas_width and 0 <= py < canvas_height: full_ellipse.add((px, py))
+        
+        rx_inner = max(0, rx - 1)
+        ry_inner = max(0, ry - 1)
+        if rx_inner > 0 or ry_inner > 0:
+            for y_offset in range(-ry_inner, ry_inner + 1):
+                for x_offset in range(-rx_inner, rx_inner + 1):
+                    if ((x_offset / <float>rx_inner if rx_inner > 0 else 0)**2 + (y_offset / <float>ry_inner if ry_inner > 0 else 0)**2) <= 1:
+                        px = x0 + x_offset; py = y0 + y_offset
+                        if 0 <= px < canvas_width and 0 <= py < canvas_height: inner_ellipse.add((px, py))
+        pixels.update(full_ellipse - inner_ellipse)
+    return pixels
+
+cpdef tuple apply_pixels_cy(
+    set pixels_to_process,
+    object active_layer_buffer,
+    unsigned int color,
+    bint color_blending,
+    int canvas_width,
+    int canvas_height
+):
+    cdef Py_ssize_t capacity = len(pixels_to_process), count = 0
+    indices = np.empty(capacity, dtype=np.uint32)
+    colors_before = np.empty(capacity, dtype=np.uint32)
+    colors_after = np.empty(capacity, dtype=np.uint32)
+    cdef unsigned int[::1] index_view = indices
+    cdef unsigned int[::1] before_view = colors_before
+    cdef unsigned int[::1] after_view = colors_after
+
+    cdef LayerView view = _make_layer_view(
+        active_layer_buffer, 255, _pixels_bbox(pixels_to_process)
+    )
+    cdef unsigned char source[4]
+    _unpack(color, source)
+    cdef int r = source[0], g = source[1], b = source[2], alpha = source[3]
+    cdef unsigned char* pixel
+    cdef unsigned char applied[4]
+    cdef unsigned int old_color, new_color
+    cdef int px, py
+
+    for px, py in pixels_to_process:
+        if px < 0 or px >= canvas_width or py < 0 or py >= canvas_height:
+            continue
+
+        pixel = _pixel_at(&view, px, py)
+        old_color = _pack(pixel)
+
+        applied[0] = r; applied[1] = g; applied[2] = b; applied[3] = alpha
+
+        if color_blending and 0 < alpha < 255 and pixel[3] > 0:
+            _blend_over(r, g, b, alpha, pixel[0], pixel[1], pixel[2], pixel[3], applied)
+
+        if applied[3] > 0:
+            new_color = _pack(applied)
+        else:
+            new_color = 0
+        if new_color == old_color:
+            continue
+
+        pixel = _writable_pixel_at(active_layer_buffer, &view, px, py)
+        _unpack(new_color, pixel)
+        index_view[count] = py * canvas_width + px
+        before_view[count] = old_color
+        after_view[count] = new_color
+        count += 1
+
+    return (indices[:count], colors_before[:count], colors_after[:count])
+
+cpdef void scatter_pixels_cy(
+    object buffer, const unsigned int[::1] indices, const unsigned int[:] colors
+):
+    cdef Py_ssize_t i
+    cdef int px, py
+    cdef unsigned int color
+    cdef unsigned int lowest = 0xFFFFFFFF, highest = 0
+    cdef int width = buffer.width
+
+    if indices.shape[0] == 0:
+        return
+    for i in range(indices.shape[0]):
+        lowest = min(lowest, indices[i])
+        highest = max(highest, indices[i])
+    cdef LayerView view = _make_layer_view(
+        buffer, 255, (0, lowest // width, width, highest // width + 1)
+    )
+
+    for i in range(indices.shape[0]):
+        px = indices[i] % view.width
+        py = indices[i] // view.width
+        color = colors[i]
+        if color & 0xFF == 0:
+            if _tile_at(&view, px >> TILE_SHIFT, py >> TILE_SHIFT) == NULL:
+                continue
+            color = 0
+        _unpack(color, _writable_pixel_at(buffer, &view, px, py))
+
+cpdef tuple pick_color_at_pixel_cy(int px, int py, list visible_layers_info):
+    cdef vector[LayerView] views = _make_layer_views(
+        visible_layers_info, (px, py, px + 1, py + 1)
+    )
+    cdef unsigned char* pixel
+    cdef int i
+    for i in range(<int>views.size() - 1, -1, -1):
+        if not (0 <= px < views[i].width and 0 <= py < views[i].height):
+            continue
+        pixel = _pixel_at(&views[i], px, py)
+        if pixel[3] > 0 and views[i].opacity > 0:
+            return _pack(pixel)
+    return None
+
+cpdef void merge_layer_pixels_cy(
+    object lower_buffer, int lower_opacity,
+    object upper_buffer, int upper_opacity,
+    bint color_blending
+):
+    cdef LayerView lower = _make_layer_view(lower_buffer, lower_opacity)
+    cdef LayerView upper = _make_layer_view(upper_buffer, upper_opacity)
+    cdef int tx, ty, i, effective_alpha
+    cdef unsigned char* dst
+    cdef unsigned char* src
+    cdef unsigned char blended[4]
+
+    for ty in range(lower.tiles_y):
+        for tx in range(lower.tiles_x):
+            if _tile_at(&upper, tx, ty) == NULL and (
+                lower_opacity == 255 or _tile_at(&lower, tx, ty) == NULL
+            ):
+                # Nothing to merge and nothing to fade: keep the tile shared
+                continue
+            if not lower.owned[ty * lower.tiles_x + tx]:
+                lower_buffer.writable_tile(tx, ty)
+            dst = _tile_at(&lower, tx, ty)
+            src = _tile_at(&upper, tx, ty)
+
+            for i in range(0, TILE_DIM * TILE_DIM * 4, 4):
+                if dst[i + 3] > 0:
+                    dst[i + 3] = (dst[i + 3] * lower_opacity) // 255
+                    if dst[i + 3] == 0:
+                        dst[i] = 0; dst[i + 1] = 0; dst[i + 2] = 0
+
+                if src == NULL:
+                    continue
+                effective_alpha = (src[i + 3] * upper_opacity) // 255
+                if effective_alpha == 0:
+                    continue
+
+                if color_blending and effective_alpha < 255 and dst[i + 3] > 0:
+                    _blend_over(
+                        src[i], src[i + 1], src[i + 2], effective_alpha,
+                        dst[i], dst[i + 1], dst[i + 2], dst[i + 3], blended
+                    )
+                else:
+                    blended[0] = src[i]; blended[1] = src[i + 1]; blended[2] = src[i + 2]
+                    blended[3] = effective_alpha
+
+                if blended[3] > 0:
+                    dst[i] = blended[0]; dst[i + 1] = blended[1]; dst[i + 2] = blended[2]
+                    dst[i + 3] = blended[3]
+                else:
+                    dst[i] = 0; dst[i + 1] = 0; dst[i + 2] = 0; dst[i + 3] = 0
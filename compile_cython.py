@@ -1,6 +1,10 @@
 import sys
 import os
+import tempfile
 from setuptools import setup, Extension
+from setuptools._distutils.ccompiler import new_compiler
+from setuptools._distutils.errors import CompileError, LinkError
+from setuptools._distutils.sysconfig import customize_compiler
 from Cython.Build import cythonize
 import numpy
 
@@ -8,11 +12,51 @@ script_dir = os.path.dirname(os.path.abspath(__file__))
 
 source_file = os.path.join(script_dir, "canvas_cython_helpers.pyx")
 
+OPENMP_TEST_SOURCE = """
+#include <omp.h>
+int main(void) { return omp_get_max_threads() > 0 ? 0 : 1; }
+"""
+
+
+def openmp_flags():
+    compiler = new_compiler()
+    customize_compiler(compiler)
+
+    if compiler.compiler_type == "msvc":
+        compile_args, link_args = ["/openmp"], []
+    elif sys.platform == "darwin":
+        compile_args, link_args = ["-Xpreprocessor", "-fopenmp"], ["-lomp"]
+    else:
+        compile_args, link_args = ["-fopenmp"], ["-fopenmp"]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        test_file = os.path.join(tmp_dir, "openmp_test.c")
+        with open(test_file, "w") as f:
+            f.write(OPENMP_TEST_SOURCE)
+        try:
+            objects = compiler.compile(
+                [test_file], output_dir=tmp_dir, extra_postargs=compile_args
+            )
+            compiler.link_executable(
+                objects,
+                os.path.join(tmp_dir, "openmp_test"),
+                extra_postargs=link_args,
+            )
+        except (CompileError, LinkError):
+            return None
+    return compile_args, link_args
+
+
 if __name__ == "__main__":
     if len(sys.argv) == 1:
         print("No command provided, defaulting to 'build_ext --inplace'")
         sys.argv.extend(["build_ext", "--inplace"])
 
+    flags = None if os.environ.get("PIXEL_ART_NO_OPENMP") else openmp_flags()
+    if flags is None:
+        print("OpenMP not available, building serial render kernels")
+        flags = ([], [])
+
     setup(
         ext_modules=cythonize(
             Extension(
@@ -20,6 +64,8 @@ if __name__ == "__main__":
                 sources=[source_file],
                 language="c++",
                 include_dirs=[numpy.get_include()],
+                extra_compile_args=flags[0],
+                extra_link_args=flags[1],
             )
         ),
     )
@@ -0,0 +1,121 @@
+import numpy as np
+
+import canvas_cython_helpers
+from layer_buffer import TILE_SIZE
+
+
+class CompositeCache:
+    """Flattened copies of the visible layers below and above a focus layer.
+
+    ``below`` holds the background plus every visible layer under the focus
+    layer. ``above`` holds the layers over it as premultiplied color plus the
+    share of the pixel underneath that still shows through. Redrawing after
+    the focus layer's pixels or opacity change then only blends three
+    buffers, whatever the number of layers.
+
+    Both are float32 and hold unrounded values, so the composed pixels match
+    a full render of the layers, whichever layer has focus, apart from the
+    odd channel that float32 round-off moves across a rounding boundary.
+
+    After a rebuild both buffers are filled lazily, tile by tile, as
+    :meth:`compose` reaches them or :meth:`fill` asks for them, so a large
+    canvas only pays for what is actually drawn.
+    """
+
+    def __init__(self):
+        self.below = None
+        self.above = None
+        self.focus_layer = None
+        self._key = None
+        self._below_info = []
+        self._above_info = []
+        self._render_alpha = True
+        self._stale = None
+
+    def invalidate(self):
+        self._key = None
+
+    def prepare(self, layers, focus_layer, width, height, use_bg, bg_color, render_alpha):
+        visible = [layer for layer in layers if layer.visible]
+        if focus_layer is not None and not any(l is focus_layer for l in visible):
+            focus_layer = None
+
+        if focus_layer is None:
+            below_layers, above_layers = visible, []
+        else:
+            split = next(i for i, l in enumerate(visible) if l is focus_layer)
+            below_layers, above_layers = visible[:split], visible[split + 1 :]
+
+        key = (
+            width,
+            height,
+            use_bg,
+            bg_color,
+            render_alpha,
+            focus_layer,
+            focus_layer.buffer if focus_layer is not None else None,
+            tuple((l, l.buffer, l.opacity) for l in below_layers),
+            tuple((l, l.buffer, l.opacity) for l in above_layers),
+        )
+        if key == self._key:
+            return False
+
+        self.focus_layer = focus_layer
+        self._below_info = [(l.buffer, l.opacity) for l in below_layers]
+        self._above_info = [(l.buffer, l.opacity) for l in above_layers]
+        self._use_bg, self._bg_color = use_bg, bg_color
+        self._render_alpha = render_alpha
+        self.below = np.empty((height, width, 3), dtype=np.float32)
+        self.above = (
+            np.empty((height, width, 4), dtype=np.float32) if above_layers else None
+        )
+        self._stale = np.ones(
+            (-(-height // TILE_SIZE), -(-width // TILE_SIZE)), dtype=bool
+        )
+        self._key = key
+        return True
+
+    def refresh_region(self, bbox):
+        canvas_cython_helpers.render_layers_into_cy(
+            self.below,
+            self._below_info,
+            self._use_bg,
+            self._bg_color,
+            self._render_alpha,
+            bbox,
+        )
+        if self.above is not None:
+            canvas_cython_helpers.flatten_layers_premultiplied_cy(
+                self.above, self._above_info, self._render_alpha, bbox
+            )
+
+    def fill(self, bbox):
+        x0, y0, x1, y1 = bbox
+        tx0, ty0 = x0 // TILE_SIZE, y0 // TILE_SIZE
+        stale = self._stale[ty0 : -(-y1 // TILE_SIZE), tx0 : -(-x1 // TILE_SIZE)]
+        if not stale.any():
+            return
+        rows = np.flatnonzero(stale.any(axis=1))
+        cols = np.flatnonzero(stale.any(axis=0))
+        stale[rows[0] : rows[-1] + 1, cols[0] : cols[-1] + 1] = False
+        height, width = self.below.shape[:2]
+        self.refresh_region(
+            (
+                (tx0 + cols[0]) * TILE_SIZE,
+                (ty0 + rows[0]) * TILE_SIZE,
+                min(width, (tx0 + cols[-1] + 1) * TILE_SIZE),
+                min(height, (ty0 + rows[-1] + 1) * TILE_SIZE),
+            )
+        )
+
+    def compose(self, bbox):
+        self.fill(bbox)
+        focus = self.focus_layer
+        return canvas_cython_helpers.blend_focus_layer_cy(
+            self.below,
+            focus.buffer if focus is not None else None,
+            focus.opacity if focus is not None else 0,
+            self.above,
+            self._render_alpha,
+            bbox,
+        )
@@ -0,0 +1,96 @@
+import numpy as np
+
+from layer_buffer import TILE_SIZE
+
+
+class DirtyRegion:
+    """Set of canvas areas that need to be re-rendered.
+
+    Damage is tracked per ``TILE_SIZE`` tile as a tight bounding box inside
+    that tile, so edits far apart on the canvas stay separate instead of
+    growing one box over everything between them. :meth:`rects` merges
+    neighbouring tiles back into a short list of rectangles.
+    """
+
+    def __init__(self):
+        self._tiles = {}
+
+    def __bool__(self):
+        return bool(self._tiles)
+
+    def clear(self):
+        self._tiles.clear()
+
+    def add_pixel(self, x, y):
+        self._add_box((x // TILE_SIZE, y // TILE_SIZE), (x, y, x + 1, y + 1))
+
+    def add_indices(self, indices, width):
+        if len(indices) == 0:
+            return
+        xs = indices % width
+        ys = indices // width
+        keys = (ys // TILE_SIZE) * (width // TILE_SIZE + 1) + xs // TILE_SIZE
+        order = np.argsort(keys, kind="stable")
+        keys, xs, ys = keys[order], xs[order], ys[order]
+        starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+        boxes = zip(
+            np.minimum.reduceat(xs, starts).tolist(),
+            np.minimum.reduceat(ys, starts).tolist(),
+            (np.maximum.reduceat(xs, starts) + 1).tolist(),
+            (np.maximum.reduceat(ys, starts) + 1).tolist(),
+        )
+        for box in boxes:
+            self._add_box((box[0] // TILE_SIZE, box[1] // TILE_SIZE), box)
+
+    def _add_box(self, key, new_box):
+        box = self._tiles.get(key)
+        if box is None:
+            self._tiles[key] = new_box
+        else:
+            self._tiles[key] = (
+                min(box[0], new_box[0]),
+                min(box[1], new_box[1]),
+                max(box[2], new_box[2]),
+                max(box[3], new_box[3]),
+            )
+
+    def rects(self, width, height):
+        rows = {}
+        for tx, ty in sorted(self._tiles):
+            box = self._tiles[(tx, ty)]
+            runs = rows.setdefault(ty, [])
+            if runs and runs[-1][0] == tx - 1:
+                _, x0, y0, x1, y1 = runs[-1]
+                runs[-1] = (
+                    tx,
+                    x0,
+                    min(y0, box[1]),
+                    box[2],
+                    max(y1, box[3]),
+                )
+            else:
+                runs.append((tx,) + box)
+
+        merged = []
+        open_rects = {}
+        for ty in sorted(rows):
+            next_open = {}
+            for _, x0, y0, x1, y1 in rows[ty]:
+                above = open_rects.get((x0, x1))
+                if above is not None and above[3] == y0 and y0 % TILE_SIZE == 0:
+                    del open_rects[(x0, x1)]
+                    rect = (x0, above[1], x1, y1)
+                else:
+                    rect = (x0, y0, x1, y1)
+                next_open[(x0, x1)] = rect
+            merged.extend(open_rects.values())
+            open_rects = next_open
+        merged.extend(open_rects.values())
+
+        clipped = []
+        for x0, y0, x1, y1 in merged:
+            x0, y0 = max(0, x0), max(0, y0)
+            x1, y1 = min(width, x1), min(height, y1)
+            if x0 < x1 and y0 < y1:
+                clipped.append((x0, y0, x1, y1))
+        return clipped
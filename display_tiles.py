@@ -0,0 +1,184 @@
+from collections import OrderedDict
+import tkinter as tk
+
+import numpy as np
+from PIL import Image, ImageTk
+
+from utilities import hex_to_rgb
+
+DISPLAY_TILE_PX = 256
+MAX_TILES = 192
+GRID_FADE_START = 3
+GRID_FADE_END = 8
+
+
+class DisplayTileCache:
+    """Pre-scaled PhotoImages of the art, one canvas image item per tile.
+
+    At zoom ``pixel_size`` a tile covers ``tile_pixels(pixel_size)`` art
+    pixels square, about ``DISPLAY_TILE_PX`` on screen, and is keyed by
+    ``(level, pixel_size, tx, ty)``, where ``level`` is the mip level the
+    image comes from when zoomed out below one screen pixel per art pixel.
+    Items sit at fixed canvas coordinates, so scrolling only creates the
+    tiles that come into view. Tiles that leave the view, including those of
+    other zoom levels, are hidden and kept up to ``MAX_TILES``; stale tiles
+    are repainted in place when shown.
+
+    Only the unscaled art pixels of a tile are handed to Tk, through a
+    reusable source image per tile size; Tk scales them into the tile with
+    ``copy -zoom``.
+
+    The pixel grid is part of the tiles: a transparent stamp holding the
+    grid lines of one tile at the current zoom is overlaid after scaling.
+    It fades in between ``GRID_FADE_START`` and ``GRID_FADE_END`` pixels
+    per art pixel.
+    """
+
+    def __init__(self, canvas, tag="art_tile"):
+        self.canvas = canvas
+        self.tag = tag
+        self._tiles = OrderedDict()
+        self._shown = set()
+        self._stale = set()
+        self._sources = {}
+        self._grid_color = None
+        self._grid_stamps = {}
+
+    @staticmethod
+    def tile_pixels(pixel_size):
+        return max(1, DISPLAY_TILE_PX // pixel_size)
+
+    def clear(self):
+        for _, item in self._tiles.values():
+            self.canvas.delete(item)
+        self._tiles.clear()
+        self._shown.clear()
+        self._stale.clear()
+        self._sources.clear()
+        self._grid_stamps.clear()
+
+    def set_grid(self, color):
+        if color != self._grid_color:
+            self._grid_color = color
+            self._grid_stamps.clear()
+            self.invalidate()
+
+    def invalidate(self, rect=None):
+        if rect is None:
+            self._stale.update(self._tiles)
+            return
+        for key in self._tiles:
+            level, pixel_size, tx, ty = key
+            x0, y0 = rect[0] >> level, rect[1] >> level
+            x1, y1 = -(-rect[2] >> level), -(-rect[3] >> level)
+            n = self.tile_pixels(pixel_size)
+            if tx * n < x1 and x0 < (tx + 1) * n and ty * n < y1 and y0 < (ty + 1) * n:
+                self._stale.add(key)
+
+    def show(self, image, pixel_size, region, level=0):
+        n = self.tile_pixels(pixel_size)
+        x0, y0, x1, y1 = region
+        visible = set()
+        if x0 < x1 and y0 < y1:
+            visible = {
+                (level, pixel_size, tx, ty)
+                for ty in range(y0 // n, -(-y1 // n))
+                for tx in range(x0 // n, -(-x1 // n))
+            }
+        for key in self._shown - visible:
+            self.canvas.itemconfig(self._tiles[key][1], state="hidden")
+
+        created = False
+        for key in sorted(visible):
+            entry = self._tiles.get(key)
+            if entry is None:
+                _, _, tx, ty = key
+                photo = self._paint(None, image, pixel_size, key)
+                item = self.canvas.create_image(
+                    tx * n * pixel_size,
+                    ty * n * pixel_size,
+                    anchor="nw",
+                    image=photo,
+                    tags=self.tag,
+                )
+                self._tiles[key] = (photo, item)
+                created = True
+            else:
+                if key in self._stale:
+                    self._paint(entry[0], image, pixel_size, key)
+                if key not in self._shown:
+                    self.canvas.itemconfig(entry[1], state="normal")
+                self._tiles.move_to_end(key)
+            self._stale.discard(key)
+        self._shown = visible
+        if created:
+            self.canvas.tag_lower(self.tag)
+
+        while len(self._tiles) > max(MAX_TILES, len(visible)):
+            key, (_, item) = self._tiles.popitem(last=False)
+            self.canvas.delete(item)
+            self._stale.discard(key)
+
+    def _paint(self, photo, image, pixel_size, key):
+        _, _, tx, ty = key
+        n = self.tile_pixels(pixel_size)
+        crop = image.crop(
+            (
+                tx * n,
+                ty * n,
+                min(image.width, (tx + 1) * n),
+                min(image.height, (ty + 1) * n),
+            )
+        )
+        source = self._sources.get(crop.size)
+        if source is None:
+            source = self._sources[crop.size] = ImageTk.PhotoImage(
+                crop, master=self.canvas
+            )
+        else:
+            source.paste(crop)
+        if photo is None:
+            photo = tk.PhotoImage(
+                master=self.canvas,
+                width=crop.width * pixel_size,
+                height=crop.height * pixel_size,
+            )
+        photo.tk.call(
+            photo,
+            "copy",
+            source,
+            "-zoom",
+            pixel_size,
+            pixel_size,
+            "-compositingrule",
+            "set",
+        )
+        if (stamp := self._grid_stamp(pixel_size, tx == 0, ty == 0)) is not None:
+            photo.tk.call(
+                photo,
+                "copy",
+                stamp,
+                "-from",
+                0,
+                0,
+                crop.width * pixel_size,
+                crop.height * pixel_size,
+            )
+        return photo
+
+    def _grid_stamp(self, pixel_size, left_edge, top_edge):
+        key = (pixel_size, left_edge, top_edge)
+        if key not in self._grid_stamps:
+            fade = (pixel_size - GRID_FADE_START) / (GRID_FADE_END - GRID_FADE_START)
+            stamp = None
+            if self._grid_color is not None and fade > 0:
+                size = self.tile_pixels(pixel_size) * pixel_size
+                lines = np.zeros((size, size, 4), dtype=np.uint8)
+                color = hex_to_rgb(self._grid_color) + (round(255 * min(1.0, fade)),)
+                lines[pixel_size if top_edge else 0 :: pixel_size] = color
+                lines[:, pixel_size if left_edge else 0 :: pixel_size] = color
+                stamp = ImageTk.PhotoImage(
+                    Image.fromarray(lines, "RGBA"), master=self.canvas
+                )
+            self._grid_stamps[key] = stamp
+        return self._grid_stamps[key]
@@ -0,0 +1,192 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import os
+import tempfile
+import threading
+import zlib
+
+DEFAULT_BUDGET_BYTES = 512 * 1024 * 1024
+DEFAULT_HOT_DEPTH = 32
+COMPRESS_LEVEL = 1
+
+
+class ColdBlob:
+    __slots__ = ("_store", "_data", "_offset", "_size")
+
+    def __init__(self, store, data, offset, size):
+        self._store = store
+        self._data = data
+        self._offset = offset
+        self._size = size
+
+    @property
+    def resident_bytes(self):
+        return self._size if self._data is not None else 0
+
+    def load(self):
+        if self._data is not None:
+            return zlib.decompress(self._data)
+        return zlib.decompress(self._store.read(self._offset, self._size))
+
+
+class ColdStore:
+    """zlib-compressed storage for history payloads that are rarely replayed.
+
+    With ``spill_to_disk`` the compressed bytes are appended to an anonymous
+    temporary file and only an offset stays in memory. Space of evicted
+    entries is not reclaimed; the file goes away once the store and all its
+    blobs are garbage collected.
+    """
+
+    def __init__(self, spill_to_disk=False):
+        self._file = (
+            tempfile.TemporaryFile(prefix="pixel-art-history-")
+            if spill_to_disk
+            else None
+        )
+        self._lock = threading.Lock()
+
+    def put(self, data):
+        compressed = zlib.compress(data, COMPRESS_LEVEL)
+        if self._file is None:
+            return ColdBlob(self, compressed, None, len(compressed))
+        with self._lock:
+            self._file.seek(0, os.SEEK_END)
+            offset = self._file.tell()
+            self._file.write(compressed)
+        return ColdBlob(self, None, offset, len(compressed))
+
+    def read(self, offset, size):
+        with self._lock:
+            self._file.seek(offset)
+            return self._file.read(size)
+
+
+class History:
+    """Undo/redo stacks that stay within a memory budget.
+
+    Every action reports an approximate cost through ``byte_size()``. When
+    the total goes over ``budget_bytes`` the oldest undo entries are dropped
+    until it fits again; the most recent undo step is always kept.
+
+    Actions more than ``hot_depth`` steps down the undo stack are frozen into
+    a :class:`ColdStore` on a worker thread and thawed again when replayed.
+    ``live_layers`` returns the layers currently in the document, which are
+    never frozen. Freezing holds the same lock as replaying an action, so a
+    layer that an undo puts back into the document is not frozen under it.
+    """
+
+    def __init__(
+        self,
+        budget_bytes=DEFAULT_BUDGET_BYTES,
+        hot_depth=DEFAULT_HOT_DEPTH,
+        spill_to_disk=False,
+        live_layers=tuple,
+    ):
+        self.budget_bytes = budget_bytes
+        self.hot_depth = hot_depth
+        self.spill_to_disk = spill_to_disk
+        self._live_layers = live_layers
+        self._undo = deque()
+        self._redo = []
+        self._sizes = {}
+        self._cold = set()
+        self._memory_usage = 0
+        self._lock = threading.Lock()
+        self._replay_lock = threading.Lock()
+        self._store = ColdStore(spill_to_disk)
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="history-freeze"
+        )
+        self.evicted_count = 0
+
+    @property
+    def memory_usage(self):
+        return self._memory_usage
+
+    @property
+    def can_undo(self):
+        return bool(self._undo)
+
+    @property
+    def can_redo(self):
+        return bool(self._redo)
+
+    def __len__(self):
+        return len(self._undo) + len(self._redo)
+
+    def set_budget(self, budget_bytes):
+        self.budget_bytes = budget_bytes
+        self._enforce_budget()
+
+    def clear(self):
+        with self._lock:
+            self._undo.clear()
+            self._redo.clear()
+            self._sizes.clear()
+            self._cold.clear()
+            self._memory_usage = 0
+        self._store = ColdStore(self.spill_to_disk)
+
+    def push(self, action):
+        for redo_action in self._redo:
+            self._forget(redo_action)
+        self._redo.clear()
+        self._track(action)
+        self._undo.append(action)
+        self._enforce_budget()
+        self._schedule_freeze()
+
+    def undo(self, app):
+        action = self._undo.pop()
+        self._cold.discard(id(action))
+        with self._replay_lock:
+            action.undo(app)
+        self._redo.append(action)
+        self._update_size(action)
+        return action
+
+    def redo(self, app):
+        action = self._redo.pop()
+        self._cold.discard(id(action))
+        with self._replay_lock:
+            action.redo(app)
+        self._undo.append(action)
+        self._update_size(action)
+        return action
+
+    def _track(self, action):
+        size = action.byte_size()
+        with self._lock:
+            self._sizes[id(action)] = size
+            self._memory_usage += size
+
+    def _forget(self, action):
+        with self._lock:
+            self._memory_usage -= self._sizes.pop(id(action), 0)
+            self._cold.discard(id(action))
+
+    def _update_size(self, action):
+        size = action.byte_size()
+        with self._lock:
+            if id(action) in self._sizes:
+                self._memory_usage += size - self._sizes[id(action)]
+                self._sizes[id(action)] = size
+
+    def _enforce_budget(self):
+        while self._memory_usage > self.budget_bytes and len(self._undo) > 1:
+            self._forget(self._undo.popleft())
+            self.evicted_count += 1
+
+    def _schedule_freeze(self):
+        for depth in range(self.hot_depth + 1, len(self._undo) + 1):
+            action = self._undo[-depth]
+            if id(action) in self._cold:
+                break
+            self._cold.add(id(action))
+            self._executor.submit(self._freeze, action, self._store)
+
+    def _freeze(self, action, store):
+        with self._replay_lock:
+            action.freeze(store, list(self._live_layers()))
+        self._update_size(action)
@@ -0,0 +1,25 @@
+from PIL import Image
+
+from layer_buffer import LayerBuffer, TILE_SIZE
+
+BAND_ROWS = TILE_SIZE * 8
+
+
+def read_image_buffer(filename):
+    with Image.open(filename) as img:
+        img.load()
+        return LayerBuffer.from_rgba_rows(img.width, img.height, rgba_bands(img))
+
+
+def rgba_bands(img, band_rows=BAND_ROWS):
+    """Yield ``(y0, rgba_bytes)`` for consecutive bands of ``band_rows`` rows.
+
+    ``img`` is decoded in full first; only the conversion to RGBA is banded,
+    so importing a large image never holds a full-size RGBA copy next to the
+    decoded source.
+    """
+    for y0 in range(0, img.height, band_rows):
+        band = img.crop((0, y0, img.width, min(y0 + band_rows, img.height)))
+        if band.mode != "RGBA":
+            band = band.convert("RGBA")
+        yield y0, band.tobytes()
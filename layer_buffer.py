@@ -0,0 +1,247 @@
+import struct
+import threading
+
+import numpy as np
+
+import canvas_cython_helpers
+
+TILE_SIZE = canvas_cython_helpers.TILE_SIZE
+_HEADER = struct.Struct("<III")
+# Snapshots may be released on worker threads, so tile reference counts are
+# only changed under this lock.
+_REFS_LOCK = threading.Lock()
+
+
+class _Tile:
+    __slots__ = ("pixels", "refs")
+
+    def __init__(self, pixels):
+        self.pixels = pixels
+        self.refs = 1
+
+
+def _sampled_tiles(start, stop, step):
+    if step <= TILE_SIZE:
+        return range(start // TILE_SIZE, (stop - 1) // TILE_SIZE + 1)
+    return {x // TILE_SIZE for x in range(start, stop, step)}
+
+
+class LayerBuffer:
+    """Sparse, tiled RGBA pixel storage for one layer.
+
+    The layer is split into ``TILE_SIZE`` square tiles of ``uint8[T, T, 4]``
+    that are only allocated once something is painted into them. A pixel with
+    alpha 0 is empty and is always stored as ``(0, 0, 0, 0)``.
+
+    Tiles are shared copy-on-write: :meth:`copy` hands the same tiles to the
+    new buffer and bumps their reference count, and whichever buffer writes a
+    shared tile first gets its own private copy.
+
+    ``tile_table`` holds the data address of every allocated tile (0 for
+    empty ones) and ``tile_owned`` flags tiles this buffer may write in place.
+    Both are updated in place so Cython kernels can keep pointers to them.
+
+    Tiles can also be lazy: a ``(source, digest)`` reference into a project
+    file that is decoded the first time the tile is read or written. Kernels
+    load the lazy tiles of the region they are about to touch.
+    """
+
+    def __init__(self, width, height):
+        self._width, self._height = width, height
+        self.tiles_x = -(-width // TILE_SIZE)
+        self.tiles_y = -(-height // TILE_SIZE)
+        self._tiles = {}
+        self._lazy = {}
+        self.tile_table = np.zeros((self.tiles_y, self.tiles_x), dtype=np.uintp)
+        self.tile_owned = np.zeros((self.tiles_y, self.tiles_x), dtype=np.uint8)
+
+    @classmethod
+    def from_rgba_rows(cls, width, height, bands):
+        buffer = cls(width, height)
+        for y0, data in bands:
+            buffer._fill_rows(y0, data)
+        return buffer
+
+    def _fill_rows(self, y0, data):
+        rgba = np.frombuffer(data, dtype=np.uint8).reshape(-1, self._width, 4)
+        y1 = min(y0 + len(rgba), self._height)
+        for ty in range(y0 // TILE_SIZE, -(-y1 // TILE_SIZE)):
+            row0 = max(y0, ty * TILE_SIZE)
+            row1 = min(y1, (ty + 1) * TILE_SIZE)
+            band = rgba[row0 - y0 : row1 - y0]
+            for tx in range(self.tiles_x):
+                x0 = tx * TILE_SIZE
+                block = band[:, x0 : x0 + TILE_SIZE]
+                if not block[..., 3].any():
+                    continue
+                pixels = self.writable_tile(tx, ty)[
+                    row0 - ty * TILE_SIZE : row1 - ty * TILE_SIZE, : block.shape[1]
+                ]
+                pixels[:] = block
+                pixels[pixels[..., 3] == 0] = 0
+
+    @classmethod
+    def deserialize(cls, data):
+        width, height, count = _HEADER.unpack_from(data)
+        buffer = cls(width, height)
+        offset = _HEADER.size
+        keys = np.frombuffer(data, dtype=np.int32, count=count * 2, offset=offset)
+        offset += keys.nbytes
+        tiles = np.frombuffer(data, dtype=np.uint8, offset=offset).reshape(
+            count, TILE_SIZE, TILE_SIZE, 4
+        )
+        for (tx, ty), pixels in zip(keys.reshape(-1, 2).tolist(), tiles):
+            buffer.writable_tile(tx, ty)[:] = pixels
+        return buffer
+
+    def serialize(self):
+        self.load_tiles()
+        keys = sorted(self._tiles)
+        return b"".join(
+            [
+                _HEADER.pack(self._width, self._height, len(keys)),
+                np.array(keys, dtype=np.int32).tobytes(),
+            ]
+            + [self._tiles[key].pixels.tobytes() for key in keys]
+        )
+
+    @property
+    def width(self):
+        return self._width
+
+    @property
+    def height(self):
+        return self._height
+
+    def __del__(self):
+        self.release()
+
+    def release(self):
+        with _REFS_LOCK:
+            for tile in self._tiles.values():
+                tile.refs -= 1
+        self._tiles = {}
+        self._lazy = {}
+        self.tile_table[:] = 0
+        self.tile_owned[:] = 0
+
+    def contains(self, x, y):
+        return 0 <= x < self._width and 0 <= y < self._height
+
+    def tile_keys(self):
+        if self._lazy:
+            return self._tiles.keys() | self._lazy.keys()
+        return self._tiles.keys()
+
+    def tile_pixels(self, tx, ty):
+        if (tx, ty) in self._lazy:
+            self._load_tile((tx, ty))
+        tile = self._tiles.get((tx, ty))
+        return tile.pixels if tile is not None else None
+
+    @property
+    def has_lazy_tiles(self):
+        return bool(self._lazy)
+
+    def add_lazy_tile(self, tx, ty, source, digest):
+        self._lazy[(tx, ty)] = (source, digest)
+
+    def lazy_tile(self, tx, ty):
+        return self._lazy.get((tx, ty))
+
+    # With a step only the tiles holding every step-th pixel of the region,
+    # counted from its top-left corner, are loaded.
+    def load_tiles(self, region=None, step=1):
+        if region is None:
+            keys = list(self._lazy)
+        else:
+            x0, y0, x1, y1 = region
+            cols = _sampled_tiles(max(0, x0), x1, step)
+            rows = _sampled_tiles(max(0, y0), y1, step)
+            if len(cols) * len(rows) < len(self._lazy):
+                keys = [
+                    (tx, ty) for ty in rows for tx in cols if (tx, ty) in self._lazy
+                ]
+            else:
+                keys = [(tx, ty) for tx, ty in self._lazy if tx in cols and ty in rows]
+        for key in keys:
+            self._load_tile(key)
+
+    def _load_tile(self, key):
+        source, digest = self._lazy.pop(key)
+        tile = _Tile(source.decode(digest))
+        tx, ty = key
+        self._tiles[key] = tile
+        self.tile_table[ty, tx] = tile.pixels.ctypes.data
+        self.tile_owned[ty, tx] = 1
+
+    def writable_tile(self, tx, ty):
+        key = (tx, ty)
+        if key in self._lazy:
+            self._load_tile(key)
+        tile = self._tiles.get(key)
+        if tile is not None and tile.refs == 1:
+            self.tile_owned[ty, tx] = 1
+            return tile.pixels
+
+        if tile is None:
+            tile = _Tile(np.zeros((TILE_SIZE, TILE_SIZE, 4), dtype=np.uint8))
+        else:
+            with _REFS_LOCK:
+                tile.refs -= 1
+            tile = _Tile(tile.pixels.copy())
+        self._tiles[key] = tile
+        self.tile_table[ty, tx] = tile.pixels.ctypes.data
+        self.tile_owned[ty, tx] = 1
+        return tile.pixels
+
+    def drop_empty_tiles(self):
+        for key, tile in list(self._tiles.items()):
+            if not tile.pixels[..., 3].any():
+                tx, ty = key
+                with _REFS_LOCK:
+                    tile.refs -= 1
+                del self._tiles[key]
+                self.tile_table[ty, tx] = 0
+                self.tile_owned[ty, tx] = 0
+
+    @property
+    def nbytes(self):
+        return len(self._tiles) * TILE_SIZE * TILE_SIZE * 4 + self.tile_table.nbytes
+
+    def is_empty(self):
+        if self._lazy:
+            return False
+        return not any(tile.pixels[..., 3].any() for tile in self._tiles.values())
+
+    def copy(self):
+        new_buffer = LayerBuffer(self._width, self._height)
+        with _REFS_LOCK:
+            for tile in self._tiles.values():
+                tile.refs += 1
+        new_buffer._tiles = dict(self._tiles)
+        new_buffer._lazy = dict(self._lazy)
+        new_buffer.tile_table[:] = self.tile_table
+        self.tile_owned[:] = 0
+        return new_buffer
+
+    def resized(self, width, height):
+        self.load_tiles()
+        new_buffer = LayerBuffer(width, height)
+        for (tx, ty), tile in self._tiles.items():
+            if tx >= new_buffer.tiles_x or ty >= new_buffer.tiles_y:
+                continue
+            with _REFS_LOCK:
+                tile.refs += 1
+            new_buffer._tiles[(tx, ty)] = tile
+            new_buffer.tile_table[ty, tx] = self.tile_table[ty, tx]
+
+            keep_w = width - tx * TILE_SIZE
+            keep_h = height - ty * TILE_SIZE
+            if keep_w < TILE_SIZE or keep_h < TILE_SIZE:
+                pixels = new_buffer.writable_tile(tx, ty)
+                pixels[:, keep_w:] = 0
+                pixels[keep_h:, :] = 0
+        self.tile_owned[:] = 0
+        new_buffer.drop_empty_tiles()
+        return new_buffer
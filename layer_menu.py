@@ -1,8 +1,8 @@
+import threading
 import tkinter as tk
 from tkinter import ttk, messagebox
-import copy
-
 from utilities import validate_int_entry, sanitize_int_input, handle_slider_click
+from layer_buffer import LayerBuffer
 import canvas_cython_helpers
 from actions import (
     AddLayerAction,
@@ -17,16 +17,53 @@ from actions import (
 class Layer:
     _counter = 1
 
-    def __init__(self, name=None):
+    def __init__(self, width, height, name=None):
         if name is None:
             self.name = f"Layer {Layer ._counter }"
             Layer._counter += 1
         else:
             self.name = name
-        self.pixel_data = {}
+        self._buffer = LayerBuffer(width, height)
+        self._frozen = None
+        self._lock = threading.Lock()
         self.visible = True
         self.opacity = 255
 
+    @property
+    def buffer(self):
+        with self._lock:
+            if self._frozen is not None:
+                self._buffer = LayerBuffer.deserialize(self._frozen.load())
+                self._frozen = None
+            return self._buffer
+
+    @buffer.setter
+    def buffer(self, value):
+        with self._lock:
+            self._buffer, self._frozen = value, None
+
+    @property
+    def nbytes(self):
+        with self._lock:
+            if self._frozen is not None:
+                return self._frozen.resident_bytes
+            return self._buffer.nbytes
+
+    def freeze(self, store):
+        with self._lock:
+            if self._frozen is None:
+                self._frozen = store.put(self._buffer.serialize())
+                self._buffer = None
+
+    def copy(self, name=None):
+        new_layer = Layer(
+            self.buffer.width, self.buffer.height, self.name if name is None else name
+        )
+        new_layer.buffer = self.buffer.copy()
+        new_layer.visible = self.visible
+        new_layer.opacity = self.opacity
+        return new_layer
+
 
 class LayerPanel(ttk.Frame):
 
@@ -39,7 +76,7 @@ class LayerPanel(ttk.Frame):
         super().__init__(parent)
         self.app = app
         self.layers = []
-        self.active_layer_index = -1
+        self._active_layer_index = -1
 
         self._drag_state = {
             "start_item": None,
@@ -54,6 +91,16 @@ class LayerPanel(ttk.Frame):
         self._setup_ui()
         self.initialize_layers()
 
+    @property
+    def active_layer_index(self):
+        return self._active_layer_index
+
+    @active_layer_index.setter
+    def active_layer_index(self, value):
+        if value != self._active_layer_index:
+            self.app.pixel_canvas.clear_layer_focus()
+        self._active_layer_index = value
+
     @property
     def active_layer(self):
         if not self.layers or not (0 <= self.active_layer_index < len(self.layers)):
@@ -178,6 +225,7 @@ class LayerPanel(ttk.Frame):
         emoji = self.VISIBLE_EMOJI if layer.visible else self.INVISIBLE_EMOJI
         self.tree.set(item_id, column="vis", value=emoji)
         self.app.pixel_canvas.force_redraw()
+        self.app.layer_properties_changed()
 
     def _on_drag_start(self, event):
         region = self.tree.identify_region(event.x, event.y)
@@ -311,7 +359,7 @@ class LayerPanel(ttk.Frame):
         self.app.pixel_canvas.force_redraw()
 
     def add_layer(self, name=None, select=False, add_to_history=True):
-        new_layer = Layer(name)
+        new_layer = Layer(self.app.canvas_width, self.app.canvas_height, name)
         prev_idx = self.active_layer_index
         insert_pos = prev_idx + 1 if prev_idx != -1 else 0
         self.layers.insert(insert_pos, new_layer)
@@ -372,63 +420,35 @@ class LayerPanel(ttk.Frame):
         if idx <= 0:
             return
 
-        upper_orig = copy.deepcopy(self.layers[idx])
-        lower_orig = copy.deepcopy(self.layers[idx - 1])
+        upper_orig = self.layers[idx].copy()
+        lower_orig = self.layers[idx - 1].copy()
 
         upper = self.layers[idx]
         lower = self.layers[idx - 1]
 
-        merged_data = self._merge_pixel_data(lower, upper)
+        merged_buffer = lower.buffer.copy()
+        canvas_cython_helpers.merge_layer_pixels_cy(
+            merged_buffer,
+            lower.opacity,
+            upper.buffer,
+            upper.opacity,
+            self.app.color_blending_var.get(),
+        )
 
-        lower.pixel_data = merged_data
+        merged_buffer.drop_empty_tiles()
+        lower.buffer = merged_buffer
         lower.opacity = 255
 
         self.layers.pop(idx)
         self.active_layer_index = idx - 1
 
-        merged_lower_final = copy.deepcopy(self.layers[idx - 1])
+        merged_lower_final = self.layers[idx - 1].copy()
         action = MergeLayerAction(upper_orig, lower_orig, merged_lower_final, idx)
         self.app.add_action(action)
 
         self.app.pixel_canvas.force_redraw()
         self.update_ui()
 
-    def _merge_pixel_data(self, lower, upper):
-
-        merged_data = {}
-        lower_opacity_factor = lower.opacity / 255.0
-
-        for coord, (hex_val, alpha) in lower.pixel_data.items():
-            baked_alpha = int(alpha * lower_opacity_factor)
-            if baked_alpha > 0:
-                merged_data[coord] = (hex_val, baked_alpha)
-
-        upper_opacity_factor = upper.opacity / 255.0
-        for coord, (upper_hex, upper_alpha) in upper.pixel_data.items():
-            effective_alpha = int(upper_alpha * upper_opacity_factor)
-            if effective_alpha == 0:
-                continue
-
-            bg_pixel = merged_data.get(coord)
-            final_hex, final_alpha = upper_hex, effective_alpha
-
-            if (
-                self.app.color_blending_var.get()
-                and 0 < effective_alpha < 255
-                and bg_pixel
-            ):
-                bg_hex, bg_a_int = bg_pixel
-                final_hex, final_alpha = canvas_cython_helpers.blend_colors_cy(
-                    upper_hex, effective_alpha, bg_hex, bg_a_int
-                )
-
-            if final_alpha > 0:
-                merged_data[coord] = (final_hex, final_alpha)
-            elif coord in merged_data:
-                del merged_data[coord]
-
-        return merged_data
-
     def duplicate_layer(self):
         if not self.active_layer:
             return
@@ -437,10 +457,7 @@ class LayerPanel(ttk.Frame):
         prev_idx = self.active_layer_index
         insert_pos = prev_idx + 1
 
-        new_layer = Layer(name=f"{orig_layer .name } copy")
-        new_layer.pixel_data = copy.deepcopy(orig_layer.pixel_data)
-        new_layer.visible = orig_layer.visible
-        new_layer.opacity = orig_layer.opacity
+        new_layer = orig_layer.copy(name=f"{orig_layer .name } copy")
 
         action = DuplicateLayerAction(new_layer, insert_pos, prev_idx)
         action.redo(self.app)
@@ -492,6 +509,10 @@ class LayerMenu(tk.Toplevel):
         self._position_menu(x, y)
         self._setup_bindings()
 
+    def destroy(self):
+        self.app.pixel_canvas.clear_layer_focus()
+        super().destroy()
+
     def _setup_styles(self):
 
         self.style = ttk.Style()
@@ -616,7 +637,8 @@ class LayerMenu(tk.Toplevel):
             self.opacity_entry.insert(0, str(val))
         if self.target_layer.opacity != val:
             self.target_layer.opacity = val
-            self.app.pixel_canvas.force_redraw()
+            self.app.pixel_canvas.redraw_layer_opacity(self.target_layer)
+            self.app.layer_properties_changed()
 
     def _on_entry_change(self, event):
 
@@ -637,7 +659,8 @@ class LayerMenu(tk.Toplevel):
             self.opacity_var.set(val)
             if self.target_layer.opacity != val:
                 self.target_layer.opacity = val
-                self.app.pixel_canvas.force_redraw()
+                self.app.pixel_canvas.redraw_layer_opacity(self.target_layer)
+                self.app.layer_properties_changed()
 
     def _on_entry_focus_out(self, event):
 
@@ -653,7 +676,8 @@ class LayerMenu(tk.Toplevel):
                 self.opacity_var.set(val)
                 if self.target_layer.opacity != val:
                     self.target_layer.opacity = val
-                    self.app.pixel_canvas.force_redraw()
+                    self.app.pixel_canvas.redraw_layer_opacity(self.target_layer)
+                    self.app.layer_properties_changed()
 
     def _cmd_merge_down(self):
         self.layer_panel.merge_layer_down()
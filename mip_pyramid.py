@@ -0,0 +1,36 @@
+MIP_LEVELS = 4
+
+
+class MipPyramid:
+    """Half-size copies of the composited art for zoomed-out views.
+
+    Level 0 is the full-resolution image itself; each further level is the
+    previous one box-filtered down by two with ``Image.reduce``. After a
+    region of level 0 changes, :meth:`update` re-reduces only the matching
+    region of every level.
+    """
+
+    def __init__(self):
+        self.levels = []
+
+    def rebuild(self, image):
+        self.levels = [image]
+        for _ in range(1, MIP_LEVELS):
+            self.levels.append(self.levels[-1].reduce(2))
+
+    def update(self, rect):
+        x0, y0, x1, y1 = rect
+        for level in range(1, len(self.levels)):
+            source = self.levels[level - 1]
+            x0, y0 = x0 & ~1, y0 & ~1
+            x1 = min(source.width, x1 + (x1 & 1))
+            y1 = min(source.height, y1 + (y1 & 1))
+            if x0 >= x1 or y0 >= y1:
+                return
+            self.levels[level].paste(
+                source.crop((x0, y0, x1, y1)).reduce(2), (x0 // 2, y0 // 2)
+            )
+            x0, y0, x1, y1 = x0 // 2, y0 // 2, -(-x1 // 2), -(-y1 // 2)
+
+    def level(self, index):
+        return self.levels[index]
@@ -1,6 +1,5 @@
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
-from PIL import Image
 from pathlib import Path
 import os
 import math
@@ -9,11 +8,31 @@ import copy
 from tkinterdnd2 import DND_FILES, TkinterDnD
 from color_wheel_picker import ColorWheelPicker
 from pixel_canvas import PixelCanvas
-from utilities import hex_to_rgb, rgb_to_hex, handle_slider_click
-import canvas_cython_helpers
+from actions import DAMAGE_NONE, DAMAGE_PIXELS
+from autosave import Autosave
+from history import History
+from background_save import BackgroundSaver, write_png
+from image_import import read_image_buffer
+from project_file import (
+    PROJECT_EXTENSION,
+    ChunkCache,
+    load_project,
+    save_project,
+    snapshot_layers,
+)
+from utilities import (
+    rgb_to_hex,
+    unpack_rgba,
+    hex_to_packed,
+    packed_to_hex,
+    handle_slider_click,
+)
 
 
-from layer_menu import LayerPanel
+from layer_menu import Layer, LayerPanel
+
+
+AUTOSAVE_INTERVAL_MS = 5 * 60 * 1000
 
 
 class PixelArtApp:
@@ -29,17 +48,23 @@ class PixelArtApp:
             print(f"Warning: Could not set application icon: {e }")
 
         self.canvas_width, self.canvas_height = 100, 100
-        self.canvas_bg_color = "#FFFFFF"
-        self.pixel_size, self.min_pixel_size, self.max_pixel_size = 5, 1, 60
+        self.canvas_bg_color = 0xFFFFFFFF
+        self.pixel_size, self.min_pixel_size, self.max_pixel_size = 5, 0.125, 60
         self.brush_size = 1
         self.zoom_factor = 1.2
         self.grid_color = "#cccccc"
-        self.current_color, self.current_alpha = "#000000", 255
+        self.current_color = 0x000000FF
         self.current_tool, self.last_used_tool = "pencil", "pencil"
         self.eyedropper_mode = False
         self.current_filename = None
 
-        self.undo_stack, self.redo_stack = [], []
+        self.history = History(live_layers=lambda: self.layers)
+        self.autosave = Autosave()
+        self.saver = BackgroundSaver(self.root)
+        self.save_failed = False
+        self.closing = False
+        self.project_chunks = ChunkCache()
+        self.project_source = None
 
         self.last_known_width = 0
         self.last_known_height = 0
@@ -81,6 +106,7 @@ class PixelArtApp:
         self._update_color_picker_from_app_state()
         self._update_history_controls()
         self._update_save_background_menu_state()
+        self._start_autosave()
 
     @property
     def layers(self):
@@ -103,8 +129,8 @@ class PixelArtApp:
         return self.layer_panel.active_layer
 
     @property
-    def active_layer_data(self):
-        return self.active_layer.pixel_data if self.active_layer else {}
+    def active_layer_buffer(self):
+        return self.active_layer.buffer if self.active_layer else None
 
     def setup_menu(self):
         menubar = tk.Menu(self.root)
@@ -122,6 +148,9 @@ class PixelArtApp:
         file_menu.add_command(
             label="Save", command=self.save_file, accelerator="Ctrl+S"
         )
+        file_menu.add_command(
+            label="Save Project As...", command=self.save_project_as
+        )
         file_menu.add_command(
             label="Export As...", command=self.export_png, accelerator="Ctrl+Shift+S"
         )
@@ -164,16 +193,16 @@ class PixelArtApp:
             ("<Control-o>", self.open_file),
             ("<Control-s>", self.save_file),
             ("<Control-Shift-S>", self.export_png),
-            ("<Control-q>", lambda e: self.root.quit()),
+            ("<Control-q>", self.on_close),
             ("<Control-z>", self.undo),
             ("<Control-y>", self.redo),
         ]:
             self.root.bind(key, lambda e, f=func: f())
 
     def _update_history_controls(self):
-        undo_state, redo_state = (tk.NORMAL if self.undo_stack else tk.DISABLED), (
-            tk.NORMAL if self.redo_stack else tk.DISABLED
-        )
+        undo_state, redo_state = (
+            tk.NORMAL if self.history.can_undo else tk.DISABLED
+        ), (tk.NORMAL if self.history.can_redo else tk.DISABLED)
         if hasattr(self, "undo_button"):
             self.undo_button.config(state=undo_state)
             self.redo_button.config(state=redo_state)
@@ -186,35 +215,88 @@ class PixelArtApp:
             self.canvas_menu.entryconfig("    Save Background", state=tk.DISABLED)
 
     def _clear_history(self):
-        self.undo_stack.clear()
-        self.redo_stack.clear()
+        self.history.clear()
         self._update_history_controls()
+        self._checkpoint_autosave()
+
+    def _start_autosave(self):
+        try:
+            recovered = self.autosave.recover()
+        except Exception as e:
+            print(f"Warning: Could not read autosave: {e }")
+            recovered = None
+        if recovered is not None and messagebox.askyesno(
+            "Recover",
+            "The app did not close cleanly last time. Recover unsaved work?",
+            parent=self.root,
+        ):
+            self._set_document(*recovered)
+            self.root.title("Pixel Art Drawing App - Recovered")
+        else:
+            self._checkpoint_autosave()
+        self.root.after(AUTOSAVE_INTERVAL_MS, self._on_autosave_timer)
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
+
+    def _checkpoint_autosave(self):
+        self.autosave.checkpoint(
+            self.canvas_width, self.canvas_height, self.active_layer_index, self.layers
+        )
+
+    def _on_autosave_timer(self):
+        if self.autosave.dirty:
+            self._checkpoint_autosave()
+        self.root.after(AUTOSAVE_INTERVAL_MS, self._on_autosave_timer)
+
+    def _record_autosave(self, action, undone=False):
+        self.autosave.record(self.layers, self.active_layer_index, action, undone)
+        if self.autosave.needs_compaction:
+            self._checkpoint_autosave()
+
+    def layer_properties_changed(self):
+        self.autosave.record_layout(self.layers, self.active_layer_index)
+
+    def on_close(self):
+        if self.saver.busy:
+            self.root.title("Pixel Art Drawing App - Finishing save...")
+            self.root.update_idletasks()
+            self.save_failed = False
+            self.closing = True
+            self.saver.flush()
+        if not self.save_failed:
+            self.autosave.discard()
+        self.root.destroy()
 
     def add_action(self, action):
-        self.undo_stack.append(action)
-        self.redo_stack.clear()
+        self.history.push(action)
+        self._record_autosave(action)
         self._update_history_controls()
 
     def undo(self, event=None):
-        if not self.undo_stack:
+        if not self.history.can_undo:
             return
-        action = self.undo_stack.pop()
-        action.undo(self)
-        self.redo_stack.append(action)
-        self.pixel_canvas.force_redraw()
-        self.layer_panel.update_ui()
+        self.pixel_canvas.finish_preview_job()
+        action = self.history.undo(self)
+        self._record_autosave(action, undone=True)
+        self._refresh_after_history(action)
         self._update_history_controls()
 
     def redo(self, event=None):
-        if not self.redo_stack:
+        if not self.history.can_redo:
             return
-        action = self.redo_stack.pop()
-        action.redo(self)
-        self.undo_stack.append(action)
-        self.pixel_canvas.force_redraw()
-        self.layer_panel.update_ui()
+        self.pixel_canvas.finish_preview_job()
+        action = self.history.redo(self)
+        self._record_autosave(action)
+        self._refresh_after_history(action)
         self._update_history_controls()
 
+    def _refresh_after_history(self, action):
+        if action.damage == DAMAGE_PIXELS:
+            self.pixel_canvas.redraw_dirty()
+            return
+        if action.damage != DAMAGE_NONE:
+            self.pixel_canvas.force_redraw()
+        self.layer_panel.update_ui()
+
     def show_resize_dialog(self):
         dialog = tk.Toplevel(self.root)
         dialog.title("Resize Canvas")
@@ -252,11 +334,7 @@ class PixelArtApp:
                     ):
                         self.canvas_width, self.canvas_height = new_width, new_height
                         for layer in self.layers:
-                            layer.pixel_data = {
-                                (x, y): data
-                                for (x, y), data in layer.pixel_data.items()
-                                if 0 <= x < new_width and 0 <= y < new_height
-                            }
+                            layer.buffer = layer.buffer.resized(new_width, new_height)
                         self._clear_history()
                         self.create_canvas()
                     dialog.destroy()
@@ -300,7 +378,7 @@ class PixelArtApp:
         if not self.show_canvas_background_var.get():
             canvas.config(bg="#C0C0C0")
             return
-        r, g, b = hex_to_rgb(self.canvas_bg_color)
+        r, g, b, _ = unpack_rgba(self.canvas_bg_color)
         gs = int(r * 0.299 + g * 0.587 + b * 0.114)
         new_gs = max(0, min(255, gs - 32 if gs >= 128 else gs + 32))
         canvas.config(bg=rgb_to_hex(new_gs, new_gs, new_gs))
@@ -429,7 +507,7 @@ class PixelArtApp:
     def handle_drop(self, event):
         filepath = event.data.strip("{}")
         if filepath.lower().endswith(
-            (".png", ".jpg", ".jpeg", ".gif", ".bmp")
+            (PROJECT_EXTENSION, ".png", ".jpg", ".jpeg", ".gif", ".bmp")
         ) and messagebox.askyesno(
             "Open Dropped File",
             "Open this image? Unsaved changes will be lost.",
@@ -445,14 +523,13 @@ class PixelArtApp:
         return {
             "tool": self.tool_var.get(),
             "color": self.current_color,
-            "alpha": self.current_alpha,
             "brush_size": self.brush_size_var.get(),
             "shape_type": self.shape_type_var.get(),
             "fill_shape": self.fill_shape_var.get(),
             "lock_aspect": is_aspect_locked
             and (str(self.lock_aspect_checkbox.cget("state")) == "normal"),
             "active_layer": self.active_layer,
-            "active_layer_data": self.active_layer_data,
+            "active_layer_buffer": self.active_layer_buffer,
             "active_layer_index": self.active_layer_index,
         }
 
@@ -487,15 +564,15 @@ class PixelArtApp:
         ):
             self.pixel_canvas.draw(self.last_mouse_event, self._get_tool_options())
 
-    def _handle_eyedropper_pick(self, color, alpha):
-        self.current_color, self.current_alpha = color, alpha
+    def _handle_eyedropper_pick(self, color):
+        self.current_color = color
         self._update_color_picker_from_app_state()
 
     def _on_color_wheel_change(self, new_hex_color, new_alpha):
         if self.current_tool == "eraser":
             self.tool_var.set(self.last_used_tool)
             self.change_tool()
-        self.current_color, self.current_alpha = new_hex_color, new_alpha
+        self.current_color = hex_to_packed(new_hex_color, new_alpha)
 
     def on_brush_size_change(self, value):
         self.brush_size_label.config(text=f"{self .brush_size_var .get ()}")
@@ -527,7 +604,9 @@ class PixelArtApp:
     def _update_color_picker_from_app_state(self):
         if hasattr(self, "color_wheel"):
             self.color_wheel.set_color(
-                self.current_color, self.current_alpha, run_callback=False
+                packed_to_hex(self.current_color),
+                self.current_color & 0xFF,
+                run_callback=False,
             )
 
     def create_canvas(self):
@@ -580,22 +659,22 @@ class PixelArtApp:
 
         main_frame = ttk.Frame(dialog, padding=15)
         main_frame.pack(fill=tk.BOTH, expand=True)
-        state = {"hex": self.canvas_bg_color}
+        state = {"color": self.canvas_bg_color}
 
         def on_dialog_color_change(new_hex, _):
-            state["hex"] = new_hex
+            state["color"] = hex_to_packed(new_hex)
 
         color_wheel = ColorWheelPicker(
             main_frame, on_dialog_color_change, show_alpha=False, show_preview=True
         )
-        color_wheel.set_color(self.canvas_bg_color)
+        color_wheel.set_color(packed_to_hex(self.canvas_bg_color))
         color_wheel.pack()
         button_frame = ttk.Frame(main_frame)
         button_frame.pack(side=tk.BOTTOM, pady=(15, 0))
 
         def apply_choice():
-            if self.canvas_bg_color != state["hex"]:
-                self.canvas_bg_color = state["hex"]
+            if self.canvas_bg_color != state["color"]:
+                self.canvas_bg_color = state["color"]
                 self._update_canvas_workarea_color()
                 if self.show_canvas_background_var.get():
                     self.pixel_canvas.force_redraw()
@@ -623,14 +702,15 @@ class PixelArtApp:
 
     def new_canvas(self):
         if any(
-            layer.pixel_data for layer in self.layers
+            not layer.buffer.is_empty() for layer in self.layers
         ) and not messagebox.askokcancel(
             "New", "Clear canvas? Unsaved changes may be lost."
         ):
             return
         self.layer_panel.initialize_layers()
         self.current_filename = None
-        self.canvas_bg_color = "#FFFFFF"
+        self.project_source = None
+        self.canvas_bg_color = 0xFFFFFFFF
         self.root.title("Pixel Art Drawing App")
         self._update_canvas_workarea_color()
         self._clear_history()
@@ -639,51 +719,127 @@ class PixelArtApp:
 
     def open_file(self):
         if any(
-            layer.pixel_data for layer in self.layers
+            not layer.buffer.is_empty() for layer in self.layers
         ) and not messagebox.askokcancel(
             "Open", "Clear canvas? Unsaved changes may be lost."
         ):
             return
         if filename := filedialog.askopenfilename(
-            title="Open PNG", filetypes=[("PNG", "*.png"), ("All", "*.*")]
+            title="Open",
+            filetypes=[
+                ("Pixel Art Project", f"*{PROJECT_EXTENSION }"),
+                ("PNG", "*.png"),
+                ("All", "*.*"),
+            ],
         ):
             self._load_image_from_path(filename)
 
     def _load_image_from_path(self, filename):
+        if filename.lower().endswith(PROJECT_EXTENSION):
+            self._load_project_from_path(filename)
+            return
         try:
-            with Image.open(filename) as img:
-                img = img.convert("RGBA")
-                old_w, old_h = self.canvas_width, self.canvas_height
-                self.canvas_width, self.canvas_height = img.width, img.height
-
-                self.layer_panel.initialize_layers()
-                self.layers[0].name = os.path.basename(filename)
-
-                rgba_data = img.tobytes()
-                self.layers[0].pixel_data = canvas_cython_helpers.process_image_data_cy(
-                    rgba_data, img.width, img.height
-                )
-                self._clear_history()
-                self.create_canvas()
-                self.layer_panel.update_ui()
-                self.current_filename = filename
-                self.root.title(
-                    f"Pixel Art Drawing App - {os .path .basename (filename )}"
+            buffer = read_image_buffer(filename)
+            old_w, old_h = self.canvas_width, self.canvas_height
+            self.canvas_width, self.canvas_height = buffer.width, buffer.height
+
+            self.layer_panel.initialize_layers()
+            self.layers[0].name = os.path.basename(filename)
+            self.layers[0].buffer = buffer
+            self.project_source = None
+            self._clear_history()
+            self.create_canvas()
+            self.layer_panel.update_ui()
+            self.current_filename = filename
+            self.root.title(
+                f"Pixel Art Drawing App - {os .path .basename (filename )}"
+            )
+            if (old_w, old_h) != (self.canvas_width, self.canvas_height):
+                messagebox.showinfo(
+                    "Canvas Resized",
+                    f"Canvas resized to {self .canvas_width }x{self .canvas_height } to fit image.",
+                    parent=self.root,
                 )
-                if (old_w, old_h) != (self.canvas_width, self.canvas_height):
-                    messagebox.showinfo(
-                        "Canvas Resized",
-                        f"Canvas resized to {self .canvas_width }x{self .canvas_height } to fit image.",
-                        parent=self.root,
-                    )
         except Exception as e:
             messagebox.showerror("Error", f"Failed to open: {e }")
 
+    def _load_project_from_path(self, filename):
+        try:
+            width, height, active_index, layer_states, source = load_project(
+                filename, self.project_chunks
+            )
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to open: {e }")
+            return
+
+        old_w, old_h = self.canvas_width, self.canvas_height
+        self._set_document(width, height, active_index, layer_states)
+        self.project_source = source
+        self.current_filename = filename
+        self.root.title(f"Pixel Art Drawing App - {os .path .basename (filename )}")
+        if (old_w, old_h) != (self.canvas_width, self.canvas_height):
+            messagebox.showinfo(
+                "Canvas Resized",
+                f"Canvas resized to {self .canvas_width }x{self .canvas_height } to fit project.",
+                parent=self.root,
+            )
+
+    def _set_document(self, width, height, active_index, layer_states):
+        self.canvas_width, self.canvas_height = width, height
+        layers = []
+        for state in layer_states:
+            layer = Layer(width, height, state["name"])
+            layer.buffer = state["buffer"]
+            layer.visible = state["visible"]
+            layer.opacity = state["opacity"]
+            layers.append(layer)
+        Layer._counter = len(layers) + 1
+        self.layers = layers
+        self.active_layer_index = min(max(active_index, 0), len(layers) - 1)
+
+        self._clear_history()
+        self.create_canvas()
+        self.layer_panel.update_ui()
+
     def save_file(self):
-        (
+        if not self.current_filename:
+            self.save_project_as()
+        elif self.current_filename.lower().endswith(PROJECT_EXTENSION):
+            self.save_project_to(self.current_filename)
+        else:
             self.export_to_png(self.current_filename)
-            if self.current_filename
-            else self.export_png()
+
+    def save_project_as(self):
+        if filename := filedialog.asksaveasfilename(
+            title="Save Project As",
+            defaultextension=PROJECT_EXTENSION,
+            filetypes=[("Pixel Art Project", f"*{PROJECT_EXTENSION }")],
+        ):
+            self.save_project_to(filename)
+
+    def save_project_to(self, filename):
+        if (
+            self.project_source is not None
+            and os.path.abspath(filename) == self.project_source.filename
+        ):
+            self.project_source.detach()
+        layer_states = snapshot_layers(self.layers)
+        width, height = self.canvas_width, self.canvas_height
+        active_index = self.active_layer_index
+        self.saver.save(
+            filename,
+            lambda progress: save_project(
+                filename,
+                width,
+                height,
+                active_index,
+                layer_states,
+                self.project_chunks,
+                progress,
+            ),
+            [state["buffer"] for state in layer_states],
+            lambda fraction: self._on_save_progress(filename, fraction),
+            lambda error: self._on_save_done(filename, error),
         )
 
     def export_png(self):
@@ -693,44 +849,55 @@ class PixelArtApp:
             self.export_to_png(filename)
 
     def export_to_png(self, filename):
-        try:
-            img = Image.new(
-                "RGBA",
-                (self.canvas_width, self.canvas_height),
-                (
-                    hex_to_rgb(self.canvas_bg_color) + (255,)
-                    if self.show_canvas_background_var.get()
-                    and self.save_background_var.get()
-                    else (0, 0, 0, 0)
-                ),
-            )
-            for layer in self.layers:
-                if not layer.visible:
-                    continue
-                layer_img = Image.new(
-                    "RGBA", (self.canvas_width, self.canvas_height), (0, 0, 0, 0)
-                )
-                layer_opacity_factor = layer.opacity / 255.0
-
-                for (x, y), (h, a) in layer.pixel_data.items():
-                    if h != "transparent" and a > 0:
-
-                        final_a = int(a * layer_opacity_factor)
-                        if final_a > 0:
-                            layer_img.putpixel((x, y), hex_to_rgb(h) + (final_a,))
-
-                img = Image.alpha_composite(img, layer_img)
-            img.save(filename, "PNG")
-            if filename == self.current_filename or self.current_filename is None:
-                self.current_filename = filename
-                self.root.title(
-                    f"Pixel Art Drawing App - {os .path .basename (filename )}"
-                )
-            messagebox.showinfo(
-                "Saved", f"Image saved to {filename }", parent=self.root
-            )
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to save: {e }")
+        bg_color = (
+            self.canvas_bg_color | 0xFF
+            if self.show_canvas_background_var.get() and self.save_background_var.get()
+            else 0
+        )
+        snapshot = [
+            (layer.buffer.copy(), layer.opacity)
+            for layer in self.layers
+            if layer.visible
+        ]
+        width, height = self.canvas_width, self.canvas_height
+        self.saver.save(
+            filename,
+            lambda progress: write_png(
+                filename, width, height, snapshot, bg_color, progress
+            ),
+            [buffer for buffer, _ in snapshot],
+            lambda fraction: self._on_save_progress(filename, fraction),
+            lambda error: self._on_save_done(filename, error),
+        )
+
+    def _on_save_progress(self, filename, fraction):
+        self.root.title(
+            f"Pixel Art Drawing App - {os .path .basename (filename )} (saving {fraction :.0%})"
+        )
+
+    def _on_save_done(self, filename, error):
+        self.save_failed = error is not None
+        is_project = filename.lower().endswith(PROJECT_EXTENSION)
+        # project_source stays on the file the lazy tiles read from, which may
+        # differ from current_filename after Save Project As.
+        if error is None and (
+            is_project
+            or filename == self.current_filename
+            or self.current_filename is None
+        ):
+            self.current_filename = filename
+        self.root.title(
+            f"Pixel Art Drawing App - {os .path .basename (self .current_filename )}"
+            if self.current_filename
+            else "Pixel Art Drawing App"
+        )
+        if error is not None:
+            messagebox.showerror("Error", f"Failed to save: {error }")
+            return
+        if self.closing:
+            return
+        kind = "Project" if is_project else "Image"
+        messagebox.showinfo("Saved", f"{kind } saved to {filename }", parent=self.root)
 
 
 def main():
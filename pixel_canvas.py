@@ -1,11 +1,22 @@
 import tkinter as tk
 from tkinter import ttk
-from PIL import Image, ImageTk, ImageDraw
+from PIL import Image, ImageDraw
 import math
+import time
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import functools
 
+import numpy as np
+
 from actions import PixelAction
+from composite_cache import CompositeCache
+from dirty_region import DirtyRegion
+from display_tiles import DisplayTileCache
+from layer_buffer import TILE_SIZE
+from mip_pyramid import MIP_LEVELS, MipPyramid
+from preview_chunks import PreviewChunkPool
+from utilities import packed_to_hex
 
 
 import canvas_cython_helpers
@@ -13,6 +24,10 @@ import canvas_cython_helpers
 
 class PixelCanvas(ttk.Frame):
     CHUNK_SIZE = 32
+    FRAME_INTERVAL_MS = 16
+    PROGRESSIVE_MIN_PIXELS = 1024 * 1024
+    SAMPLED_MAX_PIXELS = 256 * 256
+    REFINE_BUDGET_MS = 10
 
     def __init__(self, master, app_instance, pick_color_callback):
         super().__init__(master)
@@ -24,23 +39,33 @@ class PixelCanvas(ttk.Frame):
         self.mmb_eyedropper_active = False
         self.original_cursor_before_mmb = ""
         self.original_cursor_before_pan = ""
-        self.art_sprite_image, self.art_sprite_canvas_item = None, None
         self._after_id_render, self._after_id_resize = None, None
+        self._next_frame_time = 0.0
 
         self._full_art_image_cache = None
+        self._stale_art = None
+        self._mip = MipPyramid()
         self._force_full_redraw = True
-        self._dirty_bbox = None
+        self._dirty_region = DirtyRegion()
+        self._composite_cache = CompositeCache()
+        self._focus_layer = None
+        self._dirty_layers = set()
 
         self.last_draw_pixel_x, self.last_draw_pixel_y = None, None
         self.stroke_pixels_drawn_this_stroke = set()
         self.start_shape_point, self.preview_shape_item = None, None
 
-        self.preview_chunks = {}
         self.new_preview_pixels = set()
         self._after_id_preview_render = None
         self.PREVIEW_RENDER_INTERVAL_MS = 10
+        self._preview_executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="preview"
+        )
+        self._preview_job = None
 
         self._setup_widgets()
+        self._display_tiles = DisplayTileCache(self.canvas)
+        self.preview_chunks = PreviewChunkPool(self.canvas, self.CHUNK_SIZE)
         self._bind_events()
 
     def _setup_widgets(self):
@@ -132,7 +157,7 @@ class PixelCanvas(ttk.Frame):
 
             new_start = click_ratio - (viewport_ratio / 2)
             view_moveto(new_start)
-            self._update_visible_canvas_image()
+            self.request_render()
 
         return "break"
 
@@ -153,24 +178,53 @@ class PixelCanvas(ttk.Frame):
         self._after_id_resize = self.app.root.after(50, self.rescale_canvas)
 
     def force_redraw(self):
+        self.finish_preview_job()
+        self._force_full_redraw = True
+        self._composite_cache.invalidate()
+        self.rescale_canvas()
+
+    def redraw_dirty(self):
+        self.request_render()
+
+    def request_render(self):
+        if self._after_id_render is None:
+            delay = (self._next_frame_time - time.perf_counter()) * 1000
+            self._after_id_render = self.app.root.after(
+                max(0, round(delay)), self._render_frame
+            )
+
+    def render_now(self):
+        if self._after_id_render:
+            self.app.root.after_cancel(self._after_id_render)
+        self._render_frame()
+
+    def _render_frame(self):
+        self._after_id_render = None
+        self._next_frame_time = time.perf_counter() + self.FRAME_INTERVAL_MS / 1000
+        self._update_visible_canvas_image()
+
+    def mark_layer_dirty(self, layer):
+        self._dirty_layers.add(layer)
+
+    def redraw_layer_opacity(self, layer):
+        self._focus_layer = layer
         self._force_full_redraw = True
         self.rescale_canvas()
 
+    def clear_layer_focus(self):
+        self._focus_layer = None
+
     def create_canvas(self):
         self.canvas.delete("all")
-        self.art_sprite_image = self._full_art_image_cache = None
+        self._display_tiles.clear()
+        self.finish_preview_job()
+        self.preview_chunks.clear()
+        self._full_art_image_cache = self._stale_art = None
         self._force_full_redraw = True
-        self._dirty_bbox = None
-        self.art_sprite_canvas_item = self.canvas.create_image(
-            0, 0, anchor="nw", tags="art_sprite"
-        )
-        for _ in range(self.app.canvas_height - 1):
-            self.canvas.create_line(0, 0, 0, 0, fill=self.app.grid_color, tags="grid_h")
-        for _ in range(self.app.canvas_width - 1):
-            self.canvas.create_line(0, 0, 0, 0, fill=self.app.grid_color, tags="grid_v")
+        self._dirty_region.clear()
+        self._composite_cache.invalidate()
+        self._dirty_layers.clear()
         self.rescale_canvas()
-        self.canvas.tag_raise("grid_h", "art_sprite")
-        self.canvas.tag_raise("grid_v", "art_sprite")
         self.center_canvas_view()
 
     def center_canvas_view(self):
@@ -191,7 +245,7 @@ class PixelCanvas(ttk.Frame):
         ) / 2
         s_region_str = self.canvas.cget("scrollregion")
         if not s_region_str:
-            self._update_visible_canvas_image()
+            self.request_render()
             return
         try:
             s_x1, s_y1, s_x2, s_y2 = map(float, s_region_str.split())
@@ -202,44 +256,16 @@ class PixelCanvas(ttk.Frame):
                 self.canvas.yview_moveto((target_y - s_y1) / total_scroll_height)
         except (ValueError, IndexError):
             pass
-        self._update_visible_canvas_image()
+        self.request_render()
 
-    def _update_dirty_bbox(self, x, y):
-        if self._dirty_bbox is None:
-            self._dirty_bbox = (x, y, x + 1, y + 1)
-        else:
-            min_x, min_y, max_x, max_y = self._dirty_bbox
-            self._dirty_bbox = (
-                min(min_x, x),
-                min(min_y, y),
-                max(max_x, x + 1),
-                max(max_y, y + 1),
-            )
+    def mark_dirty_indices(self, indices, width):
+        self._dirty_region.add_indices(indices, width)
 
     def _update_canvas_scaling(self):
         total_width, total_height = (
             self.app.canvas_width * self.app.pixel_size,
             self.app.canvas_height * self.app.pixel_size,
         )
-        grid_state = "normal" if self.app.show_grid_var.get() else "hidden"
-        for i, line_id in enumerate(self.canvas.find_withtag("grid_h")):
-            self.canvas.coords(
-                line_id,
-                0,
-                (i + 1) * self.app.pixel_size,
-                total_width,
-                (i + 1) * self.app.pixel_size,
-            )
-            self.canvas.itemconfig(line_id, state=grid_state)
-        for i, line_id in enumerate(self.canvas.find_withtag("grid_v")):
-            self.canvas.coords(
-                line_id,
-                (i + 1) * self.app.pixel_size,
-                0,
-                (i + 1) * self.app.pixel_size,
-                total_height,
-            )
-            self.canvas.itemconfig(line_id, state=grid_state)
         margin = 50
         viewport_width, viewport_height = max(1, self.canvas.winfo_width()), max(
             1, self.canvas.winfo_height()
@@ -258,69 +284,18 @@ class PixelCanvas(ttk.Frame):
 
     def rescale_canvas(self):
         self._update_canvas_scaling()
-        self._update_visible_canvas_image()
+        self.request_render()
 
     def _update_visible_canvas_image(self):
-        if self._after_id_render:
-            self.app.root.after_cancel(self._after_id_render)
-        self._after_id_render = None
-
         viewport_w, viewport_h = self.canvas.winfo_width(), self.canvas.winfo_height()
         if viewport_w <= 1 or viewport_h <= 1:
-            self._after_id_render = self.app.root.after(
-                50, self._update_visible_canvas_image
-            )
+            self._after_id_render = self.app.root.after(50, self._render_frame)
             return
 
-        visible_layers_info = [
-            (layer.pixel_data, layer.opacity)
-            for layer in self.app.layers
-            if layer.visible
-        ]
-        use_bg = self.app.show_canvas_background_var.get()
-        bg_rgb = canvas_cython_helpers.hex_to_rgb_cy(self.app.canvas_bg_color)
-        render_alpha = self.app.render_pixel_alpha_var.get()
-
-        if self._force_full_redraw or self._full_art_image_cache is None:
-
-            image_buffer = canvas_cython_helpers.render_image(
-                self.app.canvas_width,
-                self.app.canvas_height,
-                visible_layers_info,
-                use_bg,
-                bg_rgb,
-                render_alpha,
-            )
-            self._full_art_image_cache = Image.frombytes(
-                "RGBA",
-                (self.app.canvas_width, self.app.canvas_height),
-                bytes(image_buffer),
-            )
-            self._force_full_redraw = False
-            self._dirty_bbox = None
-
-        elif self._dirty_bbox is not None:
-            dirty_w = self._dirty_bbox[2] - self._dirty_bbox[0]
-            dirty_h = self._dirty_bbox[3] - self._dirty_bbox[1]
-            dirty_buffer = canvas_cython_helpers.render_image(
-                self.app.canvas_width,
-                self.app.canvas_height,
-                visible_layers_info,
-                use_bg,
-                bg_rgb,
-                render_alpha,
-                self._dirty_bbox,
-            )
-            dirty_image = Image.frombytes(
-                "RGBA", (dirty_w, dirty_h), bytes(dirty_buffer)
-            )
-            self._full_art_image_cache.paste(
-                dirty_image, (self._dirty_bbox[0], self._dirty_bbox[1])
-            )
-            self._dirty_bbox = None
-
-        if self._full_art_image_cache is None:
-            return
+        cache = self._composite_cache
+        width, height = self.app.canvas_width, self.app.canvas_height
+        self.finish_preview_job()
+        rebuilt = self._prepare_composite()
 
         canvas_x_start, canvas_y_start = self.canvas.canvasx(0), self.canvas.canvasy(0)
         px_start = max(0, math.floor(canvas_x_start / self.app.pixel_size))
@@ -333,40 +308,162 @@ class PixelCanvas(ttk.Frame):
             self.app.canvas_height,
             math.ceil((canvas_y_start + viewport_h) / self.app.pixel_size),
         )
+        view = (px_start, py_start, px_end, py_end)
 
-        if px_start >= px_end or py_start >= py_end:
-            self.canvas.itemconfig(self.art_sprite_canvas_item, image=""),
-            self.art_sprite_image = None
+        if self._force_full_redraw or self._full_art_image_cache is None:
+            # Tiles still lazily referenced from a project file are decoded
+            # as they are refined, never all at once before the first paint.
+            progressive = any(
+                layer.buffer.has_lazy_tiles
+                for layer in self.app.layers
+                if layer.visible
+            ) or (
+                (rebuilt or self._full_art_image_cache is None)
+                and width * height >= self.PROGRESSIVE_MIN_PIXELS
+            )
+            if not progressive:
+                image_buffer = cache.compose((0, 0, width, height))
+                self._full_art_image_cache = Image.frombytes(
+                    "RGBA", (width, height), bytes(image_buffer)
+                )
+                self._stale_art = None
+            else:
+                self._full_art_image_cache = self._sampled_art_image(view)
+                self._stale_art = np.ones(
+                    (-(-height // TILE_SIZE), -(-width // TILE_SIZE)), dtype=bool
+                )
+            self._mip.rebuild(self._full_art_image_cache)
+            self._force_full_redraw = False
+            self._dirty_region.clear()
+            self._display_tiles.invalidate()
+
+        elif self._dirty_region:
+            refresh = not rebuilt and any(
+                layer is not cache.focus_layer for layer in self._dirty_layers
+            )
+            for dirty_rect in self._dirty_region.rects(width, height):
+                if refresh:
+                    cache.refresh_region(dirty_rect)
+                x0, y0, x1, y1 = dirty_rect
+                dirty_image = Image.frombytes(
+                    "RGBA", (x1 - x0, y1 - y0), bytes(cache.compose(dirty_rect))
+                )
+                self._full_art_image_cache.paste(dirty_image, (x0, y0))
+                self._mip.update(dirty_rect)
+                self._display_tiles.invalidate(dirty_rect)
+            self._dirty_region.clear()
+        self._dirty_layers.clear()
+
+        if self._full_art_image_cache is None:
             return
 
-        art_image_cropped = self._full_art_image_cache.crop(
-            (px_start, py_start, px_end, py_end)
+        if self._stale_art is not None:
+            self._refine_art(view)
+        self._display_tiles.set_grid(
+            self.app.grid_color if self.app.show_grid_var.get() else None
+        )
+        level, zoom = 0, self.app.pixel_size
+        if zoom < 1:
+            level = min(MIP_LEVELS - 1, round(math.log2(1 / zoom)))
+            zoom = max(1, round(zoom * (1 << level)))
+        self._display_tiles.show(
+            self._mip.level(level),
+            zoom,
+            (
+                px_start >> level,
+                py_start >> level,
+                -(-max(px_start, px_end) >> level),
+                -(-max(py_start, py_end) >> level),
+            ),
+            level,
         )
-        final_w, final_h = (px_end - px_start) * self.app.pixel_size, (
-            py_end - py_start
-        ) * self.app.pixel_size
 
-        if final_w <= 0 or final_h <= 0:
-            return
+    def _prepare_composite(self):
+        return self._composite_cache.prepare(
+            self.app.layers,
+            self._focus_layer or self.app.active_layer,
+            self.app.canvas_width,
+            self.app.canvas_height,
+            self.app.show_canvas_background_var.get(),
+            self.app.canvas_bg_color,
+            self.app.render_pixel_alpha_var.get(),
+        )
 
-        self.art_sprite_image = ImageTk.PhotoImage(
-            art_image_cropped.resize((final_w, final_h), Image.NEAREST)
+    def _sampled_art_image(self, view):
+        x0, y0, x1, y1 = view
+        width, height = self.app.canvas_width, self.app.canvas_height
+        use_bg = self.app.show_canvas_background_var.get()
+        background = (
+            tuple(self.app.canvas_bg_color.to_bytes(4, "big")[:3]) + (255,)
+            if use_bg
+            else (232, 232, 232, 255)
+        )
+        # Only the viewport is sampled; the rest shows the plain background
+        # until _refine_art reaches it.
+        image = Image.new("RGBA", (width, height), background)
+        if x1 <= x0 or y1 <= y0:
+            return image
+        step = math.ceil(math.sqrt((x1 - x0) * (y1 - y0) / self.SAMPLED_MAX_PIXELS))
+        layers_info = [
+            (layer.buffer, layer.opacity) for layer in self.app.layers if layer.visible
+        ]
+        sampled = canvas_cython_helpers.render_sampled_cy(
+            layers_info,
+            use_bg,
+            self.app.canvas_bg_color,
+            self.app.render_pixel_alpha_var.get(),
+            step,
+            view,
         )
-        self.canvas.itemconfig(self.art_sprite_canvas_item, image=self.art_sprite_image)
-        self.canvas.coords(
-            self.art_sprite_canvas_item,
-            px_start * self.app.pixel_size,
-            py_start * self.app.pixel_size,
+        sampled_image = Image.frombytes(
+            "RGBA", (-(-(x1 - x0) // step), -(-(y1 - y0) // step)), bytes(sampled)
         )
-        self.canvas.tag_lower(self.art_sprite_canvas_item)
+        image.paste(sampled_image.resize((x1 - x0, y1 - y0), Image.NEAREST), (x0, y0))
+        return image
+
+    def _refine_art(self, view):
+        deadline = time.perf_counter() + self.REFINE_BUDGET_MS / 1000
+        stale = self._stale_art
+        width, height = self.app.canvas_width, self.app.canvas_height
+        vx0, vy0 = view[0] // TILE_SIZE, view[1] // TILE_SIZE
+        vx1, vy1 = -(-view[2] // TILE_SIZE), -(-view[3] // TILE_SIZE)
+        rows = [(ty, vx0, vx1) for ty in range(vy0, vy1)]
+        rows += [(ty, 0, stale.shape[1]) for ty in range(stale.shape[0])]
+
+        for ty, tx0, tx1 in rows:
+            cols = np.flatnonzero(stale[ty, tx0:tx1])
+            if not len(cols):
+                continue
+            first, last = tx0 + int(cols[0]), tx0 + int(cols[-1]) + 1
+            rect = (
+                first * TILE_SIZE,
+                ty * TILE_SIZE,
+                min(width, last * TILE_SIZE),
+                min(height, (ty + 1) * TILE_SIZE),
+            )
+            x0, y0, x1, y1 = rect
+            image = Image.frombytes(
+                "RGBA", (x1 - x0, y1 - y0), bytes(self._composite_cache.compose(rect))
+            )
+            self._full_art_image_cache.paste(image, (x0, y0))
+            self._mip.update(rect)
+            self._display_tiles.invalidate(rect)
+            stale[ty, first:last] = False
+            if time.perf_counter() > deadline:
+                break
+
+        if stale.any():
+            self.request_render()
+        else:
+            self._stale_art = None
 
     def on_scroll_y(self, *args):
         self.canvas.yview(*args)
-        self._update_visible_canvas_image()
+        self.request_render()
 
     def on_scroll_x(self, *args):
         self.canvas.xview(*args)
-        self._update_visible_canvas_image()
+        self.request_render()
 
     def on_canvas_scroll(self, event):
         old_pixel_size = self.app.pixel_size
@@ -374,17 +471,26 @@ class PixelCanvas(ttk.Frame):
             event.x
         ), self.canvas.canvasy(event.y)
         zoom_in = event.delta > 0 or event.num == 4
-        new_pixel_size = (
-            self.app.pixel_size + 1
-            if zoom_in and self.app.pixel_size < 3
-            else (
-                self.app.pixel_size * self.app.zoom_factor
-                if zoom_in
-                else self.app.pixel_size / self.app.zoom_factor
+        if zoom_in:
+            new_pixel_size = (
+                old_pixel_size * 2
+                if old_pixel_size < 1
+                else (
+                    old_pixel_size + 1
+                    if old_pixel_size < 3
+                    else old_pixel_size * self.app.zoom_factor
+                )
             )
-        )
+        else:
+            new_pixel_size = (
+                old_pixel_size / 2
+                if old_pixel_size <= 2
+                else old_pixel_size / self.app.zoom_factor
+            )
+        if new_pixel_size >= 1:
+            new_pixel_size = round(new_pixel_size)
         new_pixel_size = max(
-            self.app.min_pixel_size, min(self.app.max_pixel_size, round(new_pixel_size))
+            self.app.min_pixel_size, min(self.app.max_pixel_size, new_pixel_size)
         )
         if new_pixel_size == old_pixel_size:
             return
@@ -405,7 +511,7 @@ class PixelCanvas(ttk.Frame):
         s_region_str = self.canvas.cget("scrollregion")
         if s_region_str:
             try:
-                s_x1, s_y1, s_x2, s_y2 = map(int, s_region_str.split())
+                s_x1, s_y1, s_x2, s_y2 = map(float, s_region_str.split())
                 total_scroll_width, total_scroll_height = s_x2 - s_x1, s_y2 - s_y1
                 if total_scroll_width > 0:
                     self.canvas.xview_moveto(
@@ -421,19 +527,11 @@ class PixelCanvas(ttk.Frame):
         if self.drawing:
             self.app.on_canvas_motion_1(event)
 
-            for (cx, cy), chunk in self.preview_chunks.items():
-                canvas_x = cx * self.CHUNK_SIZE * self.app.pixel_size
-                canvas_y = cy * self.CHUNK_SIZE * self.app.pixel_size
-                self.canvas.coords(chunk["item"], canvas_x, canvas_y)
-
-                final_w = self.CHUNK_SIZE * self.app.pixel_size
-                resized_img = chunk["pil"].resize((final_w, final_w), Image.NEAREST)
-                chunk["photo"] = ImageTk.PhotoImage(resized_img)
-                self.canvas.itemconfig(chunk["item"], image=chunk["photo"])
+            self.preview_chunks.rescale(self.app.pixel_size)
 
         if self.panning:
             self.canvas.scan_mark(event.x, event.y)
-        self._update_visible_canvas_image()
+        self.request_render()
 
     def get_pixel_coords(self, event_x, event_y):
         canvas_x, canvas_y = self.canvas.canvasx(event_x), self.canvas.canvasy(event_y)
@@ -452,8 +550,11 @@ class PixelCanvas(ttk.Frame):
 
     def _render_preview_frame(self):
         self._after_id_preview_render = None
-        if not self.drawing and not self.new_preview_pixels:
-            return
+        if self._preview_job is not None:
+            if not self._preview_job.done():
+                self._schedule_preview_render()
+                return
+            self.finish_preview_job()
 
         if not self.new_preview_pixels:
             return
@@ -462,100 +563,63 @@ class PixelCanvas(ttk.Frame):
 
         tool_opts["color_blending"] = self.app.color_blending_var.get()
 
-        visible_layers_info = [
-            (layer.pixel_data, layer.opacity)
-            for layer in self.app.layers
-            if layer.visible
-        ]
-        use_bg = self.app.show_canvas_background_var.get()
-        bg_rgb = canvas_cython_helpers.hex_to_rgb_cy(self.app.canvas_bg_color)
-        render_alpha = self.app.render_pixel_alpha_var.get()
-
-        rendered_buffers = canvas_cython_helpers.render_preview_chunks_cy(
+        cache = self._composite_cache
+        self._prepare_composite()
+        focus = cache.focus_layer
+        job = canvas_cython_helpers.PreviewJob(
             self.new_preview_pixels,
             tool_opts,
-            visible_layers_info,
-            use_bg,
-            bg_rgb,
-            render_alpha,
+            cache.below,
+            cache.above,
+            focus.opacity if focus is not None else 0,
+            self.app.render_pixel_alpha_var.get(),
             self.CHUNK_SIZE,
-            self.app.canvas_width,
-            self.app.canvas_height,
         )
+        cache.fill(job.region)
         self.new_preview_pixels.clear()
-
-        for (cx, cy), buffer in rendered_buffers.items():
-            if (cx, cy) not in self.preview_chunks:
-                canvas_x = cx * self.CHUNK_SIZE * self.app.pixel_size
-                canvas_y = cy * self.CHUNK_SIZE * self.app.pixel_size
-                new_chunk = {
-                    "pil": Image.new("RGBA", (self.CHUNK_SIZE, self.CHUNK_SIZE)),
-                    "item": self.canvas.create_image(canvas_x, canvas_y, anchor="nw"),
-                    "photo": None,
-                }
-                self.preview_chunks[(cx, cy)] = new_chunk
-
-            chunk = self.preview_chunks[(cx, cy)]
-
-            pil_image = Image.frombytes(
-                "RGBA", (self.CHUNK_SIZE, self.CHUNK_SIZE), bytes(buffer)
+        self._preview_job = self._preview_executor.submit(job.run)
+        self._schedule_preview_render()
+
+    def finish_preview_job(self):
+        # The worker reads the composite cache and the focus layer's pixels
+        # without the GIL, so it must be done before either is written,
+        # resized or rebuilt.
+        if self._preview_job is not None:
+            self.preview_chunks.update(
+                self._preview_job.result(), self.app.pixel_size
             )
-
-            chunk["pil"].paste(pil_image, mask=pil_image)
-
-            final_w = self.CHUNK_SIZE * self.app.pixel_size
-            if final_w > 0:
-                resized_img = chunk["pil"].resize((final_w, final_w), Image.NEAREST)
-                chunk["photo"] = ImageTk.PhotoImage(resized_img)
-                self.canvas.itemconfig(chunk["item"], image=chunk["photo"])
-
-        if self.drawing:
-            self._schedule_preview_render()
+            self._preview_job = None
 
     def _cleanup_preview(self):
         if self._after_id_preview_render:
             self.app.root.after_cancel(self._after_id_preview_render)
             self._after_id_preview_render = None
-
-        for chunk in self.preview_chunks.values():
-            self.canvas.delete(chunk["item"])
-
-        self.preview_chunks.clear()
+        self.finish_preview_job()
+        self.preview_chunks.release()
         self.new_preview_pixels.clear()
 
     def flood_fill(self, start_x, start_y, tool_options):
-        active_layer_data = tool_options["active_layer_data"]
-        new_color_hex, new_alpha = tool_options["color"], tool_options["alpha"]
+        active_layer_buffer = tool_options["active_layer_buffer"]
         if start_x is None:
             return
 
-        target_data = active_layer_data.get((start_x, start_y), ("transparent", 0))
-        new_pixel_data = (new_color_hex, new_alpha)
-
-        if target_data == new_pixel_data:
-            return
-
-        if target_data == ("transparent", 0) and new_alpha == 0:
-            return
-
-        pixels_before, pixels_after = canvas_cython_helpers.flood_fill_apply_cy(
+        indices, colors_before, colors_after = canvas_cython_helpers.flood_fill_apply_cy(
             start_x,
             start_y,
             self.app.canvas_width,
             self.app.canvas_height,
-            active_layer_data,
-            target_data,
-            new_color_hex,
-            new_alpha,
+            active_layer_buffer,
+            tool_options["color"],
         )
 
-        if not pixels_before:
+        if not len(indices):
             return
 
-        self._dirty_bbox = (0, 0, self.app.canvas_width, self.app.canvas_height)
+        self.mark_dirty_indices(indices, self.app.canvas_width)
+        self.mark_layer_dirty(tool_options["active_layer"])
 
         action = PixelAction(
-            tool_options["active_layer_index"], pixels_before, pixels_after
+            tool_options["active_layer_index"], indices, colors_before, colors_after
         )
         self.app.add_action(action)
         self.rescale_canvas()
@@ -587,7 +651,7 @@ class PixelCanvas(ttk.Frame):
                     (curr_py + 0.5) * self.app.pixel_size,
                 )
                 self.preview_shape_item = self.canvas.create_line(
-                    x_s, y_s, x_c, y_c, fill=tool_options["color"], width=2
+                    x_s, y_s, x_c, y_c, fill=packed_to_hex(tool_options["color"]), width=2
                 )
             elif shape_type == "Rectangle":
                 ex, ey = curr_px, curr_py
@@ -604,7 +668,12 @@ class PixelCanvas(ttk.Frame):
                     max(y0, ey) + 1
                 ) * self.app.pixel_size
                 self.preview_shape_item = self.canvas.create_rectangle(
-                    c_x0, c_y0, c_x1, c_y1, outline=tool_options["color"], width=2
+                    c_x0,
+                    c_y0,
+                    c_x1,
+                    c_y1,
+                    outline=packed_to_hex(tool_options["color"]),
+                    width=2,
                 )
             elif shape_type == "Ellipse":
                 cx, cy = (x0 + 0.5) * self.app.pixel_size, (
@@ -621,7 +690,7 @@ class PixelCanvas(ttk.Frame):
                     cy - ry_f,
                     cx + rx_f,
                     cy + ry_f,
-                    outline=tool_options["color"],
+                    outline=packed_to_hex(tool_options["color"]),
                     width=2,
                 )
             if self.preview_shape_item:
@@ -659,11 +728,10 @@ class PixelCanvas(ttk.Frame):
             return
 
         self.drawing = False
-        self._render_preview_frame()
         self._cleanup_preview()
 
         tool = tool_options["tool"]
-        active_layer_data = tool_options["active_layer_data"]
+        active_layer_buffer = tool_options["active_layer_buffer"]
         pixels_to_process = set()
 
         if tool == "shape":
@@ -725,31 +793,28 @@ class PixelCanvas(ttk.Frame):
             self.last_draw_pixel_x = self.last_draw_pixel_y = None
 
         if pixels_to_process:
-            is_eraser = tool == "eraser"
-            color, alpha = (
-                ("transparent", 0)
-                if is_eraser
-                else (tool_options["color"], tool_options["alpha"])
-            )
+            color = 0 if tool == "eraser" else tool_options["color"]
 
-            pixels_before, pixels_after = canvas_cython_helpers.apply_pixels_cy(
+            indices, colors_before, colors_after = canvas_cython_helpers.apply_pixels_cy(
                 pixels_to_process,
-                active_layer_data,
+                active_layer_buffer,
                 color,
-                alpha,
                 self.app.color_blending_var.get(),
                 self.app.canvas_width,
                 self.app.canvas_height,
             )
 
-            if pixels_before:
-                for px, py in pixels_to_process:
-                    self._update_dirty_bbox(px, py)
+            if len(indices):
+                self.mark_dirty_indices(indices, self.app.canvas_width)
+                self.mark_layer_dirty(tool_options["active_layer"])
                 action = PixelAction(
-                    tool_options["active_layer_index"], pixels_before, pixels_after
+                    tool_options["active_layer_index"],
+                    indices,
+                    colors_before,
+                    colors_after,
                 )
                 self.app.add_action(action)
-                self.rescale_canvas()
+                self.render_now()
 
     def start_draw(self, event, tool_options):
         px, py = self.get_pixel_coords(event.x, event.y)
@@ -763,6 +828,8 @@ class PixelCanvas(ttk.Frame):
             return
 
         self._cleanup_preview()
+        self.clear_layer_focus()
+        self._prepare_composite()
         self.drawing = True
         self.stroke_pixels_drawn_this_stroke.clear()
 
@@ -788,15 +855,15 @@ class PixelCanvas(ttk.Frame):
 
     def _core_pick_color_at_pixel(self, px, py):
         visible_layers_info = [
-            (layer.pixel_data, layer.opacity)
+            (layer.buffer, layer.opacity)
             for layer in self.app.layers
             if layer.visible
         ]
-        pixel_data = canvas_cython_helpers.pick_color_at_pixel_cy(
+        color = canvas_cython_helpers.pick_color_at_pixel_cy(
             px, py, visible_layers_info
         )
-        if pixel_data:
-            self.pick_color_callback(pixel_data[0], pixel_data[1])
+        if color:
+            self.pick_color_callback(color)
             return True
         return False
 
@@ -824,7 +891,7 @@ class PixelCanvas(ttk.Frame):
 
     def pan_motion(self, event):
         self.canvas.scan_dragto(event.x, event.y, gain=1)
-        self._update_visible_canvas_image()
+        self.request_render()
 
     def stop_pan(self, event):
         self.panning = False
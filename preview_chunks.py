@@ -0,0 +1,128 @@
+import tkinter as tk
+
+from PIL import Image, ImageTk
+
+MAX_POOLED_CHUNKS = 64
+
+
+class PreviewChunkPool:
+    """Canvas images showing the stroke preview, one per chunk of art pixels.
+
+    A chunk keeps the preview pixels drawn so far in a PIL image and shows
+    them scaled in a ``tk.PhotoImage`` that persists for the whole stroke.
+    Each frame only the rectangle of a chunk that received new pixels is
+    staged in a shared unscaled ``ImageTk.PhotoImage`` and copied into the
+    chunk's photo with Tk doing the scaling, so a frame costs in proportion
+    to what the stroke changed and allocates nothing. The whole chunk is only
+    scaled again when the zoom changes. Chunks released at the end of a
+    stroke are hidden and reused by the next one, up to ``MAX_POOLED_CHUNKS``.
+    """
+
+    def __init__(self, canvas, chunk_size):
+        self.canvas = canvas
+        self.chunk_size = chunk_size
+        self.chunks = {}
+        self._free = []
+        self._staging = None
+
+    def update(self, rendered_chunks, pixel_size):
+        size = self.chunk_size
+        for coord, (buffer, bounds) in rendered_chunks.items():
+            chunk = self.chunks.get(coord)
+            if chunk is None:
+                chunk = self.chunks[coord] = self._acquire(coord, pixel_size)
+            pixels = Image.frombuffer(
+                "RGBA", (size, size), buffer, "raw", "RGBA", 0, 1
+            ).crop(bounds)
+            chunk["pil"].paste(pixels, bounds[:2], mask=pixels)
+            self._paint(chunk, pixel_size, bounds)
+
+    def rescale(self, pixel_size):
+        for coord, chunk in self.chunks.items():
+            self._place(coord, chunk, pixel_size)
+            self._resize(chunk, pixel_size)
+            self._paint(chunk, pixel_size, (0, 0, self.chunk_size, self.chunk_size))
+
+    def release(self):
+        for chunk in self.chunks.values():
+            if len(self._free) < MAX_POOLED_CHUNKS:
+                self.canvas.itemconfig(chunk["item"], state="hidden")
+                self._free.append(chunk)
+            else:
+                self.canvas.delete(chunk["item"])
+        self.chunks.clear()
+
+    def clear(self):
+        for chunk in self._free + list(self.chunks.values()):
+            self.canvas.delete(chunk["item"])
+        self._free.clear()
+        self.chunks.clear()
+
+    def _acquire(self, coord, pixel_size):
+        size = self.chunk_size
+        if self._free:
+            chunk = self._free.pop()
+            chunk["pil"].paste((0, 0, 0, 0), (0, 0, size, size))
+            self.canvas.itemconfig(chunk["item"], state="normal")
+        else:
+            chunk = {
+                "pil": Image.new("RGBA", (size, size)),
+                "photo": tk.PhotoImage(master=self.canvas),
+                "item": self.canvas.create_image(0, 0, anchor="nw"),
+            }
+            self.canvas.itemconfig(chunk["item"], image=chunk["photo"])
+        self._place(coord, chunk, pixel_size)
+        self._resize(chunk, pixel_size)
+        return chunk
+
+    def _place(self, coord, chunk, pixel_size):
+        cx, cy = coord
+        self.canvas.coords(
+            chunk["item"],
+            cx * self.chunk_size * pixel_size,
+            cy * self.chunk_size * pixel_size,
+        )
+
+    def _resize(self, chunk, pixel_size):
+        if pixel_size >= 1:
+            side = self.chunk_size * pixel_size
+        else:
+            side = -(-self.chunk_size // round(1 / pixel_size))
+        photo = chunk["photo"]
+        photo.configure(width=side, height=side)
+        photo.blank()
+
+    def _paint(self, chunk, pixel_size, bounds):
+        x0, y0, x1, y1 = bounds
+        if pixel_size >= 1:
+            scale = ("-zoom", pixel_size, pixel_size)
+            to = (x0 * pixel_size, y0 * pixel_size)
+        else:
+            # Subsampling keeps every step-th pixel, so the copied rectangle
+            # has to start on that grid.
+            step = round(1 / pixel_size)
+            x0, y0 = x0 - x0 % step, y0 - y0 % step
+            scale = ("-subsample", step, step)
+            to = (x0 // step, y0 // step)
+        if self._staging is None:
+            self._staging = ImageTk.PhotoImage(
+                "RGBA", (self.chunk_size, self.chunk_size), master=self.canvas
+            )
+        # PhotoImage.paste always writes at the top-left corner
+        self._staging.paste(chunk["pil"].crop((x0, y0, x1, y1)))
+        photo = chunk["photo"]
+        photo.tk.call(
+            photo,
+            "copy",
+            self._staging,
+            "-from",
+            0,
+            0,
+            x1 - x0,
+            y1 - y0,
+            "-to",
+            *to,
+            *scale,
+            "-compositingrule",
+            "set",
+        )
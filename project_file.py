@@ -0,0 +1,217 @@
+import hashlib
+import json
+import mmap
+import os
+import struct
+import threading
+import zipfile
+import zlib
+
+import numpy as np
+
+from background_save import write_atomically
+from layer_buffer import LayerBuffer, TILE_SIZE
+
+PROJECT_EXTENSION = ".pxart"
+FORMAT_VERSION = 1
+MANIFEST_NAME = "project.json"
+CHUNK_DIR = "tiles/"
+COMPRESS_LEVEL = 6
+_LOCAL_HEADER = struct.Struct("<4s22xHH")
+
+
+class ChunkCache:
+    """Compressed tile chunks from the last save or load, by content digest.
+
+    Chunks are stored in the archive already zlib-compressed, so a tile whose
+    content has not changed since the previous save is written from here
+    without compressing it again.
+    """
+
+    def __init__(self):
+        self._chunks = {}
+
+    def replace(self, chunks):
+        self._chunks = chunks
+
+    def get(self, digest):
+        return self._chunks.get(digest)
+
+
+class MappedTileSource:
+    """Compressed tile chunks of an open project file, read through mmap.
+
+    Chunks are looked up by digest and only decompressed when a layer first
+    touches the tile. :meth:`detach` copies the compressed chunks into memory
+    and closes the file, which is needed before the file can be replaced.
+    """
+
+    def __init__(self, filename):
+        self.filename = os.path.abspath(filename)
+        self._file = open(filename, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._spans = {}
+        self._detached = None
+        self._lock = threading.Lock()
+
+    def add_chunk(self, digest, info):
+        signature, name_length, extra_length = _LOCAL_HEADER.unpack_from(
+            self._map, info.header_offset
+        )
+        if signature != b"PK\x03\x04" or info.compress_type != zipfile.ZIP_STORED:
+            raise ValueError(f"Unsupported tile chunk {info .filename }")
+        offset = info.header_offset + _LOCAL_HEADER.size + name_length + extra_length
+        if offset + info.compress_size > len(self._map):
+            raise ValueError(f"Truncated tile chunk {info .filename }")
+        self._spans[digest] = (offset, info.compress_size)
+
+    def has_chunk(self, digest):
+        return digest in self._spans
+
+    def compressed(self, digest):
+        with self._lock:
+            if self._detached is not None:
+                return self._detached[digest]
+            offset, size = self._spans[digest]
+            return self._map[offset : offset + size]
+
+    def decode(self, digest):
+        data = zlib.decompress(self.compressed(digest))
+        pixels = np.frombuffer(data, dtype=np.uint8)
+        return pixels.reshape(TILE_SIZE, TILE_SIZE, 4).copy()
+
+    def detach(self):
+        with self._lock:
+            if self._detached is not None:
+                return
+            self._detached = {
+                digest: self._map[offset : offset + size]
+                for digest, (offset, size) in self._spans.items()
+            }
+            self._close()
+
+    def _close(self):
+        self._map.close()
+        self._file.close()
+
+
+def tile_digest(pixels):
+    return hashlib.blake2b(pixels.tobytes(), digest_size=16).hexdigest()
+
+
+def snapshot_layers(layers):
+    return [
+        {
+            "name": layer.name,
+            "visible": layer.visible,
+            "opacity": layer.opacity,
+            "buffer": layer.buffer.copy(),
+        }
+        for layer in layers
+    ]
+
+
+def save_project(filename, width, height, active_index, layers, chunk_cache, progress):
+    manifest = {
+        "version": FORMAT_VERSION,
+        "width": width,
+        "height": height,
+        "tile_size": TILE_SIZE,
+        "active_layer": active_index,
+        "layers": [],
+    }
+    chunks = {}
+    total_tiles = max(1, sum(len(layer["buffer"].tile_keys()) for layer in layers))
+    done_tiles = 0
+
+    for layer in layers:
+        buffer = layer["buffer"]
+        tiles = []
+        for tx, ty in sorted(buffer.tile_keys()):
+            done_tiles += 1
+            lazy = buffer.lazy_tile(tx, ty)
+            if lazy is not None:
+                source, digest = lazy
+                if digest not in chunks:
+                    chunks[digest] = source.compressed(digest)
+                tiles.append([tx, ty, digest])
+                continue
+            pixels = buffer.tile_pixels(tx, ty)
+            if not pixels[..., 3].any():
+                continue
+            digest = tile_digest(pixels)
+            if digest not in chunks:
+                chunks[digest] = chunk_cache.get(digest) or zlib.compress(
+                    pixels.tobytes(), COMPRESS_LEVEL
+                )
+            tiles.append([tx, ty, digest])
+        manifest["layers"].append(
+            {
+                "name": layer["name"],
+                "visible": layer["visible"],
+                "opacity": layer["opacity"],
+                "tiles": tiles,
+            }
+        )
+        progress(0.9 * done_tiles / total_tiles)
+
+    def write(path):
+        with zipfile.ZipFile(path, "w", zipfile.ZIP_STORED) as archive:
+            archive.writestr(
+                MANIFEST_NAME, json.dumps(manifest), compress_type=zipfile.ZIP_DEFLATED
+            )
+            for digest, data in chunks.items():
+                archive.writestr(CHUNK_DIR + digest, data)
+
+    write_atomically(filename, write)
+    chunk_cache.replace(chunks)
+
+
+def _read_manifest(filename, source):
+    with zipfile.ZipFile(filename) as archive:
+        try:
+            manifest = json.loads(archive.read(MANIFEST_NAME))
+        except KeyError:
+            raise ValueError("Not a pixel art project file")
+        if manifest.get("version") != FORMAT_VERSION:
+            raise ValueError(
+                f"Unsupported project version {manifest .get ('version')}"
+            )
+        if manifest.get("tile_size") != TILE_SIZE:
+            raise ValueError("Project was saved with a different tile size")
+        for info in archive.infolist():
+            if info.filename.startswith(CHUNK_DIR):
+                source.add_chunk(info.filename[len(CHUNK_DIR) :], info)
+    return manifest
+
+
+def load_project(filename, chunk_cache):
+    source = MappedTileSource(filename)
+    try:
+        manifest = _read_manifest(filename, source)
+        width, height = manifest["width"], manifest["height"]
+        layers = [
+            _read_layer(entry, width, height, source) for entry in manifest["layers"]
+        ]
+    except Exception:
+        source._close()
+        raise
+
+    chunk_cache.replace({})
+    return width, height, manifest["active_layer"], layers, source
+
+
+def _read_layer(entry, width, height, source):
+    buffer = LayerBuffer(width, height)
+    for tx, ty, digest in entry["tiles"]:
+        if not (0 <= tx < buffer.tiles_x and 0 <= ty < buffer.tiles_y):
+            raise ValueError(f"Tile ({tx }, {ty }) is outside the canvas")
+        if not source.has_chunk(digest):
+            raise ValueError(f"Missing tile chunk {digest }")
+        buffer.add_lazy_tile(tx, ty, source, digest)
+    return {
+        "name": entry["name"],
+        "visible": entry["visible"],
+        "opacity": entry["opacity"],
+        "buffer": buffer,
+    }
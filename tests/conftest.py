@@ -0,0 +1,51 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import canvas_cython_helpers
+from layer_menu import Layer
+
+
+class FakeCanvas:
+    def mark_layer_dirty(self, layer):
+        pass
+
+    def mark_dirty_indices(self, indices, width):
+        pass
+
+
+class FakeApp:
+    """Just the parts of ``PixelArtApp`` that actions touch."""
+
+    def __init__(self, width, height):
+        self.layers = [Layer(width, height, "Background")]
+        self.active_layer_index = 0
+        self.pixel_canvas = FakeCanvas()
+
+
+def pixels(buffer):
+    return bytes(
+        canvas_cython_helpers.export_image_cy(
+            buffer.width, buffer.height, [(buffer, 255)], 0
+        )
+    )
+
+
+def paint(buffer, points, color):
+    return canvas_cython_helpers.apply_pixels_cy(
+        set(points), buffer, color, False, buffer.width, buffer.height
+    )
+
+
+@pytest.fixture
+def app():
+    return FakeApp(70, 50)
+
+
+@pytest.fixture
+def rng():
+    return np.random.default_rng(7)
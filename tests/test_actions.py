@@ -0,0 +1,57 @@
+import numpy as np
+
+import canvas_cython_helpers
+from actions import PixelAction, _pack_arrays, _unpack_arrays
+from conftest import paint, pixels
+
+
+def test_apply_and_scatter_round_trip(app, rng):
+    buffer = app.layers[0].buffer
+    paint(buffer, [(x, 3) for x in range(70)], 0x20406080)
+    original = pixels(buffer)
+    points = {(int(x), int(y)) for x, y in rng.integers(0, 50, (300, 2))}
+
+    indices, before, after = canvas_cython_helpers.apply_pixels_cy(
+        points, buffer, 0xC0FFEE80, True, 70, 50
+    )
+    painted = pixels(buffer)
+    assert len(indices) == len(np.unique(indices)) <= len(points)
+    assert (before != after).all()
+
+    canvas_cython_helpers.scatter_pixels_cy(buffer, indices, before)
+    assert pixels(buffer) == original
+    canvas_cython_helpers.scatter_pixels_cy(buffer, indices, after)
+    assert pixels(buffer) == painted
+
+
+def test_unchanged_pixels_are_not_recorded(app):
+    buffer = app.layers[0].buffer
+    paint(buffer, [(1, 1), (2, 2)], 0xFF0000FF)
+    indices, _, _ = paint(buffer, [(1, 1), (2, 2), (3, 3), (99, 1)], 0xFF0000FF)
+    assert indices.tolist() == [3 * 70 + 3]
+
+
+def test_pixel_action_undo_redo(app):
+    buffer = app.layers[0].buffer
+    original = pixels(buffer)
+    action = PixelAction(0, *paint(buffer, [(x, x) for x in range(50)], 0xFFFFFFFF))
+    painted = pixels(buffer)
+
+    action.undo(app)
+    assert pixels(buffer) == original
+    action.redo(app)
+    assert pixels(buffer) == painted
+
+
+def test_constant_colors_pack_to_one_value():
+    indices = np.arange(1000, dtype=np.uint32)
+    before = np.arange(1000, dtype=np.uint32) * 7
+    after = np.broadcast_to(np.uint32(0xFF0000FF), (1000,))
+    packed = _pack_arrays(indices, before, after)
+    assert len(packed) < 3 * 1000 * 4
+
+    unpacked = _unpack_arrays(packed, 3)
+    for original, restored in zip((indices, before, after), unpacked):
+        assert (original == restored).all()
+    action = PixelAction(0, indices, before, after)
+    assert action.byte_size() < PixelAction(0, indices, before, before).byte_size()
@@ -0,0 +1,129 @@
+from actions import AddLayerAction, PixelAction, RenameLayerAction
+from autosave import Autosave
+from conftest import paint, pixels
+from layer_menu import Layer
+
+
+def random_points(rng, app, count=150):
+    width, height = app.layers[0].buffer.width, app.layers[0].buffer.height
+    return zip(
+        rng.integers(0, width, count).tolist(), rng.integers(0, height, count).tolist()
+    )
+
+
+def paint_step(autosave, app, rng, color):
+    layer = app.layers[app.active_layer_index]
+    action = PixelAction(
+        app.active_layer_index, *paint(layer.buffer, random_points(rng, app), color)
+    )
+    autosave.record(app.layers, app.active_layer_index, action)
+    return action
+
+
+def crash(autosave):
+    """Stop writing and let go of the session lock without discarding it."""
+    autosave._executor.shutdown(wait=True)
+    autosave._journal.close()
+    autosave._lock.close()
+
+
+def journal_path(autosave):
+    return next(autosave.directory.glob("journal-*.bin"))
+
+
+def assert_recovered(recovered, app):
+    width, height, active_index, layers = recovered
+    assert (width, height) == (70, 50)
+    assert active_index == app.active_layer_index
+    assert [state["name"] for state in layers] == [layer.name for layer in app.layers]
+    for state, layer in zip(layers, app.layers):
+        assert pixels(state["buffer"]) == pixels(layer.buffer)
+
+
+def test_replays_do_undo_and_redo(tmp_path, app, rng):
+    autosave = Autosave(tmp_path)
+    assert autosave.recover() is None
+    autosave.checkpoint(70, 50, 0, app.layers)
+
+    paint_step(autosave, app, rng, 0xFF0000FF)
+    layer = Layer(70, 50, "Ink")
+    app.layers.append(layer)
+    app.active_layer_index = 1
+    autosave.record(app.layers, 1, AddLayerAction(layer, 1, 0))
+    kept = paint_step(autosave, app, rng, 0x00FF00FF)
+    undone = paint_step(autosave, app, rng, 0x0000FF80)
+
+    undone.undo(app)
+    autosave.record(app.layers, 1, undone, undone=True)
+    kept.undo(app)
+    autosave.record(app.layers, 1, kept, undone=True)
+    kept.redo(app)
+    autosave.record(app.layers, 1, kept)
+    rename = RenameLayerAction(0, "Background", "Paper")
+    rename.redo(app)
+    autosave.record(app.layers, 1, rename)
+    crash(autosave)
+
+    assert_recovered(Autosave(tmp_path).recover(), app)
+
+
+def test_torn_tail_keeps_complete_records(tmp_path, app, rng):
+    autosave = Autosave(tmp_path)
+    autosave.checkpoint(70, 50, 0, app.layers)
+    paint_step(autosave, app, rng, 0xFF0000FF)
+    autosave._executor.submit(lambda: None).result()
+    expected = pixels(app.layers[0].buffer)
+    intact_size = journal_path(autosave).stat().st_size
+
+    paint_step(autosave, app, rng, 0x00FF00FF)
+    crash(autosave)
+    journal = journal_path(autosave)
+    with open(journal, "r+b") as f:
+        f.truncate((intact_size + journal.stat().st_size) // 2)
+
+    _, _, _, layers = Autosave(tmp_path).recover()
+    assert pixels(layers[0]["buffer"]) == expected
+
+
+def test_live_session_is_not_recovered(tmp_path, app, rng):
+    running = Autosave(tmp_path)
+    running.checkpoint(70, 50, 0, app.layers)
+    paint_step(running, app, rng, 0xFF0000FF)
+    running._executor.submit(lambda: None).result()
+
+    assert Autosave(tmp_path).recover() is None
+    running.discard()
+    assert not running.directory.exists()
+
+
+def test_checkpoint_removes_recovered_session(tmp_path, app, rng):
+    crashed = Autosave(tmp_path)
+    crashed.checkpoint(70, 50, 0, app.layers)
+    paint_step(crashed, app, rng, 0xFF0000FF)
+    crash(crashed)
+
+    autosave = Autosave(tmp_path)
+    width, height, active_index, layers = autosave.recover()
+    assert_recovered((width, height, active_index, layers), app)
+    autosave.checkpoint(width, height, active_index, app.layers)
+    autosave.discard()
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_layer_property_changes_are_journaled(tmp_path, app, rng):
+    autosave = Autosave(tmp_path)
+    autosave.checkpoint(70, 50, 0, app.layers)
+    paint_step(autosave, app, rng, 0xFF0000FF)
+    autosave.checkpoint(70, 50, 0, app.layers)
+    assert not autosave.dirty
+
+    autosave.record_layout(app.layers, 0)
+    assert not autosave.dirty
+    app.layers[0].opacity = 90
+    app.layers[0].visible = False
+    autosave.record_layout(app.layers, 0)
+    assert autosave.dirty
+    crash(autosave)
+
+    _, _, _, layers = Autosave(tmp_path).recover()
+    assert (layers[0]["opacity"], layers[0]["visible"]) == (90, False)
@@ -0,0 +1,85 @@
+import threading
+
+import pytest
+
+from background_save import BackgroundSaver, write_atomically
+
+
+class FakeRoot:
+    def after(self, ms, callback):
+        return object()
+
+
+class Snapshot:
+    def __init__(self):
+        self.released = False
+
+    def release(self):
+        self.released = True
+
+
+def test_write_atomically_keeps_old_file_on_failure(tmp_path):
+    path = tmp_path / "art.png"
+    path.write_bytes(b"old")
+
+    def fail(temp_path):
+        with open(temp_path, "wb") as f:
+            f.write(b"half")
+        raise OSError("disk full")
+
+    with pytest.raises(OSError):
+        write_atomically(str(path), fail)
+    assert path.read_bytes() == b"old"
+
+    write_atomically(str(path), lambda temp_path: open(temp_path, "wb").close())
+    assert path.read_bytes() == b""
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["art.png"]
+
+
+def test_queued_saves_coalesce_per_file():
+    saver = BackgroundSaver(FakeRoot())
+    gate = threading.Event()
+    written, done = [], []
+
+    def job(name, snapshot, wait=False):
+        def work(progress):
+            if wait:
+                gate.wait()
+            progress(1.0)
+            written.append(name)
+
+        saver.save(
+            name[0],
+            work,
+            [snapshot],
+            lambda fraction: None,
+            lambda error: done.append((name, error)),
+        )
+
+    snapshots = [Snapshot() for _ in range(4)]
+    job("a", snapshots[0], wait=True)
+    job("b1", snapshots[1])
+    job("c", snapshots[2])
+    job("b2", snapshots[3])
+    assert saver.busy
+    assert snapshots[1].released and not snapshots[3].released
+
+    gate.set()
+    saver.flush()
+    assert written == ["a", "b2", "c"]
+    assert done == [("a", None), ("b2", None), ("c", None)]
+    assert all(snapshot.released for snapshot in snapshots)
+    assert not saver.busy
+
+
+def test_errors_reach_on_done():
+    saver = BackgroundSaver(FakeRoot())
+    snapshot, done = Snapshot(), []
+
+    def work(progress):
+        raise ValueError("broken")
+
+    saver.save("x", work, [snapshot], lambda fraction: None, done.append)
+    saver.flush()
+    assert isinstance(done[0], ValueError)
+    assert snapshot.released
@@ -0,0 +1,94 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+import canvas_cython_helpers
+from composite_cache import CompositeCache
+from layer_buffer import LayerBuffer
+
+WIDTH, HEIGHT = 150, 100
+BG_COLOR = 0x336699FF
+
+
+def make_layers(rng, count=5):
+    layers = []
+    for _ in range(count):
+        rgba = rng.integers(0, 256, (HEIGHT, WIDTH, 4), dtype=np.uint8)
+        rgba[rng.random((HEIGHT, WIDTH)) < 0.3] = 0
+        layers.append(
+            SimpleNamespace(
+                buffer=LayerBuffer.from_rgba_rows(WIDTH, HEIGHT, [(0, rgba.tobytes())]),
+                opacity=int(rng.integers(1, 256)),
+                visible=True,
+            )
+        )
+    return layers
+
+
+def full_render(layers, use_bg, render_alpha, bbox=(0, 0, WIDTH, HEIGHT)):
+    out = np.zeros((HEIGHT, WIDTH, 4), dtype=np.uint8)
+    canvas_cython_helpers.render_layers_into_cy(
+        out,
+        [(layer.buffer, layer.opacity) for layer in layers if layer.visible],
+        use_bg,
+        BG_COLOR,
+        render_alpha,
+        bbox,
+    )
+    x0, y0, x1, y1 = bbox
+    return out[y0:y1, x0:x1]
+
+
+def compose(cache, bbox=(0, 0, WIDTH, HEIGHT)):
+    x0, y0, x1, y1 = bbox
+    data = bytes(cache.compose(bbox))
+    return np.frombuffer(data, np.uint8).reshape(y1 - y0, x1 - x0, 4)
+
+
+@pytest.mark.parametrize("render_alpha", [True, False])
+@pytest.mark.parametrize("use_bg", [True, False])
+def test_compose_matches_full_render_for_every_focus(rng, render_alpha, use_bg):
+    layers = make_layers(rng)
+    layers[2].visible = False
+    expected = full_render(layers, use_bg, render_alpha).astype(int)
+
+    for focus in [None] + layers:
+        cache = CompositeCache()
+        cache.prepare(layers, focus, WIDTH, HEIGHT, use_bg, BG_COLOR, render_alpha)
+        difference = np.abs(compose(cache) - expected)
+        # float32 round-off can tip a channel across a rounding boundary
+        assert difference.max() <= 1
+        assert np.count_nonzero(difference) <= 3
+
+
+def test_focus_edits_recompose_without_rebuild(rng):
+    layers = make_layers(rng)
+    focus = layers[1]
+    cache = CompositeCache()
+    assert cache.prepare(layers, focus, WIDTH, HEIGHT, True, BG_COLOR, True)
+    compose(cache)
+
+    canvas_cython_helpers.apply_pixels_cy(
+        {(x, 40) for x in range(WIDTH)}, focus.buffer, 0xFF00FF80, False, WIDTH, HEIGHT
+    )
+    focus.opacity = 90
+    assert not cache.prepare(layers, focus, WIDTH, HEIGHT, True, BG_COLOR, True)
+    bbox = (0, 30, WIDTH, 50)
+    difference = np.abs(compose(cache, bbox) - full_render(layers, True, True, bbox))
+    assert difference.max() <= 1
+
+    layers[3].opacity = 10
+    assert cache.prepare(layers, focus, WIDTH, HEIGHT, True, BG_COLOR, True)
+
+
+def test_fill_is_lazy_per_tile(rng):
+    layers = make_layers(rng)
+    cache = CompositeCache()
+    cache.prepare(layers, layers[0], WIDTH, HEIGHT, False, 0, True)
+    assert cache._stale.all()
+
+    cache.fill((40, 40, 50, 50))
+    assert np.count_nonzero(~cache._stale) == 1
+    compose(cache)
+    assert not cache._stale.any()
@@ -0,0 +1,64 @@
+import numpy as np
+
+from dirty_region import DirtyRegion
+from layer_buffer import TILE_SIZE
+
+
+def covered(rects, width, height):
+    mask = np.zeros((height, width), dtype=bool)
+    for x0, y0, x1, y1 in rects:
+        mask[y0:y1, x0:x1] = True
+    return mask
+
+
+def test_scattered_edits_stay_separate():
+    region = DirtyRegion()
+    region.add_pixel(3, 4)
+    region.add_pixel(250, 180)
+
+    assert sorted(region.rects(256, 256)) == [(3, 4, 4, 5), (250, 180, 251, 181)]
+
+
+def test_diagonal_edit_is_covered_tightly():
+    size = 8 * TILE_SIZE
+    region = DirtyRegion()
+    for i in range(size):
+        region.add_pixel(i, i)
+
+    rects = region.rects(size, size)
+    mask = covered(rects, size, size)
+    assert all(mask[i, i] for i in range(size))
+    assert mask.sum() == 8 * TILE_SIZE * TILE_SIZE
+    assert sum((x1 - x0) * (y1 - y0) for x0, y0, x1, y1 in rects) == mask.sum()
+
+
+def test_neighbouring_tiles_merge_and_clip():
+    region = DirtyRegion()
+    for x in range(0, 3 * TILE_SIZE):
+        region.add_pixel(x, 5)
+        region.add_pixel(x, TILE_SIZE + 5)
+
+    assert region.rects(70, 100) == [
+        (0, 5, 70, 6),
+        (0, TILE_SIZE + 5, 70, TILE_SIZE + 6),
+    ]
+
+    region.clear()
+    for y in range(2 * TILE_SIZE):
+        region.add_pixel(9, y)
+    assert region.rects(70, 100) == [(9, 0, 10, 2 * TILE_SIZE)]
+
+
+def test_indices_match_pixels():
+    width, height = 97, 61
+    rng = np.random.default_rng(5)
+    indices = np.unique(rng.integers(0, width * height, 300)).astype(np.uint32)
+    by_pixel, by_index = DirtyRegion(), DirtyRegion()
+    for index in indices.tolist():
+        by_pixel.add_pixel(index % width, index // width)
+    by_index.add_indices(indices, width)
+
+    assert by_index.rects(width, height) == by_pixel.rects(width, height)
+    assert not DirtyRegion()
+    by_index.clear()
+    assert not by_index
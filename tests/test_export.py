@@ -0,0 +1,35 @@
+import numpy as np
+from PIL import Image
+import pytest
+
+import canvas_cython_helpers
+from layer_buffer import LayerBuffer
+
+
+def reference_export(width, height, layers, bg_color):
+    """The putpixel plus ``Image.alpha_composite`` export it replaced."""
+    background = tuple(bg_color.to_bytes(4, "big"))
+    image = Image.new("RGBA", (width, height), background)
+    for rgba, opacity in layers:
+        layer = rgba.copy()
+        layer[..., 3] = (layer[..., 3] * (opacity / 255.0)).astype(np.uint8)
+        layer[layer[..., 3] == 0] = 0
+        image = Image.alpha_composite(image, Image.fromarray(layer, "RGBA"))
+    return image.tobytes()
+
+
+@pytest.mark.parametrize("bg_color", [0, 0x336699FF])
+def test_export_matches_pillow_alpha_composite(rng, bg_color):
+    width, height = 90, 75
+    layers = []
+    for opacity in (255, 180, 37, 0, 255):
+        rgba = rng.integers(0, 256, (height, width, 4), dtype=np.uint8)
+        rgba[rng.random((height, width)) < 0.4] = 0
+        layers.append((rgba, opacity))
+    buffers = [
+        (LayerBuffer.from_rgba_rows(width, height, [(0, rgba.tobytes())]), opacity)
+        for rgba, opacity in layers
+    ]
+
+    exported = canvas_cython_helpers.export_image_cy(width, height, buffers, bg_color)
+    assert bytes(exported) == reference_export(width, height, layers, bg_color)
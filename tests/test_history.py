@@ -0,0 +1,80 @@
+import numpy as np
+
+from actions import DeleteLayerAction, PixelAction
+from conftest import paint, pixels
+from history import History
+
+
+def wait_for_freezing(history):
+    history._executor.submit(lambda: None).result()
+
+
+def paint_row(app, y, color):
+    layer = app.layers[app.active_layer_index]
+    points = [(x, y) for x in range(layer.buffer.width)]
+    return PixelAction(app.active_layer_index, *paint(layer.buffer, points, color))
+
+
+def test_oldest_steps_are_evicted_over_budget(app):
+    action_size = paint_row(app, 0, 0xFF0000FF).byte_size()
+    history = History(budget_bytes=3 * action_size, hot_depth=100)
+    actions = [paint_row(app, y, 0x00FF00FF) for y in range(5)]
+    for action in actions:
+        history.push(action)
+
+    assert history.evicted_count == 2
+    assert history.memory_usage == 3 * action_size
+    assert list(history._undo) == actions[2:]
+
+    history.set_budget(0)
+    assert list(history._undo) == actions[-1:]
+
+
+def test_undo_clears_redo_on_push(app):
+    history = History()
+    first, second = paint_row(app, 0, 0xFF0000FF), paint_row(app, 1, 0xFF0000FF)
+    history.push(first)
+    history.push(second)
+    assert history.undo(app) is second
+    assert history.can_redo
+
+    history.push(paint_row(app, 2, 0x0000FFFF))
+    assert not history.can_redo
+    assert len(history) == 2
+
+
+def test_frozen_steps_thaw_on_undo(app):
+    history = History(hot_depth=1, spill_to_disk=True)
+    original = pixels(app.layers[0].buffer)
+    states = []
+    for y in range(6):
+        history.push(paint_row(app, y * 3, 0x11223380 + y))
+        states.append(pixels(app.layers[0].buffer))
+    wait_for_freezing(history)
+
+    cold = list(history._undo)[:-1]
+    assert all(action._frozen is not None for action in cold)
+    assert history._undo[-1]._frozen is None
+    assert history.memory_usage == sum(a.byte_size() for a in history._undo)
+
+    for expected in reversed([original] + states[:-1]):
+        history.undo(app)
+        assert pixels(app.layers[0].buffer) == expected
+    while history.can_redo:
+        history.redo(app)
+    assert pixels(app.layers[0].buffer) == states[-1]
+
+
+def test_live_layers_are_not_frozen(app):
+    history = History(hot_depth=0, live_layers=lambda: app.layers)
+    layer = app.layers[0]
+    paint(layer.buffer, [(1, 1)], 0xFF0000FF)
+    history.push(DeleteLayerAction(layer, 0, 0, 0))
+    wait_for_freezing(history)
+    assert layer._frozen is None
+
+    removed = app.layers.pop()
+    history.push(DeleteLayerAction(removed, 0, 0, 0))
+    wait_for_freezing(history)
+    assert removed._frozen is not None
+    assert np.frombuffer(pixels(removed.buffer), np.uint8)[4 * 71 + 3] == 255
@@ -0,0 +1,40 @@
+import numpy as np
+from PIL import Image
+import pytest
+
+from image_import import BAND_ROWS, read_image_buffer, rgba_bands
+from layer_buffer import TILE_SIZE
+
+
+def as_array(buffer):
+    rgba = np.zeros((buffer.height, buffer.width, 4), dtype=np.uint8)
+    for tx, ty in buffer.tile_keys():
+        y0, x0 = ty * TILE_SIZE, tx * TILE_SIZE
+        tile = buffer.tile_pixels(tx, ty)
+        rgba[y0 : y0 + TILE_SIZE, x0 : x0 + TILE_SIZE] = tile[
+            : buffer.height - y0, : buffer.width - x0
+        ]
+    return rgba
+
+
+@pytest.mark.parametrize("mode", ["RGBA", "RGB", "P", "LA"])
+def test_read_image_buffer_matches_rgba_conversion(tmp_path, rng, mode):
+    height, width = BAND_ROWS + 45, 70
+    rgba = rng.integers(0, 256, (height, width, 4), dtype=np.uint8)
+    rgba[rng.random((height, width)) < 0.2, 3] = 0
+    path = tmp_path / "art.png"
+    Image.fromarray(rgba, "RGBA").convert(mode).save(path)
+
+    buffer = read_image_buffer(path)
+    with Image.open(path) as image:
+        expected = np.array(image.convert("RGBA"))
+    expected[expected[..., 3] == 0] = 0
+    assert (buffer.width, buffer.height) == (width, height)
+    assert (as_array(buffer) == expected).all()
+
+
+def test_rgba_bands_cover_every_row(rng):
+    image = Image.fromarray(rng.integers(0, 256, (70, 9, 3), dtype=np.uint8), "RGB")
+    bands = list(rgba_bands(image, band_rows=32))
+    assert [y0 for y0, _ in bands] == [0, 32, 64]
+    assert b"".join(data for _, data in bands) == image.convert("RGBA").tobytes()
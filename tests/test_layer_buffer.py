@@ -0,0 +1,108 @@
+import numpy as np
+
+import canvas_cython_helpers
+from conftest import paint, pixels
+from layer_buffer import LayerBuffer, TILE_SIZE
+
+
+def random_buffer(rng, width=100, height=70, coverage=0.5):
+    rgba = rng.integers(0, 256, (height, width, 4), dtype=np.uint8)
+    rgba[rng.random((height, width)) > coverage] = 0
+    return LayerBuffer.from_rgba_rows(width, height, [(0, rgba.tobytes())])
+
+
+def as_array(buffer):
+    shape = (buffer.height, buffer.width, 4)
+    return np.frombuffer(pixels(buffer), np.uint8).reshape(shape)
+
+
+def test_copy_shares_tiles_until_written(rng):
+    buffer = random_buffer(rng)
+    before = pixels(buffer)
+    copy = buffer.copy()
+    assert (copy.tile_table == buffer.tile_table).all()
+    assert all(tile.refs == 2 for tile in buffer._tiles.values())
+    assert not buffer.tile_owned.any() and not copy.tile_owned.any()
+
+    paint(copy, [(1, 1)], 0x123456FF)
+    assert copy.tile_table[0, 0] != buffer.tile_table[0, 0]
+    assert (copy.tile_table.flat[1:] == buffer.tile_table.flat[1:]).all()
+    assert buffer._tiles[(0, 0)].refs == 1 and copy._tiles[(0, 0)].refs == 1
+    assert pixels(buffer) == before
+    assert as_array(copy)[1, 1].tolist() == [0x12, 0x34, 0x56, 0xFF]
+
+    # The original is the only owner of (0, 0) again and writes in place
+    address = buffer.tile_table[0, 0]
+    paint(buffer, [(2, 2)], 0xFF0000FF)
+    assert buffer.tile_table[0, 0] == address
+
+
+def test_release_drops_references(rng):
+    buffer = random_buffer(rng)
+    copies = [buffer.copy() for _ in range(3)]
+    tile = buffer._tiles[(0, 0)]
+    assert tile.refs == 4
+    for copy in copies:
+        copy.release()
+    assert tile.refs == 1
+    assert not copies[0].tile_table.any()
+
+
+def test_empty_pixels_are_stored_as_zero(rng):
+    buffer = random_buffer(rng)
+    rgba = as_array(buffer)
+    assert not rgba[rgba[..., 3] == 0].any()
+
+    points = [(x, y) for y in range(TILE_SIZE) for x in range(TILE_SIZE)]
+    paint(buffer, points, 0)
+    buffer.drop_empty_tiles()
+    assert (0, 0) not in buffer.tile_keys()
+    assert buffer.tile_table[0, 0] == 0
+    assert as_array(buffer)[:TILE_SIZE, :TILE_SIZE].sum() == 0
+
+
+def test_serialize_and_resize_keep_pixels(rng):
+    buffer = random_buffer(rng)
+    assert pixels(LayerBuffer.deserialize(buffer.serialize())) == pixels(buffer)
+
+    smaller = buffer.resized(45, 40)
+    assert (as_array(smaller) == as_array(buffer)[:40, :45]).all()
+    larger = buffer.resized(130, 90)
+    assert (as_array(larger)[:70, :100] == as_array(buffer)).all()
+    assert not as_array(larger)[70:].any() and not as_array(larger)[:, 100:].any()
+
+
+def expected_merge(lower, lower_opacity, upper, upper_opacity):
+    out = lower.astype(int)
+    out[..., 3] = out[..., 3] * lower_opacity // 255
+    out[out[..., 3] == 0] = 0
+    alpha = upper[..., 3].astype(int) * upper_opacity // 255
+    covered = alpha > 0
+    out[covered, :3] = upper[covered, :3]
+    out[covered, 3] = alpha[covered]
+    return out.astype(np.uint8)
+
+
+def test_merge_layer_pixels(rng):
+    lower = random_buffer(rng, coverage=0.8)
+    upper = random_buffer(rng, coverage=0.3)
+    for lower_opacity in (255, 90):
+        merged = lower.copy()
+        canvas_cython_helpers.merge_layer_pixels_cy(
+            merged, lower_opacity, upper, 200, False
+        )
+        expected = expected_merge(as_array(lower), lower_opacity, as_array(upper), 200)
+        assert (as_array(merged) == expected).all()
+
+
+def test_merge_keeps_untouched_tiles_shared(rng):
+    lower = random_buffer(rng, coverage=0.8)
+    upper = LayerBuffer(lower.width, lower.height)
+    paint(upper, [(5, 5), (40, 5)], 0x00FF00FF)
+    merged = lower.copy()
+    canvas_cython_helpers.merge_layer_pixels_cy(merged, 255, upper, 255, True)
+
+    shared = merged.tile_table == lower.tile_table
+    assert not shared[0, 0] and not shared[0, 1]
+    assert shared.sum() == shared.size - 2
+    assert as_array(merged)[5, 40].tolist() == [0, 255, 0, 255]
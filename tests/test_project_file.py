@@ -0,0 +1,138 @@
+import json
+from types import SimpleNamespace
+import zipfile
+
+import numpy as np
+import pytest
+
+import canvas_cython_helpers
+from conftest import paint, pixels
+from layer_buffer import LayerBuffer
+from project_file import (
+    CHUNK_DIR,
+    MANIFEST_NAME,
+    ChunkCache,
+    load_project,
+    save_project,
+    snapshot_layers,
+)
+
+
+def make_layers(rng):
+    layers = []
+    for name, opacity in (("Background", 255), ("Ink", 128)):
+        buffer = LayerBuffer(100, 70)
+        points = zip(
+            rng.integers(0, 100, 400).tolist(), rng.integers(0, 70, 400).tolist()
+        )
+        paint(buffer, points, int(rng.integers(1, 2**32)) | 0xFF)
+        layers.append(
+            {"name": name, "visible": True, "opacity": opacity, "buffer": buffer}
+        )
+    layers[1]["visible"] = False
+    return layers
+
+
+def save(path, layers, chunk_cache=None):
+    save_project(
+        path, 100, 70, 1, layers, chunk_cache or ChunkCache(), lambda fraction: None
+    )
+
+
+def assert_same_layers(loaded, expected):
+    assert len(loaded) == len(expected)
+    for state, original in zip(loaded, expected):
+        assert state["name"] == original["name"]
+        assert state["visible"] == original["visible"]
+        assert state["opacity"] == original["opacity"]
+        assert pixels(state["buffer"]) == pixels(original["buffer"])
+
+
+def test_save_and_load_round_trip(tmp_path, rng):
+    path = tmp_path / "art.pxart"
+    layers = make_layers(rng)
+    save(path, layers)
+
+    width, height, active_index, loaded, source = load_project(path, ChunkCache())
+    assert (width, height, active_index) == (100, 70, 1)
+    assert all(state["buffer"].has_lazy_tiles for state in loaded)
+    assert_same_layers(loaded, layers)
+    source.detach()
+
+
+def test_lazy_resave_over_same_file(tmp_path, rng):
+    path = tmp_path / "art.pxart"
+    save(path, make_layers(rng))
+    chunk_cache = ChunkCache()
+    _, _, _, loaded, source = load_project(path, chunk_cache)
+
+    paint(loaded[0]["buffer"], [(1, 1), (2, 1)], 0x123456FF)
+    untouched = loaded[1]["buffer"]
+    assert untouched.lazy_tile(0, 0) is not None
+    expected = [dict(state, buffer=state["buffer"].copy()) for state in loaded]
+
+    source.detach()
+    save(
+        path,
+        snapshot_layers([SimpleNamespace(**state) for state in loaded]),
+        chunk_cache,
+    )
+
+    _, _, _, reloaded, source = load_project(path, ChunkCache())
+    assert_same_layers(reloaded, expected)
+    source.detach()
+
+
+@pytest.mark.parametrize(
+    "tile, message",
+    [
+        ([4, 0, None], "outside"),
+        ([0, -1, None], "outside"),
+        ([0, 0, "0" * 32], "Missing"),
+    ],
+)
+def test_rejects_bad_tile_references(tmp_path, rng, tile, message):
+    path = tmp_path / "art.pxart"
+    save(path, make_layers(rng))
+    with zipfile.ZipFile(path) as archive:
+        manifest = json.loads(archive.read(MANIFEST_NAME))
+        chunks = {
+            info.filename: archive.read(info)
+            for info in archive.infolist()
+            if info.filename.startswith(CHUNK_DIR)
+        }
+    first_digest = manifest["layers"][0]["tiles"][0][2]
+    manifest["layers"][0]["tiles"].append(tile[:2] + [tile[2] or first_digest])
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_STORED) as archive:
+        archive.writestr(MANIFEST_NAME, json.dumps(manifest))
+        for name, data in chunks.items():
+            archive.writestr(name, data)
+
+    with pytest.raises(ValueError, match=message):
+        load_project(path, ChunkCache())
+
+
+def test_sampled_render_loads_only_sampled_tiles(tmp_path, rng):
+    path = tmp_path / "art.pxart"
+    layers = make_layers(rng)
+    layers[1]["visible"] = True
+    save(path, layers)
+    _, _, _, loaded, source = load_project(path, ChunkCache())
+    layers_info = [(state["buffer"], state["opacity"]) for state in loaded]
+    all_tiles = [set(state["buffer"].tile_keys()) for state in loaded]
+
+    sampled = canvas_cython_helpers.render_sampled_cy(
+        layers_info, False, 0, True, 40, (33, 0, 100, 70)
+    )
+    for state, keys in zip(loaded, all_tiles):
+        buffer = state["buffer"]
+        lazy = {key for key in keys if buffer.lazy_tile(*key) is not None}
+        assert lazy == keys - {(1, 0), (2, 0), (1, 1), (2, 1)}
+
+    full = np.zeros((70, 100, 4), dtype=np.uint8)
+    canvas_cython_helpers.render_layers_into_cy(
+        full, layers_info, False, 0, True, (0, 0, 100, 70)
+    )
+    expected = full[0:70:40, 33:100:40]
+    assert bytes(sampled) == expected.tobytes()
+    source.detach()
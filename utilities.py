@@ -17,6 +17,26 @@ def rgb_to_hex(r, g, b):
     return f"#{int (r ):02x}{int (g ):02x}{int (b ):02x}"
 
 
+def pack_rgba(r, g, b, a=255):
+
+    return (int(r) << 24) | (int(g) << 16) | (int(b) << 8) | int(a)
+
+
+def unpack_rgba(color):
+
+    return ((color >> 24) & 0xFF, (color >> 16) & 0xFF, (color >> 8) & 0xFF, color & 0xFF)
+
+
+def hex_to_packed(hex_color_str, alpha=255):
+
+    return pack_rgba(*hex_to_rgb(hex_color_str), alpha)
+
+
+def packed_to_hex(color):
+
+    return rgb_to_hex(*unpack_rgba(color)[:3])
+
+
 def handle_slider_click(event, slider):
 
     if slider.identify(event.x, event.y) in ("trough1", "trough2"):